@@ -0,0 +1,560 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import io
+import logging
+import os
+import socket
+import time
+from typing import Callable
+
+import checksum
+import compression
+import protocol
+from attribute_journal import AttributeJournal
+from attribute_store import AttributeStore
+from content_index import ContentIndex
+from disk_writer import FileSync
+from filename_index import FilenameIndex
+from partial_store import PartialStore
+from stripe_store import StripeStore
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# Every chunk costs a round trip to the writer pool, so chunks are larger than
+# CONNECTION_BUFSIZE, up to the default limit of the stream reader's buffer
+READ_SIZE = 2**16
+WRITER_THREADS = 4
+
+
+def write_all(file: io.FileIO, chunk: bytes) -> None:
+    """
+    Writes the whole chunk to an unbuffered file, which may write it partially.
+
+    Args:
+        file: The file opened for unbuffered writing.
+        chunk: The data to write.
+    """
+    view = memoryview(chunk)
+    while view:
+        view = view[file.write(view) :]
+
+
+async def receive_metadata(
+    reader: asyncio.StreamReader,
+) -> tuple[str, int, dict[str, str]] | None:
+    """
+    Receives metadata from the client, including the filename, filesize
+    and optional fields (see protocol.encode_metadata), from a metadata frame
+    or the legacy text header of old clients.
+
+    Args:
+        reader: The stream of the client connection.
+
+    Returns:
+        A tuple containing the filename, filesize and optional fields, or None
+        if the client closed the connection before sending anything.
+
+    Raises:
+        ConnectionError: If the client closed the connection in the middle.
+        ValueError: If the metadata is malformed.
+    """
+    try:
+        header = await reader.readexactly(1)
+    except asyncio.IncompleteReadError:
+        return None
+
+    try:
+        if protocol.is_frame(header):
+            header += await reader.readexactly(protocol.FRAME_HEADER.size - 1)
+            block = await reader.readexactly(protocol.parse_frame_header(header))
+            return protocol.parse_frame_metadata(block)
+
+        header += await reader.readexactly(int(os.getenv("METADATA_LENGTH_SIZE")) - 1)
+        file_info = await reader.readexactly(int(header.decode().strip()))
+        return protocol.parse_legacy_metadata(file_info)
+    except asyncio.IncompleteReadError:
+        raise ConnectionError("Socket closed prematurely")
+
+
+async def receive_checksum(reader: asyncio.StreamReader) -> int:
+    """
+    Receives the checksum that follows the content of a file (see protocol.CHECKSUM).
+
+    Args:
+        reader: The stream of the client connection.
+
+    Returns:
+        The client's checksum of the content.
+
+    Raises:
+        ConnectionError: If the client closed the connection in the middle.
+    """
+    try:
+        (expected,) = protocol.CHECKSUM.unpack(
+            await reader.readexactly(protocol.CHECKSUM.size)
+        )
+        return expected
+    except asyncio.IncompleteReadError:
+        raise ConnectionError("Socket closed prematurely")
+
+
+async def receive_frame(
+    reader: asyncio.StreamReader, decompressor: object, count: int
+) -> bytes:
+    """
+    Receives a compressed frame (see protocol.FRAME_LENGTH) and decompresses it.
+
+    Args:
+        reader: The stream of the client connection.
+        decompressor: The decompressor of the file (see compression).
+        count: The number of decompressed bytes left in the file.
+
+    Returns:
+        The decompressed content of the frame, possibly empty.
+
+    Raises:
+        ConnectionError: If the client closed the connection in the middle.
+        ValueError: If the frame is malformed, or decompresses past the filesize or
+            MAX_FRAME_SIZE (checked while decompressing, see compression).
+    """
+    try:
+        (frame_length,) = protocol.FRAME_LENGTH.unpack(
+            await reader.readexactly(protocol.FRAME_LENGTH.size)
+        )
+        if not 0 < frame_length <= protocol.MAX_FRAME_SIZE:
+            raise ValueError(f"Invalid compressed frame length: {frame_length}")
+        return decompressor.decompress(
+            await reader.readexactly(frame_length),
+            min(count, protocol.MAX_FRAME_SIZE),
+        )
+    except asyncio.IncompleteReadError:
+        raise ConnectionError("Socket closed prematurely")
+
+
+class AsyncServer:
+    """
+    The asyncio engine of the server, an alternative to the epoll event loop.
+
+    Speaks the same protocol as the epoll engine (see protocol). The event loop
+    never touches the disk: the storage calls go to a single storage thread, as
+    the filename index and the journal are not thread-safe, and the payload is
+    written by a pool of writer threads.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        filename_index: FilenameIndex,
+        journal: "AttributeJournal | AttributeStore",
+    ):
+        """
+        Initializes the engine and its stores.
+
+        Args:
+            directory: The directory where the files are saved.
+            filename_index: The index of the filenames in the storage directory.
+            journal: The journal of the received files' attributes.
+        """
+        self._filename_index = filename_index
+        self._journal = journal
+        self._file_sync = FileSync(
+            directory,
+            os.getenv("FILE_FSYNC"),
+            float(os.getenv("FILE_FSYNC_INTERVAL")),
+        )
+        self._partial_store = PartialStore(
+            directory, float(os.getenv("PARTIAL_TTL")), self._file_sync
+        )
+        self._stripe_store = StripeStore(
+            directory, float(os.getenv("PARTIAL_TTL")), self._file_sync
+        )
+        self._content_index = ContentIndex(directory)
+
+        self._storage = concurrent.futures.ThreadPoolExecutor(1, "storage")
+        self._writers = concurrent.futures.ThreadPoolExecutor(WRITER_THREADS, "writer")
+
+    async def serve(self, server_socket: socket.socket) -> None:
+        """
+        Accepts connections on the listening socket until cancelled.
+
+        Args:
+            server_socket: The listening server socket.
+        """
+        # start_server() listens on the socket again, with a backlog of 100 by default
+        server = await asyncio.start_server(
+            self.handle_connection, sock=server_socket, backlog=socket.SOMAXCONN
+        )
+        async with server:
+            await self._run_maintenance()
+
+    def close(self) -> None:
+        """Waits for the pending disk operations and closes the stores."""
+        self._writers.shutdown()
+        self._storage.shutdown()
+        self._content_index.close()
+
+    async def _run_maintenance(self) -> None:
+        """
+        Flushes the journal, syncs the committed files and collects the stores when
+        it is due, forever.
+        """
+        while True:
+            timeout = min(
+                self._partial_store.time_until_collection(),
+                self._stripe_store.time_until_collection(),
+                self._content_index.time_until_collection(),
+            )
+            for optional_timeout in (
+                self._journal.time_until_flush(),
+                self._file_sync.time_until_sync(),
+            ):
+                if optional_timeout is not None:
+                    timeout = min(timeout, optional_timeout)
+
+            await asyncio.sleep(timeout)
+            await self._in_storage(self._journal.flush_if_due)
+            await self._in_storage(self._file_sync.sync_if_due)
+            await self._in_storage(self._partial_store.collect_if_due)
+            await self._in_storage(self._stripe_store.collect_if_due)
+            await self._in_storage(self._content_index.collect_if_due)
+
+    async def _in_storage(self, function: Callable, *args: object) -> object:
+        """Runs a call on the storage thread and returns its result."""
+        return await asyncio.get_running_loop().run_in_executor(
+            self._storage, function, *args
+        )
+
+    async def handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """
+        Receives the files of a connection: a single file, or several pipelined ones.
+
+        Args:
+            reader: The stream to receive from.
+            writer: The stream to reply to.
+        """
+        peer = writer.get_extra_info("peername")
+        logging.info(f"Connection from {peer}")
+        try:
+            while True:
+                metadata = await receive_metadata(reader)
+                if not metadata:
+                    # The client has sent all files of a pipelined transfer, or nothing
+                    break
+
+                filename, filesize, fields = metadata
+                sequence = int(fields["seq"]) if "seq" in fields else None
+                await self.receive_file(
+                    reader, writer, peer, filename, filesize, fields, sequence
+                )
+                if sequence is None:
+                    break
+        except Exception as e:
+            logging.error(f"Error in connection from {peer}: {e}")
+        finally:
+            writer.close()
+            with contextlib.suppress(OSError):
+                await writer.wait_closed()
+            logging.info(f"Closed connection from {peer}")
+
+    async def receive_file(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        peer: tuple[str, int],
+        filename: str,
+        filesize: int,
+        fields: dict[str, str],
+        sequence: int | None,
+    ) -> None:
+        """
+        Receives the content of a file and acknowledges it, see
+        server.handle_metadata_reception() for the resumable, duplicate, striped
+        and checksummed files.
+
+        Args:
+            reader: The stream to receive from.
+            writer: The stream to reply to.
+            peer: The address of the client.
+            filename: The original filename.
+            filesize: The size of the file in bytes.
+            fields: The optional metadata fields.
+            sequence: The sequence number of a pipelined file, None otherwise.
+
+        Raises:
+            ConnectionError: If the client closed the connection in the middle.
+        """
+        transfer_id = fields.get("tid")
+        content_hash = fields.get("hash")
+        if transfer_id and content_hash:
+            linked_filename = await self._in_storage(
+                self._content_index.link,
+                content_hash,
+                filesize,
+                filename,
+                self._filename_index,
+            )
+            if linked_filename:
+                await self._in_storage(
+                    self._journal.append,
+                    linked_filename,
+                    filesize,
+                    f"{peer[0]}:{peer[1]}",
+                    0.0,
+                    content_hash,
+                )
+                logging.info(f"Saved {linked_filename} from {peer} as a duplicate")
+                writer.write(
+                    protocol.encode_reply(protocol.REPLY_DUPLICATE, sequence or 0)
+                    + protocol.LEGACY_ACK
+                )
+                await writer.drain()
+                return
+
+        codec = fields.get("codec")
+        if codec and not compression.is_available(codec):
+            if not transfer_id:
+                raise ValueError(f"Unsupported compression codec: {codec}")
+            codec = None
+
+        stripe = None
+        end = filesize
+        partial_name = transfer_id
+        if "stripe" in fields:
+            if not transfer_id or codec:
+                raise ValueError("A stripe requires a transfer ID and no codec")
+            index, count = protocol.parse_stripe(fields["stripe"])
+            file, received, end = await self._in_storage(
+                self._stripe_store.open, transfer_id, filesize, index, count
+            )
+            stripe = (index, count)
+        elif transfer_id:
+            file, received = await self._in_storage(
+                self._partial_store.open, transfer_id, filename, filesize
+            )
+            kind = (
+                protocol.REPLY_READY
+                if codec or "codec" not in fields
+                else protocol.REPLY_READY_RAW
+            )
+            writer.write(protocol.encode_reply(kind, sequence or 0, received))
+        else:
+            file, partial_name = await self._in_storage(
+                self._partial_store.create, filesize
+            )
+            received = 0
+
+        # Hashed while received unless resumed, so it needs no verification pass
+        content_digest = (
+            protocol.create_content_digest()
+            if content_hash and not stripe and not received
+            else None
+        )
+        algorithm = fields.get("sum")
+        digest = None
+        if algorithm and checksum.is_available(algorithm):
+            digest = checksum.create_checksum(algorithm)
+        elif algorithm:
+            logging.warning(f"Cannot verify {filename}, {algorithm} is not installed")
+
+        logging.info(f"Receiving {filename} ({filesize} bytes)")
+        started = time.perf_counter()
+        start = received
+        loop = asyncio.get_running_loop()
+        decompressor = codec and compression.create_decompressor(codec)
+        write = None
+        try:
+            while received < end:
+                if decompressor:
+                    chunk = await receive_frame(reader, decompressor, end - received)
+                    if not chunk:
+                        continue
+                else:
+                    chunk = await reader.read(min(READ_SIZE, end - received))
+                    if not chunk:
+                        raise ConnectionError("Socket closed prematurely")
+
+                if digest:
+                    digest.update(chunk)
+                if content_digest:
+                    content_digest.update(chunk)
+                # The next chunk is received while the previous one is written
+                if write:
+                    await write
+                write = loop.run_in_executor(self._writers, write_all, file, chunk)
+                received += len(chunk)
+
+            if write:
+                await write
+
+            expected = algorithm and await receive_checksum(reader)
+            if digest and digest.intdigest() != expected:
+                # A resumable upload keeps the content received before this connection
+                received = start
+                raise protocol.ChecksumMismatchError(
+                    f"Checksum mismatch of {filename}: "
+                    f"{digest.intdigest():#x} != {expected:#x}"
+                )
+        except BaseException as e:
+            if write:
+                with contextlib.suppress(Exception):
+                    await write
+            await self._in_storage(
+                self._abort_file,
+                file,
+                transfer_id,
+                partial_name,
+                stripe,
+                filename,
+                filesize,
+                received,
+            )
+            if not isinstance(e, protocol.ChecksumMismatchError):
+                raise
+
+            logging.error(f"Error in connection from {peer}: {e}")
+            writer.write(
+                protocol.encode_reply(
+                    protocol.REPLY_CHECKSUM_MISMATCH, sequence or 0, digest.intdigest()
+                )
+            )
+            await writer.drain()
+            return
+
+        duration = time.perf_counter() - started
+        if stripe:
+            filename = await self._in_storage(
+                self._finish_stripe, file, transfer_id, filename, stripe
+            )
+            if filename:
+                await self._in_storage(
+                    self._journal.append,
+                    filename,
+                    filesize,
+                    f"{peer[0]}:{peer[1]}",
+                    duration,
+                )
+                logging.info(
+                    f"Saved {filename} from {peer} ({filesize} bytes, striped)"
+                )
+        else:
+            filename, content_hash = await self._in_storage(
+                self._finalize_file,
+                file,
+                partial_name,
+                filename,
+                content_hash,
+                content_digest,
+            )
+            await self._in_storage(
+                self._journal.append,
+                filename,
+                received,
+                f"{peer[0]}:{peer[1]}",
+                duration,
+                content_hash,
+            )
+            logging.info(
+                f"Saved {filename} from {peer} ({received} bytes in {duration:.3f} s, "
+                f"{received / max(duration, 1e-9) / 2**20:.1f} MiB/s)"
+            )
+
+        if sequence is None:
+            writer.write(protocol.LEGACY_ACK)
+        else:
+            writer.write(protocol.encode_reply(protocol.REPLY_ACK, sequence))
+        await writer.drain()
+
+    def _finalize_file(
+        self,
+        file: io.FileIO,
+        partial_name: str,
+        filename: str,
+        content_hash: str | None,
+        content_digest: object,
+    ) -> tuple[str, str | None]:
+        """
+        Closes a completely received file, see server.commit_file_reception().
+
+        Returns:
+            The unique filename the file is saved under, and its content hash if
+            the content digest verified it.
+        """
+        filename = self._partial_store.commit(
+            partial_name, filename, self._filename_index
+        )
+        file.close()
+        if content_hash:
+            content_hash = self._content_index.add(
+                content_hash, filename, content_digest
+            )
+
+        return filename, content_hash
+
+    def _finish_stripe(
+        self,
+        file: io.FileIO,
+        transfer_id: str,
+        filename: str,
+        stripe: tuple[int, int],
+    ) -> str | None:
+        """
+        Closes a completely received stripe, see server.commit_file_reception().
+
+        Returns:
+            The unique filename the file is saved under if the stripe completed it,
+            None otherwise.
+        """
+        file.close()
+        index, count = stripe
+        return self._stripe_store.finish(
+            transfer_id, filename, index, count, self._filename_index
+        )
+
+    def _abort_file(
+        self,
+        file: io.FileIO,
+        transfer_id: str | None,
+        partial_name: str,
+        stripe: tuple[int, int] | None,
+        filename: str,
+        filesize: int,
+        received: int,
+    ) -> None:
+        """Handles an interrupted file reception, see server.abort_file_reception()."""
+        file.close()
+        if stripe:
+            return
+        if transfer_id:
+            self._partial_store.save(transfer_id, filename, filesize, received)
+            return
+        self._partial_store.discard(partial_name)
+
+
+def serve(
+    directory: str,
+    server_socket: socket.socket,
+    filename_index: FilenameIndex,
+    journal: "AttributeJournal | AttributeStore",
+) -> None:
+    """
+    Runs the asyncio engine on the server socket, with uvloop if it is installed.
+
+    Args:
+        directory: The directory where the file will be saved.
+        server_socket: The listening server socket.
+        filename_index: The index of the filenames in the storage directory.
+        journal: The journal of the received files' attributes.
+    """
+    server = AsyncServer(directory, filename_index, journal)
+    try:
+        loop_factory = uvloop.new_event_loop if uvloop else None
+        with asyncio.Runner(loop_factory=loop_factory) as runner:
+            runner.run(server.serve(server_socket))
+    finally:
+        server.close()
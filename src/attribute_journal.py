@@ -0,0 +1,199 @@
+import csv
+import fcntl
+import io
+import logging
+import os
+import time
+from datetime import datetime
+
+FIELDS = ("Timestamp", "Filename", "Size", "Peer", "Duration", "ContentHash")
+FSYNC_POLICIES = ("none", "batch", "always")
+
+
+class AttributeJournal:
+    """
+    An append-only journal of the received files' attributes (file_attributes.csv).
+
+    The file stays open for the life of the server. Records are collected in memory
+    and written out in one append when enough of them are pending or the oldest one
+    has waited long enough, so completing an upload costs no disk I/O.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        flush_records: int,
+        flush_interval: float,
+        fsync_policy: str = "none",
+    ):
+        """
+        Initializes the journal, opening the file and writing the header if it is empty.
+        A journal with older columns is upgraded first, see upgrade_journal().
+
+        Args:
+            path: The path of the journal file.
+            flush_records: The number of pending records that triggers a flush.
+            flush_interval: The maximum time in seconds a record stays in memory.
+            fsync_policy: When to fsync the file: "none" leaves it to the OS,
+                "batch" syncs after every flush, "always" flushes and syncs every record.
+
+        Raises:
+            ValueError: If the fsync policy is unknown, or the file has columns
+                other than FIELDS.
+        """
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {fsync_policy}")
+
+        self._flush_records = 1 if fsync_policy == "always" else flush_records
+        self._flush_interval = flush_interval
+        self._fsync = fsync_policy != "none"
+
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+        self._pending = 0
+        self._oldest_pending = 0.0
+
+        self._file = self._open(path)
+
+    @staticmethod
+    def _open(path: str) -> io.TextIOWrapper:
+        """Opens the journal for appending, with the current header, see __init__()."""
+        while True:
+            file = open(path, "a", newline="")
+            # Worker processes append to the same file, see flush()
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                current = os.fstat(file.fileno()).st_ino == os.stat(path).st_ino
+                if current and not file.tell():
+                    csv.writer(file).writerow(FIELDS)
+                    file.flush()
+                    return file
+                if current and not upgrade_journal(path):
+                    return file
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+            # Replaced by the upgraded journal, by this or another worker process
+            file.close()
+
+    def append(
+        self,
+        filename: str,
+        size: int,
+        peer: str,
+        duration: float,
+        content_hash: str = None,
+    ) -> None:
+        """
+        Adds a record for a received file, flushing the journal if enough are pending.
+
+        Args:
+            filename: The name the file is saved under.
+            size: The size of the file in bytes.
+            peer: The address of the client that sent the file.
+            duration: The transfer duration in seconds.
+            content_hash: The verified content hash (optional).
+        """
+        self._writer.writerow(
+            (
+                datetime.now().isoformat(),
+                filename,
+                size,
+                peer,
+                f"{duration:.6f}",
+                content_hash or "",
+            )
+        )
+        if not self._pending:
+            self._oldest_pending = time.monotonic()
+        self._pending += 1
+
+        if self._pending >= self._flush_records:
+            self.flush()
+
+    def time_until_flush(self) -> float | None:
+        """
+        Returns the time left until the pending records must be flushed.
+
+        Returns:
+            The time in seconds, or None if there is nothing to flush.
+        """
+        if not self._pending:
+            return None
+        elapsed = time.monotonic() - self._oldest_pending
+        return max(self._flush_interval - elapsed, 0.0)
+
+    def flush_if_due(self) -> None:
+        """Flushes the pending records if the oldest one has waited long enough."""
+        if self._pending and self.time_until_flush() == 0:
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes the pending records to the file in a single append."""
+        if not self._pending:
+            return
+
+        block = self._buffer.getvalue()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._pending = 0
+
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        try:
+            self._file.write(block)
+            self._file.flush()
+            if self._fsync:
+                os.fsync(self._file.fileno())
+        except OSError as e:
+            logging.error(f"Error writing file attributes: {e}")
+        finally:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def close(self) -> None:
+        """Flushes the pending records and closes the file."""
+        try:
+            self.flush()
+        finally:
+            self._file.close()
+
+
+def upgrade_journal(path: str) -> bool:
+    """
+    Rewrites a journal written with older columns, e.g. only the Timestamp and
+    Filename of the first servers, under the current FIELDS with the missing fields
+    left empty, so new records never land under an old header. The rewritten
+    journal replaces the old one atomically.
+
+    Every older header is a prefix of FIELDS, so records are upgraded by position:
+    those appended under an old header by servers writing more columns keep
+    their values.
+
+    Args:
+        path: The path of the journal file.
+
+    Returns:
+        True if the journal was rewritten, False if its columns are current.
+
+    Raises:
+        ValueError: If the file has columns other than FIELDS.
+    """
+    with open(path, newline="") as journal:
+        rows = csv.reader(journal)
+        header = tuple(next(rows, ()))
+        if header == FIELDS:
+            return False
+        if not header or header != FIELDS[: len(header)]:
+            raise ValueError(f"Unknown columns in {path}: {', '.join(header)}")
+
+        upgraded_path = f"{path}.upgrade"
+        with open(upgraded_path, "w", newline="") as upgraded:
+            writer = csv.writer(upgraded)
+            writer.writerow(FIELDS)
+            for row in rows:
+                writer.writerow(row + [""] * (len(FIELDS) - len(row)))
+            upgraded.flush()
+            os.fsync(upgraded.fileno())
+
+    os.replace(upgraded_path, path)
+    logging.info(f"Upgraded {path} to the columns {', '.join(FIELDS)}")
+    return True
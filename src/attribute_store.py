@@ -0,0 +1,316 @@
+import csv
+import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+DATABASE_NAME = "file_attributes.sqlite3"
+COLUMNS = ("timestamp", "filename", "size", "peer", "duration", "content_hash")
+SYNCHRONOUS_MODES = {"none": "OFF", "batch": "NORMAL", "always": "FULL"}
+# The span of an ISO 8601 time by its length, e.g. 12:00 is a whole minute
+TIME_SPANS = {2: timedelta(hours=1), 5: timedelta(minutes=1), 8: timedelta(seconds=1)}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    timestamp TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    size INTEGER,
+    peer TEXT,
+    duration REAL,
+    content_hash TEXT
+);
+CREATE INDEX IF NOT EXISTS files_filename ON files (filename);
+CREATE INDEX IF NOT EXISTS files_timestamp ON files (timestamp);
+CREATE INDEX IF NOT EXISTS files_content_hash ON files (content_hash);
+CREATE TABLE IF NOT EXISTS imports (
+    path TEXT PRIMARY KEY,
+    imported_at TEXT NOT NULL
+);
+"""
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """
+    Opens the attribute database, creating its schema if needed.
+
+    Args:
+        path: The path of the database file.
+
+    Returns:
+        The database connection.
+    """
+    # Worker processes write to the same database, waiting for each other's locks
+    connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def import_csv(connection: sqlite3.Connection, csv_path: str) -> int:
+    """
+    Imports the records of a file_attributes.csv journal, once per journal file.
+
+    Args:
+        connection: The database connection.
+        csv_path: The path of the CSV journal.
+
+    Returns:
+        The number of imported records, 0 if the journal was imported before.
+    """
+    csv_path = os.path.abspath(csv_path)
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        imported = connection.execute(
+            "SELECT 1 FROM imports WHERE path = ?", (csv_path,)
+        ).fetchone()
+        records = []
+        if not imported and os.path.exists(csv_path):
+            with open(csv_path, newline="") as csv_file:
+                # Journals not upgraded yet may only have the Timestamp and
+                # Filename columns, see attribute_journal.upgrade_journal()
+                for row in csv.DictReader(csv_file):
+                    records.append(
+                        (
+                            row["Timestamp"],
+                            row["Filename"],
+                            row.get("Size") or None,
+                            row.get("Peer") or None,
+                            row.get("Duration") or None,
+                            row.get("ContentHash") or None,
+                        )
+                    )
+            connection.executemany(
+                f"INSERT INTO files ({', '.join(COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?)",
+                records,
+            )
+            connection.execute(
+                "INSERT INTO imports VALUES (?, ?)",
+                (csv_path, datetime.now().isoformat()),
+            )
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+
+    return len(records)
+
+
+def query_between(connection: sqlite3.Connection, start: str, end: str) -> list[tuple]:
+    """
+    Finds the files received between two ISO 8601 timestamps (inclusive). The end
+    includes all of the span it is written to, e.g. 2024-06-01 the whole day and
+    2024-06-01T12:00 the whole minute.
+
+    The timestamps are normalised to the isoformat() the records are stored in,
+    so they compare as strings, using the timestamp index.
+
+    Args:
+        connection: The database connection.
+        start: The earliest timestamp.
+        end: The latest timestamp.
+
+    Returns:
+        The matching records, ordered by timestamp.
+
+    Raises:
+        ValueError: If a timestamp is not in ISO 8601 format.
+    """
+    return connection.execute(
+        f"SELECT {', '.join(COLUMNS)} FROM files "
+        "WHERE timestamp >= ? AND timestamp < ? ORDER BY timestamp",
+        (datetime.fromisoformat(start).isoformat(), end_after(end)),
+    ).fetchall()
+
+
+def end_after(timestamp: str) -> str:
+    """
+    Returns the first timestamp after the span an ISO 8601 timestamp is written to.
+
+    Args:
+        timestamp: A date, or a date and a time.
+
+    Returns:
+        The timestamp in isoformat().
+
+    Raises:
+        ValueError: If the timestamp is not in ISO 8601 format.
+    """
+    parsed = datetime.fromisoformat(timestamp)
+    date_and_time = re.split(r"[T ]", timestamp, maxsplit=1)
+    if len(date_and_time) == 1:
+        return (parsed + timedelta(days=1)).isoformat()
+    return (
+        parsed + TIME_SPANS.get(len(date_and_time[1]), timedelta(microseconds=1))
+    ).isoformat()
+
+
+def query_filename(connection: sqlite3.Connection, filename: str) -> list[tuple]:
+    """
+    Finds the files saved under a name.
+
+    Args:
+        connection: The database connection.
+        filename: The name the file is saved under.
+
+    Returns:
+        The matching records, ordered by timestamp.
+    """
+    return connection.execute(
+        f"SELECT {', '.join(COLUMNS)} FROM files "
+        "WHERE filename = ? ORDER BY timestamp",
+        (filename,),
+    ).fetchall()
+
+
+def query_content_hash(
+    connection: sqlite3.Connection, content_hash: str
+) -> list[tuple]:
+    """
+    Finds the files with the given content hash.
+
+    Args:
+        connection: The database connection.
+        content_hash: The hex digest of the file content.
+
+    Returns:
+        The matching records, ordered by timestamp.
+    """
+    return connection.execute(
+        f"SELECT {', '.join(COLUMNS)} FROM files "
+        "WHERE content_hash = ? ORDER BY timestamp",
+        (content_hash,),
+    ).fetchall()
+
+
+class AttributeStore:
+    """
+    An SQLite-backed store of the received files' attributes, indexed by
+    filename, timestamp and content hash.
+
+    Has the same interface as AttributeJournal. Records are handed to a writer thread
+    that inserts them in batched transactions, off the event loop thread.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        flush_records: int,
+        flush_interval: float,
+        fsync_policy: str = "none",
+        csv_path: str = None,
+    ):
+        """
+        Initializes the store, creating the database and starting the writer thread.
+
+        Args:
+            path: The path of the database file.
+            flush_records: The maximum number of records inserted in one transaction.
+            flush_interval: The maximum time in seconds a record waits to be inserted.
+            fsync_policy: When to sync the database: "none" leaves it to the OS,
+                "batch" syncs on WAL checkpoints, "always" syncs every record.
+            csv_path: The path of a CSV journal to import once (optional).
+
+        Raises:
+            ValueError: If the fsync policy is unknown.
+        """
+        if fsync_policy not in SYNCHRONOUS_MODES:
+            raise ValueError(f"Unknown fsync policy: {fsync_policy}")
+
+        self._path = path
+        self._flush_records = 1 if fsync_policy == "always" else flush_records
+        self._flush_interval = flush_interval
+        self._synchronous = SYNCHRONOUS_MODES[fsync_policy]
+        self._queue = queue.SimpleQueue()
+
+        connection = connect(path)
+        try:
+            if csv_path:
+                imported = import_csv(connection, csv_path)
+                if imported:
+                    logging.info(f"Imported {imported} records from {csv_path}")
+        finally:
+            connection.close()
+
+        self._thread = threading.Thread(target=self._run, name="attribute-store")
+        self._thread.start()
+
+    def append(
+        self,
+        filename: str,
+        size: int,
+        peer: str,
+        duration: float,
+        content_hash: str = None,
+    ) -> None:
+        """
+        Queues a record for a received file.
+
+        Args:
+            filename: The name the file is saved under.
+            size: The size of the file in bytes.
+            peer: The address of the client that sent the file.
+            duration: The transfer duration in seconds.
+            content_hash: The verified content hash (optional).
+        """
+        self._queue.put(
+            (datetime.now().isoformat(), filename, size, peer, duration, content_hash)
+        )
+
+    def time_until_flush(self) -> None:
+        """Returns None, as the writer thread flushes the records on its own."""
+        return None
+
+    def flush_if_due(self) -> None:
+        """Does nothing, as the writer thread flushes the records on its own."""
+
+    def close(self) -> None:
+        """Inserts the queued records and stops the writer thread."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        """Inserts the queued records in batches until close() is called."""
+        connection = connect(self._path)
+        connection.execute(f"PRAGMA synchronous = {self._synchronous}")
+        try:
+            running = True
+            while running:
+                batch = [self._queue.get()]
+                if batch[0] is None:
+                    break
+
+                deadline = time.monotonic() + self._flush_interval
+                while len(batch) < self._flush_records:
+                    try:
+                        record = self._queue.get(
+                            timeout=max(deadline - time.monotonic(), 0)
+                        )
+                    except queue.Empty:
+                        break
+                    if record is None:
+                        running = False
+                        break
+                    batch.append(record)
+
+                self._insert(connection, batch)
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _insert(connection: sqlite3.Connection, batch: list[tuple]) -> None:
+        """Inserts a batch of records in one transaction."""
+        try:
+            with connection:
+                connection.execute("BEGIN")
+                connection.executemany(
+                    f"INSERT INTO files ({', '.join(COLUMNS)}) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    batch,
+                )
+        except sqlite3.Error as e:
+            logging.error(f"Error writing file attributes: {e}")
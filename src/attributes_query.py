@@ -0,0 +1,70 @@
+import argparse
+import csv
+import logging
+import os
+import sys
+
+import attribute_store
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Query the attributes of the files stored by the server"
+    )
+    parser.add_argument("directory", help="Directory the server saves files to")
+    subparsers = parser.add_subparsers(dest="query", required=True)
+
+    between_parser = subparsers.add_parser(
+        "between", help="Files received between two ISO 8601 timestamps"
+    )
+    between_parser.add_argument("start", help="Earliest timestamp, e.g. 2024-06-01")
+    between_parser.add_argument("end", help="Latest timestamp, e.g. 2024-06-02T12:00")
+
+    exists_parser = subparsers.add_parser("exists", help="Files saved under a name")
+    exists_parser.add_argument("filename", help="Name the file is saved under")
+
+    hash_parser = subparsers.add_parser("hash", help="Files with a content hash")
+    hash_parser.add_argument("content_hash", help="Hex digest of the file content")
+
+    subparsers.add_parser(
+        "import", help="Import file_attributes.csv if it was not imported yet"
+    )
+
+    args = parser.parse_args()
+
+    connection = attribute_store.connect(
+        os.path.join(args.directory, attribute_store.DATABASE_NAME)
+    )
+    try:
+        if args.query == "import":
+            imported = attribute_store.import_csv(
+                connection, os.path.join(args.directory, "file_attributes.csv")
+            )
+            logging.info(f"Imported {imported} records")
+            return 0
+
+        if args.query == "between":
+            try:
+                records = attribute_store.query_between(
+                    connection, args.start, args.end
+                )
+            except ValueError as e:
+                parser.error(str(e))
+        elif args.query == "exists":
+            records = attribute_store.query_filename(connection, args.filename)
+        else:
+            records = attribute_store.query_content_hash(connection, args.content_hash)
+    finally:
+        connection.close()
+
+    writer = csv.writer(sys.stdout)
+    writer.writerow(attribute_store.COLUMNS)
+    writer.writerows(records)
+    return 0 if records else 1
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    sys.exit(main())
@@ -0,0 +1,82 @@
+import zlib
+from typing import Callable
+
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# In the order of preference: crc32c runs on the CPU's CRC instructions, xxh3 is
+# nearly as fast in software, zlib's crc32 is always available
+ALGORITHMS = ("crc32c", "xxh3", "crc32")
+
+
+class _Crc:
+    """Adapts a CRC function to the update()/intdigest() interface of xxhash."""
+
+    def __init__(self, function: Callable[[bytes, int], int]):
+        self._function = function
+        self._value = 0
+
+    def update(self, data: bytes) -> None:
+        self._value = self._function(data, self._value)
+
+    def intdigest(self) -> int:
+        return self._value
+
+
+def is_available(algorithm: str) -> bool:
+    """
+    Checks whether a checksum algorithm can be used, as crc32c and xxh3 are
+    optional dependencies.
+
+    Args:
+        algorithm: The algorithm name, one of ALGORITHMS.
+
+    Returns:
+        True if the algorithm's library is installed.
+    """
+    if algorithm == "crc32c":
+        return crc32c is not None
+    if algorithm == "xxh3":
+        return xxhash is not None
+    return algorithm == "crc32"
+
+
+def fastest_available() -> str:
+    """
+    Returns the fastest checksum algorithm installed.
+
+    Returns:
+        The algorithm name, one of ALGORITHMS.
+    """
+    return next(algorithm for algorithm in ALGORITHMS if is_available(algorithm))
+
+
+def create_checksum(algorithm: str) -> object:
+    """
+    Creates a streaming checksum.
+
+    Args:
+        algorithm: The algorithm name, one of ALGORITHMS.
+
+    Returns:
+        An object with update(data) and intdigest() methods, the digest fitting
+        in protocol.CHECKSUM.
+
+    Raises:
+        ValueError: If the algorithm is unknown or not installed.
+    """
+    if not is_available(algorithm):
+        raise ValueError(f"Unsupported checksum algorithm: {algorithm}")
+
+    if algorithm == "crc32c":
+        return _Crc(crc32c.crc32c)
+    if algorithm == "xxh3":
+        return xxhash.xxh3_64()
+    return _Crc(zlib.crc32)
@@ -9,11 +9,30 @@ from PyQt6.QtWidgets import QApplication
 
 import client_cli
 import client_gui
-
-
-def main_cli(file_path: str, host: str, port: int) -> None:
+import compression
+
+
+def main_cli(
+    file_paths: list[str],
+    host: str,
+    port: int,
+    jobs: int,
+    retries: int,
+    codec: str | None,
+    level: int | None,
+    stripes: int,
+) -> None:
     try:
-        client_cli.send_file(file_path, host, port)
+        if len(file_paths) == 1 and os.path.isfile(file_paths[0]) and stripes > 1:
+            client_cli.send_striped(file_paths[0], host, port, stripes, retries)
+            return
+        if len(file_paths) == 1 and os.path.isfile(file_paths[0]):
+            client_cli.send_file(
+                file_paths[0], host, port, retries=retries, codec=codec, level=level
+            )
+            return
+
+        client_cli.send_tree(file_paths, host, port, jobs, codec, level)
     except Exception as e:
         logging.error(f"Failed to send file: {e}")
 
@@ -40,14 +59,64 @@ def main() -> None:
     subparsers.add_parser("gui", help="Run in GUI mode")
     cli_parser = subparsers.add_parser("cli", help="Run in CLI mode")
 
-    cli_parser.add_argument("file_path", help="Path to the file to transfer")
+    cli_parser.add_argument(
+        "file_paths",
+        nargs="+",
+        metavar="file_path",
+        help="Path to the file, directory or glob pattern to transfer",
+    )
     cli_parser.add_argument("host", help="Server IP address")
     cli_parser.add_argument("port", type=int, help="Server port")
+    cli_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=4,
+        help="Number of concurrent connections for several files (default: 4)",
+    )
+    cli_parser.add_argument(
+        "-r",
+        "--retries",
+        type=int,
+        default=3,
+        help="Number of times to resume a single file after a connection error "
+        "(default: 3)",
+    )
+    cli_parser.add_argument(
+        "-z",
+        "--compress",
+        choices=compression.CODECS,
+        help="Compress the content with the codec, skipped for files that do not "
+        "compress well (zstd and lz4 must be installed on both ends)",
+    )
+    cli_parser.add_argument(
+        "-l",
+        "--level",
+        type=int,
+        help="Compression level (default: fast level of the codec)",
+    )
+    cli_parser.add_argument(
+        "-s",
+        "--stripes",
+        type=int,
+        default=1,
+        help="Number of parallel connections to split a single large file across, "
+        "uncompressed (default: 1)",
+    )
 
     args = parser.parse_args()
 
     if args.mode == "cli":
-        main_cli(args.file_path, args.host, args.port)
+        main_cli(
+            args.file_paths,
+            args.host,
+            args.port,
+            args.jobs,
+            args.retries,
+            args.compress,
+            args.level,
+            args.stripes,
+        )
     else:
         main_gui(external_data_dir)
 
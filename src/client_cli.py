@@ -1,101 +1,789 @@
+import concurrent.futures
+import contextlib
+import glob
+import hashlib
+import io
 import logging
 import os
 import socket
+import threading
+import time
+from typing import Callable, Iterable, Iterator
 
-import tqdm
+import checksum
+import compression
+import protocol
+from send_window import SendWindow
+from transfer_progress import ByteCounter, ProgressBar, TransferProgress
 
-import gui_progress_handler
+COMPRESSION_BLOCK_SIZE = 2**18
+COMPRESSION_SAMPLE_SIZE = 2**20
+# Compression is turned off for files whose sample compresses worse than this
+MIN_COMPRESSION_RATIO = 1.2
+# Smaller stripes are not worth a connection of their own
+MIN_STRIPE_SIZE = 8 * 2**20
+# The size of the reads of the content sent with sendfile(), for its checksum
+CHECKSUM_READ_SIZE = 2**20
+CORRUPTED_REASON = "Corrupted in transfer (checksum mismatch)"
 
 
-def send_metadata(file_path: str, client_socket: socket.socket) -> str:
+def connect(host: str, port: int) -> socket.socket:
+    """
+    Open a connection to the server.
+
+    The send buffer of the socket is set to SOCKET_SNDBUF bytes, unless it is 0,
+    which leaves it to the kernel's autotuning.
+
+    Args:
+        host: The IP address of the server.
+        port: The port number of the server.
+
+    Returns:
+        The connected socket.
+    """
+    client_socket = socket.create_connection((host, port))
+    send_buffer = int(os.getenv("SOCKET_SNDBUF"))
+    if send_buffer:
+        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer)
+    return client_socket
+
+
+def send_metadata(
+    file_path: str, client_socket: socket.socket, **fields: object
+) -> str:
     """
     Send metadata of the file to the server.
 
-    This function sends the metadata of the file, including the filename and
-    file size, to the server using the provided socket.
+    This function sends the metadata frame of the file, including the filename and
+    file size, to the server using the provided socket, in a single call.
 
     Args:
         file_path: The path of the file whose metadata is to be sent.
         client_socket: The socket object for the connection to the server.
+        **fields: The optional metadata fields (see protocol.encode_metadata).
 
     Returns:
         The filename of the file whose metadata was sent.
-
-    Notes:
-        METADATA_LENGTH_SIZE is an environment variable that specifies the size of the
-        metadata length in bytes. Must be set before running the script (see .env).
     """
     filesize = os.path.getsize(file_path)
     filename = os.path.basename(file_path)
 
-    file_info = f"{filename}/{filesize}"
-    metadata_size = int(os.getenv("METADATA_LENGTH_SIZE"))
-    metadata_length = f"{len(file_info):<{metadata_size}}".encode()
-
-    client_socket.sendall(metadata_length)
-    client_socket.sendall(file_info.encode())
+    client_socket.sendall(protocol.encode_metadata(filename, filesize, **fields))
 
     logging.info(f"File {filename} metadata sent to server")
     return filename
 
 
+def transfer_id(file_path: str) -> str:
+    """
+    Compute the ID of a resumable upload of the file.
+
+    The ID is derived from the file's absolute path, size and modification time,
+    so an interrupted upload of an unchanged file is resumed, even by another run.
+
+    Args:
+        file_path: The path of the file.
+
+    Returns:
+        The transfer ID (hex digits).
+    """
+    stat = os.stat(file_path)
+    key = f"{os.path.abspath(file_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+
+def receive_reply(client_socket: socket.socket) -> tuple[int, int, int]:
+    """
+    Receive a server reply to a pipelined or resumable file.
+
+    Args:
+        client_socket: The socket object for the connection to the server.
+
+    Returns:
+        A tuple containing the reply kind, sequence number and value.
+
+    Raises:
+        ConnectionResetError: If the server closed the connection.
+    """
+    reply = client_socket.recv(protocol.REPLY.size, socket.MSG_WAITALL)
+    if len(reply) < protocol.REPLY.size:
+        raise ConnectionResetError("Server closed the connection")
+    return protocol.REPLY.unpack(reply)
+
+
+def receive_ack(client_socket: socket.socket, filename: str) -> None:
+    """
+    Receive the server's acknowledgement of a single file.
+
+    Args:
+        client_socket: The socket object for the connection to the server.
+        filename: The filename of the file, for the errors.
+
+    Raises:
+        ChecksumMismatchError: If the content the server received was corrupted.
+        ConnectionResetError: If the server failed to receive the file.
+    """
+    ack = client_socket.recv(1)
+    if ack == protocol.LEGACY_ACK:
+        return
+    if ack and ack[0] == protocol.REPLY_CHECKSUM_MISMATCH:
+        raise protocol.ChecksumMismatchError(f"{filename} was corrupted in transfer")
+    raise ConnectionResetError(f"Server failed to receive {filename}")
+
+
+def choose_codec(file: io.BufferedReader, codec: str | None, level: int) -> str | None:
+    """
+    Check whether a file is worth compressing, by compressing a sample from its start.
+
+    Args:
+        file: The file to be sent, its position is restored afterwards.
+        codec: The requested compression codec, None for no compression.
+        level: The compression level, the codec's default if None.
+
+    Returns:
+        The codec if the sample compresses well enough, None otherwise.
+    """
+    if not codec:
+        return None
+
+    position = file.tell()
+    sample = file.read(COMPRESSION_SAMPLE_SIZE)
+    file.seek(position)
+    if not sample:
+        return None
+
+    compressor = compression.create_compressor(codec, level)
+    ratio = len(sample) / len(compressor.compress(sample) + compressor.flush())
+    if ratio < MIN_COMPRESSION_RATIO:
+        logging.info(f"Sending {file.name} uncompressed (ratio {ratio:.2f})")
+        return None
+    return codec
+
+
+def send_compressed_payload(
+    file: io.BufferedReader,
+    file_size: int,
+    client_socket: socket.socket,
+    progress: TransferProgress,
+    counter: ByteCounter,
+    offset: int,
+    codec: str,
+    level: int,
+    digest: object,
+) -> bool:
+    """
+    Send the content of an open file to the server as compressed frames
+    (see protocol.FRAME_LENGTH), see send_payload().
+
+    The compressor output of the last block is flushed into the same frame,
+    so the server completes the file right after that frame.
+    """
+    compressor = compression.create_compressor(codec, level)
+    file.seek(offset)
+    block = file.read(min(COMPRESSION_BLOCK_SIZE, file_size - offset))
+    while block:
+        offset += len(block)
+        if digest:
+            digest.update(block)
+        next_block = file.read(min(COMPRESSION_BLOCK_SIZE, file_size - offset))
+        frame = compressor.compress(block)
+        if not next_block:
+            frame += compressor.flush()
+        if frame:
+            protocol.send_buffers(
+                client_socket, protocol.FRAME_LENGTH.pack(len(frame)), frame
+            )
+        counter.value += len(block)
+        if progress.cancelled.is_set():
+            return False
+        block = next_block
+
+    if offset < file_size:
+        raise ConnectionResetError(f"{file.name} was truncated while sending")
+    return True
+
+
+def send_payload(
+    file: io.BufferedReader,
+    file_size: int,
+    client_socket: socket.socket,
+    progress: TransferProgress,
+    offset: int = 0,
+    codec: str = None,
+    level: int = None,
+    checksum_algorithm: str = None,
+) -> bool:
+    """
+    Send the content of an open file to the server in chunks.
+
+    With a checksum algorithm, the content is followed by its checksum (see
+    protocol.CHECKSUM). The checksum is computed from the page cache right after
+    every chunk is sent with sendfile(), while the chunk is still cached, or from
+    the blocks read for the compressor.
+
+    The chunks sent with sendfile() are sized by a SendWindow, to keep the calls
+    back into Python few. Per chunk, the progress is only counted and checked for
+    cancellation, the displays sample it on their own (see TransferProgress).
+
+    Args:
+        file: The file to be sent.
+        file_size: The size of the file in bytes.
+        client_socket: The socket object for the connection to the server.
+        progress: The progress to count the sent bytes in.
+        offset: The offset to start sending from.
+        codec: The compression codec announced in the metadata, None to send
+            the content as is with sendfile().
+        level: The compression level, the codec's default if None.
+        checksum_algorithm: The checksum algorithm announced in the metadata
+            (see checksum), None to send no checksum.
+
+    Returns:
+        True if the file was sent, False if the transfer was canceled.
+
+    Raises:
+        ConnectionResetError: If the server stops receiving the file.
+
+    Notes:
+        SEND_WINDOW is an environment variable that fixes the size of the chunks
+        sent with sendfile(), 0 sizes them adaptively (see .env).
+    """
+    digest = checksum_algorithm and checksum.create_checksum(checksum_algorithm)
+    counter = progress.counter()
+    if codec:
+        if not send_compressed_payload(
+            file,
+            file_size,
+            client_socket,
+            progress,
+            counter,
+            offset,
+            codec,
+            level,
+            digest,
+        ):
+            return False
+    else:
+        window = SendWindow(client_socket)
+        buffer = memoryview(bytearray(CHECKSUM_READ_SIZE)) if digest else None
+        while offset < file_size:
+            if progress.cancelled.is_set():
+                return False
+            start = time.perf_counter()
+            sent = client_socket.sendfile(
+                file, offset, min(window.size, file_size - offset)
+            )
+            window.update(sent, time.perf_counter() - start)
+            if not sent:
+                raise ConnectionResetError(f"Server failed to receive {file.name}")
+            if digest:
+                update_from_file(digest, file, offset, sent, buffer)
+            offset += sent
+            counter.value += sent
+
+    if digest:
+        client_socket.sendall(protocol.CHECKSUM.pack(digest.intdigest()))
+    return True
+
+
+def update_from_file(
+    digest: object,
+    file: io.BufferedReader,
+    offset: int,
+    length: int,
+    buffer: memoryview,
+) -> None:
+    """
+    Update a checksum with a range of a file, read into a reused buffer.
+
+    Args:
+        digest: The checksum (see checksum.create_checksum).
+        file: The file the range is read from, its position is left as is.
+        offset: The offset of the range.
+        length: The length of the range.
+        buffer: The buffer to read into, in pieces of its length.
+
+    Raises:
+        ConnectionResetError: If the file was truncated while sending.
+    """
+    while length:
+        read = os.preadv(file.fileno(), [buffer[:length]], offset)
+        if not read:
+            raise ConnectionResetError(f"{file.name} was truncated while sending")
+        digest.update(buffer[:read])
+        length -= read
+        offset += read
+
+
 def send_file(
     file_path: str,
     host: str,
     port: int,
-    progress_handler: "gui_progress_handler.ProgressHandler" = None,
-) -> None:
+    progress: TransferProgress = None,
+    retries: int = 0,
+    codec: str = None,
+    level: int = None,
+) -> bool:
     """
     Send a file to a server.
 
     This function establishes a connection to the server, sends the file metadata,
-    and then sends the file in chunks. If the GUI progress handler is provided,
-    it will be used to update the progress bar of the sending process.
+    and then sends the file in chunks, counting them in the progress, which the
+    caller can display and cancel the transfer through (see TransferProgress).
+
+    The upload is resumable: the server replies to the metadata with the offset
+    it already has from an interrupted upload of the same file, and the file is
+    sent from there. A dropped connection is resumed up to `retries` times.
+
+    The metadata carries the content hash of the file, so if the server already
+    stores the same content, it saves the file without the content being sent.
+
+    The content is compressed with the codec if a sample of it compresses well,
+    and the server supports the codec. It is followed by its checksum, so the
+    server rejects it if it was corrupted in transfer.
 
     Args:
         file_path: The path of the file to be sent.
         host: The IP address of the server.
         port: The port number of the server.
-        progress_handler: The GUI progress handler for updating the progress bar of sending the file.
+        progress: The progress of the transfer, shared with the caller (optional,
+            displayed with a ProgressBar if not given).
+        retries: The number of times to reconnect and resume after a connection error.
+        codec: The compression codec (see compression.CODECS), None for no compression.
+        level: The compression level, the codec's default if None.
+
+    Returns:
+        True if the file was saved by the server, False if the transfer was canceled.
 
     Raises:
         FileNotFoundError: If the file to be sent does not exist.
         ConnectionResetError: If the server fails to receive the file.
+        ChecksumMismatchError: If the file was corrupted in transfer.
 
     Notes:
-        CONNECTION_BUFSIZE is an environment variable that specifies the buffer size
-        for the connection. Must be set before running the script (see .env).
+        SEND_WINDOW and SOCKET_SNDBUF are environment variables that tune the
+        sending (see send_payload() and connect()). Must be set before running
+        the script (see .env).
     """
-    with socket.create_connection((host, port)) as client_socket:
-        filename = send_metadata(file_path, client_socket)
+    with open(file_path, "rb") as f:
+        codec = choose_codec(f, codec, level)
+        content_hash = protocol.content_hash(f)
+    display = contextlib.nullcontext()
+    if progress is None:
+        progress = TransferProgress()
+        display = ProgressBar(progress, "Sending file")
+
+    with display:
+        for attempt in range(retries + 1):
+            try:
+                return send_file_attempt(
+                    file_path,
+                    host,
+                    port,
+                    content_hash,
+                    progress,
+                    codec,
+                    level,
+                )
+            except ConnectionError as e:
+                if attempt == retries:
+                    raise
+                logging.warning(f"Sending {file_path} interrupted ({e}), resuming")
+                time.sleep(1)
 
-        read_size = int(os.getenv("CONNECTION_BUFSIZE"))
+
+def send_file_attempt(
+    file_path: str,
+    host: str,
+    port: int,
+    content_hash: str,
+    progress: TransferProgress,
+    codec: str | None,
+    level: int | None,
+) -> bool:
+    """
+    Make a single attempt to send a file to a server, see send_file().
+
+    Args:
+        file_path: The path of the file to be sent.
+        host: The IP address of the server.
+        port: The port number of the server.
+        content_hash: The content hash of the file (see protocol.content_hash).
+        progress: The progress of the transfer, counted over from the resumed offset.
+        codec: The compression codec, None for no compression.
+        level: The compression level, the codec's default if None.
+
+    Returns:
+        True if the file was saved by the server, False if the transfer was canceled.
+    """
+    with connect(host, port) as client_socket:
+        algorithm = checksum.fastest_available()
+        fields = {"tid": transfer_id(file_path), "hash": content_hash, "sum": algorithm}
+        if codec:
+            fields["codec"] = codec
+        filename = send_metadata(file_path, client_socket, **fields)
+        kind, _, offset = receive_reply(client_socket)
         file_size = os.path.getsize(file_path)
+        if kind == protocol.REPLY_DUPLICATE:
+            if not client_socket.recv(1):
+                raise ConnectionResetError(f"Server failed to save {filename}")
 
-        if progress_handler:
-            progress_handler.final_value = file_size
-
-        offset = 0
-        with open(file_path, "rb") as f, tqdm.tqdm(
-            desc="Sending file", total=file_size, ncols=80, unit="B", unit_scale=True
-        ) as pbar:
-            while offset < file_size:
-                sent = client_socket.sendfile(f, offset, read_size * 4)
-                if not sent:
-                    raise ConnectionResetError(f"Server failed to receive {filename}")
-                offset += sent
-                pbar.update(sent)
-
-                if progress_handler and not progress_handler.update_progress(sent):
-                    client_socket.close()
-                    return
+            logging.info(
+                f"File {filename} is already on the server, saved without sending"
+            )
+            progress.restart(file_size, file_size)
+            return True
 
-        success = client_socket.recv(1)
-        client_socket.close()
+        if kind == protocol.REPLY_READY_RAW:
+            logging.info(f"Server does not support {codec}, sending uncompressed")
+            codec = None
+        if offset:
+            logging.info(f"Resuming {filename} from byte {offset}")
+
+        progress.restart(file_size, offset)
+        with open(file_path, "rb") as f:
+            if not send_payload(
+                f,
+                file_size,
+                client_socket,
+                progress,
+                offset,
+                codec,
+                level,
+                algorithm,
+            ):
+                client_socket.close()
+                return False
 
-        if not success:
-            raise ConnectionResetError(f"Server failed to receive {filename}")
+        receive_ack(client_socket, filename)
+        client_socket.close()
 
         logging.info(f"File {filename} sent successfully")
-        if progress_handler:
-            progress_handler.finish()
+        return True
+
+
+def send_striped(
+    file_path: str, host: str, port: int, stripes: int, retries: int = 0
+) -> None:
+    """
+    Send a large file to a server over several parallel connections.
+
+    The file is split into ranges (stripes, see protocol.stripe_range), every one
+    sent with sendfile() from its own offset over its own connection, so a single
+    file is not limited by the throughput of a single TCP stream. The server writes
+    every stripe at its offset into the preallocated file, and saves the file once
+    all stripes have arrived. A stripe whose connection drops is sent again, up to
+    `retries` times, its bytes counted in the progress once. Every stripe is
+    followed by its own checksum.
+
+    Files too small for every stripe to reach MIN_STRIPE_SIZE use fewer stripes.
+
+    Args:
+        file_path: The path of the file to be sent.
+        host: The IP address of the server.
+        port: The port number of the server.
+        stripes: The number of parallel connections.
+        retries: The number of times to send a stripe again after a connection error.
+
+    Raises:
+        FileNotFoundError: If the file to be sent does not exist.
+        ConnectionResetError: If the server fails to receive the file.
+        ChecksumMismatchError: If a stripe was corrupted in transfer.
+    """
+    file_size = os.path.getsize(file_path)
+    algorithm = checksum.fastest_available()
+    stripes = max(min(stripes, file_size // MIN_STRIPE_SIZE), 1)
+    upload_id = transfer_id(file_path)
+
+    def send_stripe(index: int) -> None:
+        start, end = protocol.stripe_range(file_size, index, stripes)
+        counter = progress.counter()
+        counted = counter.value
+        for attempt in range(retries + 1):
+            try:
+                with connect(host, port) as client_socket, open(file_path, "rb") as f:
+                    send_metadata(
+                        file_path,
+                        client_socket,
+                        tid=upload_id,
+                        stripe=f"{index}/{stripes}",
+                        sum=algorithm,
+                    )
+                    send_payload(
+                        f,
+                        end,
+                        client_socket,
+                        progress,
+                        offset=start,
+                        checksum_algorithm=algorithm,
+                    )
+                    receive_ack(client_socket, f"stripe {index} of {file_path}")
+                    return
+            except ConnectionError as e:
+                # The stripe is sent again from its start
+                counter.value = counted
+                if attempt == retries:
+                    raise
+                logging.warning(f"Sending stripe {index} interrupted ({e}), resending")
+                time.sleep(1)
+
+    progress = TransferProgress(file_size)
+    start = time.perf_counter()
+    with ProgressBar(progress, "Sending file"), concurrent.futures.ThreadPoolExecutor(
+        stripes
+    ) as executor:
+        for future in [executor.submit(send_stripe, i) for i in range(stripes)]:
+            future.result()
+    elapsed = time.perf_counter() - start
+
+    logging.info(
+        f"File {os.path.basename(file_path)} sent successfully over {stripes} "
+        f"connections ({file_size / 2**20 / max(elapsed, 1e-9):.1f} MiB/s)"
+    )
+
+
+def receive_replies(
+    client_socket: socket.socket,
+    acknowledged: set[int],
+    corrupted: set[int],
+    on_reply: Callable[[int, bool], None] = None,
+) -> None:
+    """
+    Receive the server's replies to a pipelined transfer until the server
+    closes the connection.
+
+    Args:
+        client_socket: The socket object for the connection to the server.
+        acknowledged: The set to add the sequence numbers of the received files to.
+        corrupted: The set to add the sequence numbers of the files whose checksum
+            did not match to.
+        on_reply: Called with the sequence number of every acknowledged or corrupted
+            file, and whether it was acknowledged (optional).
+    """
+    with client_socket.makefile("rb") as replies:
+        while len(reply := replies.read(protocol.REPLY.size)) == protocol.REPLY.size:
+            kind, sequence, _ = protocol.REPLY.unpack(reply)
+            if kind == protocol.REPLY_ACK:
+                acknowledged.add(sequence)
+            elif kind == protocol.REPLY_CHECKSUM_MISMATCH:
+                corrupted.add(sequence)
+            else:
+                continue
+            if on_reply:
+                on_reply(sequence, kind == protocol.REPLY_ACK)
+
+
+def send_files(
+    file_paths: Iterable[str],
+    host: str,
+    port: int,
+    progress: TransferProgress = None,
+    codec: str = None,
+    level: int = None,
+    file_progress: Callable[[str], TransferProgress] = None,
+    on_result: Callable[[str, str | None], None] = None,
+) -> dict[str, str]:
+    """
+    Send several files to a server over a single connection.
+
+    The files are pipelined: their metadata and content are streamed one after
+    another, while the server acknowledges every file by its sequence number
+    in the background, so the client never waits for a round trip. Every file
+    is followed by its checksum.
+
+    Args:
+        file_paths: The paths of the files to be sent, consumed lazily.
+        host: The IP address of the server.
+        port: The port number of the server.
+        progress: The progress to count the sent bytes in, shared by concurrent
+            connections (optional, displayed with a ProgressBar if neither it nor
+            file_progress is given). Canceling it stops sending, the files sent
+            before are still acknowledged, the ones after are not sent.
+        codec: The compression codec for the files that compress well (optional),
+            the server must support it.
+        level: The compression level, the codec's default if None.
+        file_progress: Returns the progress of every file, counted and canceled
+            like the shared one, instead of the shared one (optional).
+        on_result: Called with the path of every file and None as soon as it is
+            acknowledged, or the reason it was not sent, from the thread
+            receiving the replies or the calling one (optional).
+
+    Returns:
+        The paths of the files that were not sent, mapped to the reasons.
+
+    Raises:
+        OSError: If the connection to the server cannot be established.
+    """
+    acknowledged = set()
+    corrupted = set()
+    algorithm = checksum.fastest_available()
+    sent_paths = {}
+    failures = {}
+    error = None
+
+    def report(sequence: int, sent: bool) -> None:
+        if on_result:
+            on_result(sent_paths[sequence], None if sent else CORRUPTED_REASON)
+
+    display = contextlib.nullcontext()
+    if progress is None and not file_progress:
+        progress = TransferProgress()
+        display = ProgressBar(progress, "Sending files")
+
+    with connect(host, port) as client_socket, display:
+        reader = threading.Thread(
+            target=receive_replies,
+            args=(client_socket, acknowledged, corrupted, report),
+        )
+        reader.start()
+        try:
+            for sequence, file_path in enumerate(file_paths):
+                try:
+                    f = open(file_path, "rb")
+                except OSError as e:
+                    failures[file_path] = e.strerror
+                    if on_result:
+                        on_result(file_path, e.strerror)
+                    continue
+
+                sent_paths[sequence] = file_path
+                with f:
+                    file_size = os.fstat(f.fileno()).st_size
+                    fields = {"seq": sequence, "sum": algorithm}
+                    file_codec = choose_codec(f, codec, level)
+                    if file_codec:
+                        fields["codec"] = file_codec
+                    send_metadata(file_path, client_socket, **fields)
+                    if not send_payload(
+                        f,
+                        file_size,
+                        client_socket,
+                        file_progress(file_path) if file_progress else progress,
+                        0,
+                        file_codec,
+                        level,
+                        algorithm,
+                    ):
+                        raise ConnectionAbortedError("Canceled")
+
+            # Lets the server close the connection once all files are acknowledged
+            client_socket.shutdown(socket.SHUT_WR)
+        except OSError as e:
+            error = e
+            with contextlib.suppress(OSError):
+                # A canceled transfer still reads the acknowledgements of the files
+                # sent before, the server drops the canceled one at the end of input
+                client_socket.shutdown(
+                    socket.SHUT_WR
+                    if isinstance(e, ConnectionAbortedError)
+                    else socket.SHUT_RDWR
+                )
+        finally:
+            reader.join()
+
+    for sequence, file_path in sent_paths.items():
+        if sequence in acknowledged:
+            logging.info(f"File {os.path.basename(file_path)} sent successfully")
+        elif sequence in corrupted:
+            failures[file_path] = CORRUPTED_REASON
+        else:
+            failures[file_path] = str(error or "Not acknowledged by the server")
+            if on_result:
+                on_result(file_path, failures[file_path])
+
+    return failures
+
+
+def iter_file_paths(patterns: Iterable[str]) -> Iterator[str]:
+    """
+    Lazily expand files, directories and glob patterns into file paths.
+
+    Directories are walked recursively, glob patterns support "**". Paths that
+    match nothing are yielded as is, so they are reported as failures.
+
+    Args:
+        patterns: The paths of files or directories, or glob patterns.
+
+    Yields:
+        The paths of the files to be sent.
+    """
+    for pattern in patterns:
+        paths = (
+            glob.iglob(pattern, recursive=True)
+            if glob.has_magic(pattern)
+            else [pattern]
+        )
+        for path in paths:
+            if not os.path.isdir(path):
+                yield path
+                continue
+
+            for root, _, filenames in os.walk(path):
+                for filename in filenames:
+                    yield os.path.join(root, filename)
+
+
+def send_tree(
+    patterns: list[str],
+    host: str,
+    port: int,
+    jobs: int,
+    codec: str = None,
+    level: int = None,
+) -> dict[str, str]:
+    """
+    Send files, directories and glob patterns to a server over a pool of
+    concurrent pipelined connections, logging a summary at the end.
+
+    Args:
+        patterns: The paths of files or directories, or glob patterns.
+        host: The IP address of the server.
+        port: The port number of the server.
+        jobs: The number of concurrent connections.
+        codec: The compression codec (see send_files()), None for no compression.
+        level: The compression level, the codec's default if None.
+
+    Returns:
+        The paths of the files that were not sent, mapped to the reasons.
+    """
+    paths = iter_file_paths(patterns)
+    paths_lock = threading.Lock()
+    taken = 0
+    failures = {}
+
+    def next_path() -> str | None:
+        nonlocal taken
+        with paths_lock:
+            path = next(paths, None)
+            taken += path is not None
+            return path
+
+    def run_connection() -> None:
+        try:
+            failures.update(
+                send_files(iter(next_path, None), host, port, progress, codec, level)
+            )
+        except Exception as e:
+            logging.error(f"Failed to send files to {host}:{port}: {e}")
+
+    progress = TransferProgress()
+    start = time.perf_counter()
+    with ProgressBar(progress, "Sending files"), concurrent.futures.ThreadPoolExecutor(
+        jobs
+    ) as executor:
+        for _ in range(jobs):
+            executor.submit(run_connection)
+    elapsed = time.perf_counter() - start
+
+    # Left over if every connection failed
+    for path in iter(next_path, None):
+        failures[path] = "No connection to the server"
+
+    logging.info(
+        f"Sent {taken - len(failures)} of {taken} files "
+        f"({progress.sent / 2**20:.1f} MiB in {elapsed:.2f} s, "
+        f"{progress.sent / 2**20 / max(elapsed, 1e-9):.1f} MiB/s)"
+    )
+    for path, reason in failures.items():
+        logging.error(f"Failed to send {path}: {reason}")
+
+    return failures
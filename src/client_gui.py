@@ -1,32 +1,46 @@
 import logging
+from typing import Callable
 
 import qdarktheme
+from PyQt6.QtCore import Qt
+from PyQt6.QtGui import QDragEnterEvent, QDropEvent, QIntValidator
 from PyQt6.QtWidgets import (
+    QAbstractItemView,
+    QHBoxLayout,
+    QHeaderView,
     QVBoxLayout,
     QLabel,
     QLineEdit,
     QPushButton,
     QFileDialog,
-    QMessageBox,
     QMainWindow,
+    QSpinBox,
+    QTableView,
     QWidget,
-    QProgressDialog,
 )
 
-from gui_progress_handler import ProgressHandler
+from gui_transfer_queue import (
+    ProgressDelegate,
+    TransferItem,
+    TransferQueue,
+    TransferQueueModel,
+)
+
+# The number of files sent concurrently at start, as the CLI's --jobs
+DEFAULT_WORKERS = 4
+MAX_WORKERS = 32
 
 
 class FileTransferClientGUI(QMainWindow):
     """A GUI application for transferring files using PyQt6."""
 
-    _send_progress_dialog: QProgressDialog = None
-
     def __init__(self):
         """Initializes the FileTransferClientGUI class."""
         super().__init__()
+        self._queue = TransferQueue(DEFAULT_WORKERS)
+        self._model = TransferQueueModel(self._queue, self)
         self._init_ui()
 
-        self._suppress_progress_warning = False
         self.show()
 
     def _init_ui(self) -> None:
@@ -34,18 +48,12 @@ class FileTransferClientGUI(QMainWindow):
         qdarktheme.setup_theme(custom_colors={"primary": "#d79df1"})
 
         self.setWindowTitle("File Transfer Client")
-        self.setFixedSize(300, 300)
+        self.resize(720, 480)
+        self.setAcceptDrops(True)
 
         self.main_widget = QWidget(self)
         layout = QVBoxLayout()
 
-        self._file_label = QLabel("File:", self.main_widget)
-        self._file_input = QLineEdit(self.main_widget)
-        self._file_input.textChanged.connect(lambda _: self._handle_button_state())
-
-        self._browse_button = QPushButton("Browse", self.main_widget)
-        self._browse_button.clicked.connect(self._browse_file)
-
         self._host_label = QLabel("Host:", self.main_widget)
         self._host_input = QLineEdit(self.main_widget)
         self._host_input.setPlaceholderText("127.0.0.1 or example.com")
@@ -54,113 +62,147 @@ class FileTransferClientGUI(QMainWindow):
         self._port_label = QLabel("Port:", self.main_widget)
         self._port_input = QLineEdit(self.main_widget)
         self._port_input.setPlaceholderText("12345")
+        self._port_input.setValidator(QIntValidator(1, 65535, self._port_input))
         self._port_input.textChanged.connect(lambda _: self._handle_button_state())
 
-        self._send_button = QPushButton("Send", self.main_widget)
-        self._send_button.clicked.connect(self._handle_button_click)
-        self._send_button.setDisabled(True)
+        self._workers_label = QLabel("Parallel:", self.main_widget)
+        self._workers_input = QSpinBox(self.main_widget)
+        self._workers_input.setRange(1, MAX_WORKERS)
+        self._workers_input.setValue(DEFAULT_WORKERS)
+        self._workers_input.valueChanged.connect(self._queue.set_workers)
+
+        self._add_files_button = QPushButton("Add files", self.main_widget)
+        self._add_files_button.clicked.connect(self._browse_files)
+        self._add_files_button.setDisabled(True)
+
+        self._add_folder_button = QPushButton("Add folder", self.main_widget)
+        self._add_folder_button.clicked.connect(self._browse_folder)
+        self._add_folder_button.setDisabled(True)
+
+        self._queue_view = QTableView(self.main_widget)
+        self._queue_view.setModel(self._model)
+        self._queue_view.setItemDelegateForColumn(
+            TransferQueueModel.PROGRESS_COLUMN, ProgressDelegate(self._queue_view)
+        )
+        self._queue_view.setSelectionBehavior(
+            QAbstractItemView.SelectionBehavior.SelectRows
+        )
+        self._queue_view.setSelectionMode(
+            QAbstractItemView.SelectionMode.ExtendedSelection
+        )
+        self._queue_view.setTextElideMode(Qt.TextElideMode.ElideMiddle)
+        self._queue_view.setWordWrap(False)
+        self._queue_view.verticalHeader().hide()
+        # Fixed sizes, so thousands of rows are never measured
+        self._queue_view.verticalHeader().setSectionResizeMode(
+            QHeaderView.ResizeMode.Fixed
+        )
+        header = self._queue_view.horizontalHeader()
+        header.setSectionResizeMode(0, QHeaderView.ResizeMode.Stretch)
+        for column, width in ((1, 80), (2, 120), (3, 160)):
+            header.setSectionResizeMode(column, QHeaderView.ResizeMode.Interactive)
+            header.resizeSection(column, width)
+
+        self._cancel_button = QPushButton("Cancel", self.main_widget)
+        self._cancel_button.clicked.connect(
+            lambda: self._for_selected(self._queue.cancel)
+        )
+
+        self._retry_button = QPushButton("Retry", self.main_widget)
+        self._retry_button.clicked.connect(
+            lambda: self._for_selected(self._queue.retry)
+        )
+
+        self._clear_button = QPushButton("Clear finished", self.main_widget)
+        self._clear_button.clicked.connect(self._model.clear_finished)
+
+        self._summary_label = QLabel("Drop files or folders here", self.main_widget)
+        self._model.summary_change.connect(self._summary_label.setText)
+
+        server_layout = QHBoxLayout()
+        server_layout.addWidget(self._host_label)
+        server_layout.addWidget(self._host_input, 1)
+        server_layout.addWidget(self._port_label)
+        server_layout.addWidget(self._port_input)
+        server_layout.addWidget(self._workers_label)
+        server_layout.addWidget(self._workers_input)
+
+        add_layout = QHBoxLayout()
+        add_layout.addWidget(self._add_files_button)
+        add_layout.addWidget(self._add_folder_button)
 
-        self._file_input.returnPressed.connect(self._send_button.click)
-        self._host_input.returnPressed.connect(self._send_button.click)
-        self._port_input.returnPressed.connect(self._send_button.click)
+        item_layout = QHBoxLayout()
+        item_layout.addWidget(self._cancel_button)
+        item_layout.addWidget(self._retry_button)
+        item_layout.addWidget(self._clear_button)
 
-        layout.addWidget(self._file_label)
-        layout.addWidget(self._file_input)
-        layout.addWidget(self._browse_button)
-        layout.addWidget(self._host_label)
-        layout.addWidget(self._host_input)
-        layout.addWidget(self._port_label)
-        layout.addWidget(self._port_input)
-        layout.addWidget(self._send_button)
+        layout.addLayout(server_layout)
+        layout.addLayout(add_layout)
+        layout.addWidget(self._queue_view)
+        layout.addLayout(item_layout)
+        layout.addWidget(self._summary_label)
 
         self.main_widget.setLayout(layout)
         self.setCentralWidget(self.main_widget)
 
-    def _browse_file(self) -> None:
-        """
-        Opens a file dialog to browse and select a file.
+    def _browse_files(self) -> None:
+        """Opens a file dialog to select files, and queues them."""
+        file_names, _ = QFileDialog.getOpenFileNames(self, "Add Files")
 
-        Sets the selected file path in the file input line edit.
-        """
-        file_name, _ = QFileDialog.getOpenFileName(self, "Open File")
+        if file_names:
+            self._add_paths(file_names)
+
+    def _browse_folder(self) -> None:
+        """Opens a file dialog to select a folder, and queues the files in it."""
+        directory = QFileDialog.getExistingDirectory(self, "Add Folder")
+
+        if directory:
+            self._add_paths([directory])
 
-        if file_name:
-            self._file_input.setText(file_name)
+    def _can_add(self) -> bool:
+        """Whether the server to send the files to is set."""
+        return bool(self._host_input.text() and self._port_input.text())
 
     def _handle_button_state(self) -> None:
         """
-        Enables or disables the send button based on the input fields.
+        Enables or disables the add buttons based on the input fields.
 
-        The send button is enabled only if the file, host, and port fields are not empty.
+        The add buttons are enabled only if the host and port fields are not empty.
         """
-        if (
-            self._file_input.text()
-            and self._host_input.text()
-            and self._port_input.text()
-        ):
-            self._send_button.setEnabled(True)
-        else:
-            self._send_button.setDisabled(True)
-
-    def _handle_button_click(self) -> None:
+        self._add_files_button.setEnabled(self._can_add())
+        self._add_folder_button.setEnabled(self._can_add())
+
+    def _add_paths(self, paths: list[str]) -> None:
         """
-        Handles the click event of the send button to send the selected file.
+        Queues files and folders to be sent to the server of the input fields.
 
-        Displays a progress dialog while the file transfer is in progress.
+        Args:
+            paths: The paths of the files and folders.
         """
-        if not self._send_progress_dialog:
-            self._init_progress_dialog()
+        logging.info(f"Queueing {len(paths)} paths")
+        self._queue.add(paths, self._host_input.text(), int(self._port_input.text()))
 
-        self._progress_handler.set_info_to_send(
-            self._file_input.text(), self._host_input.text(), self._port_input.text()
-        )
-        self._progress_handler.start()
-
-    def _init_progress_dialog(self):
-        """Initializes the progress dialog. Sets handle functions for the progress dialog."""
-
-        def __handle_progress_change(value) -> None:
-            self._send_progress_dialog.setValue(value)
-
-            if value == -1:
-                self._send_progress_dialog.show()
-                self._send_progress_dialog.cancel_button.setEnabled(True)
-            elif value == 99:
-                self._send_progress_dialog.cancel_button.setDisabled(True)
-            elif value == 100:
-                QMessageBox.information(self, "Success", "File sent successfully")
-
-        def __handle_progress_error(error_text: str) -> None:
-            self._suppress_progress_warning = True
-            self._send_progress_dialog.close()
-            logging.error(f"Failed to send file: {error_text}")
-            QMessageBox.critical(self, "Error", f"Failed to send file: {error_text}")
-            self._suppress_progress_warning = False
-
-        def __handle_cancel_click() -> None:
-            if self._suppress_progress_warning:
-                return
-
-            self._send_progress_dialog.hide()
-            self._progress_handler.final_value = -1
-            QMessageBox.warning(self, "Warning", "File transfer canceled")
-            logging.warning("File transfer canceled")
-
-        self._send_progress_dialog = QProgressDialog("", "Cancel", 0, 100, self)
-        self._send_progress_dialog.setWindowTitle("Sending File")
-        self._send_progress_dialog.setMinimumWidth(300)
-        self._send_progress_dialog.setModal(True)
-        self._send_progress_dialog.cancel_button = self._send_progress_dialog.findChild(
-            QPushButton
-        )
+    def _for_selected(self, action: Callable[[TransferItem], None]) -> None:
+        """
+        Applies a queue action (cancel or retry) to the items of the selected rows.
+
+        Args:
+            action: The TransferQueue method taking an item.
+        """
+        for index in self._queue_view.selectionModel().selectedRows():
+            action(self._model.item(index.row()))
+
+    def dragEnterEvent(self, a0: QDragEnterEvent) -> None:
+        if a0.mimeData().hasUrls() and self._can_add():
+            a0.acceptProposedAction()
 
-        self._progress_handler = ProgressHandler(self._send_progress_dialog)
-        self._progress_handler.progress_change.connect(__handle_progress_change)
-        self._progress_handler.error.connect(__handle_progress_error)
-        self._send_progress_dialog.canceled.connect(__handle_cancel_click)
+    def dropEvent(self, a0: QDropEvent) -> None:
+        paths = [url.toLocalFile() for url in a0.mimeData().urls() if url.isLocalFile()]
+        if paths:
+            self._add_paths(paths)
+            a0.acceptProposedAction()
 
     def closeEvent(self, a0):
         logging.info("Closing client GUI...")
-        self._suppress_progress_warning = True
-        self._progress_handler.terminate()
+        self._queue.close()
         super().closeEvent(a0)
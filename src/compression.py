@@ -0,0 +1,156 @@
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+CODECS = ("zstd", "lz4", "zlib")
+# Favor speed, as the compression runs inline with the transfer
+DEFAULT_LEVELS = {"zstd": 3, "lz4": 0, "zlib": 1}
+# The size of the pieces zstd hands its output over in, see _ZstdDecompressor
+ZSTD_WRITE_SIZE = 2**17
+
+
+class _LZ4Compressor:
+    """Adapts lz4.frame.LZ4FrameCompressor to the compressobj() interface."""
+
+    def __init__(self, level: int):
+        self._compressor = lz4.frame.LZ4FrameCompressor(compression_level=level)
+        self._header = self._compressor.begin()
+
+    def compress(self, data: bytes) -> bytes:
+        header, self._header = self._header, b""
+        return header + self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        header, self._header = self._header, b""
+        return header + self._compressor.flush()
+
+
+class _LimitedBuffer:
+    """Collects decompressed output, refusing to grow past a limit."""
+
+    def __init__(self):
+        self.limit = 0
+        self._chunks: list[bytes] = []
+        self._size = 0
+
+    def write(self, data: bytes) -> int:
+        self._size += len(data)
+        if self._size > self.limit:
+            raise ValueError(f"Decompressed content exceeds {self.limit} bytes")
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def take(self) -> bytes:
+        output = b"".join(self._chunks)
+        self._chunks = []
+        self._size = 0
+        return output
+
+
+class _ZstdDecompressor:
+    """
+    Bounds the output of zstd, whose decompressobj() has no max_length: the stream
+    writer hands the output over in ZSTD_WRITE_SIZE pieces, and the buffer stops it
+    at the first piece past the limit.
+    """
+
+    def __init__(self):
+        self._buffer = _LimitedBuffer()
+        self._writer = zstandard.ZstdDecompressor().stream_writer(
+            self._buffer, write_size=ZSTD_WRITE_SIZE
+        )
+
+    def decompress(self, data: bytes, max_length: int) -> bytes:
+        self._buffer.limit = max_length
+        self._writer.write(data)
+        return self._buffer.take()
+
+
+class _BoundedDecompressor:
+    """Adapts zlib and lz4 decompressors, which take a max_length, to a hard limit."""
+
+    def __init__(self, decompressor: object):
+        self._decompressor = decompressor
+
+    def decompress(self, data: bytes, max_length: int) -> bytes:
+        # One byte past the limit is enough to tell the data exceeds it
+        output = self._decompressor.decompress(data, max_length + 1)
+        if len(output) > max_length:
+            raise ValueError(f"Decompressed content exceeds {max_length} bytes")
+        return output
+
+
+def is_available(codec: str) -> bool:
+    """
+    Checks whether a codec can be used, as zstd and lz4 are optional dependencies.
+
+    Args:
+        codec: The codec name, one of CODECS.
+
+    Returns:
+        True if the codec's library is installed.
+    """
+    if codec == "zstd":
+        return zstandard is not None
+    if codec == "lz4":
+        return lz4 is not None
+    return codec == "zlib"
+
+
+def create_compressor(codec: str, level: int = None) -> object:
+    """
+    Creates a streaming compressor.
+
+    Args:
+        codec: The codec name, one of CODECS.
+        level: The compression level, the codec's default if None.
+
+    Returns:
+        An object with compress(data) and flush() methods returning the compressed bytes.
+
+    Raises:
+        ValueError: If the codec is unknown or not installed.
+    """
+    if not is_available(codec):
+        raise ValueError(f"Unsupported compression codec: {codec}")
+
+    level = DEFAULT_LEVELS[codec] if level is None else level
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    if codec == "lz4":
+        return _LZ4Compressor(level)
+    return zlib.compressobj(level)
+
+
+def create_decompressor(codec: str) -> object:
+    """
+    Creates a streaming decompressor, whose output is bounded, so a small frame
+    inflating to gigabytes (a decompression bomb) is rejected before it is held
+    in memory.
+
+    Args:
+        codec: The codec name, one of CODECS.
+
+    Returns:
+        An object with a decompress(data, max_length) method returning the
+        decompressed bytes, raising ValueError once they exceed max_length.
+
+    Raises:
+        ValueError: If the codec is unknown or not installed.
+    """
+    if not is_available(codec):
+        raise ValueError(f"Unsupported compression codec: {codec}")
+
+    if codec == "zstd":
+        return _ZstdDecompressor()
+    if codec == "lz4":
+        return _BoundedDecompressor(lz4.frame.LZ4FrameDecompressor())
+    return _BoundedDecompressor(zlib.decompressobj())
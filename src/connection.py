@@ -0,0 +1,115 @@
+import enum
+import io
+import socket
+import time
+
+
+class State(enum.IntEnum):
+    """The states of a connection of the epoll engine, in the order they are passed."""
+
+    RECEIVE_METADATA_LENGTH = 0
+    RECEIVE_METADATA_BODY = 1
+    RECEIVE_FILE = 2
+    RECEIVE_CHECKSUM = 3
+    COMMITTING = 4
+    CLOSING = 5
+    CLOSED = 6
+
+
+class Connection:
+    """
+    The state of a client connection of the epoll engine. The attributes are slots,
+    so a connection takes a fixed-size object instead of a dict, and every access
+    in the hot loop is an attribute lookup instead of a string-keyed one.
+    """
+
+    __slots__ = (
+        "socket",
+        "peer",
+        "state",
+        # The bytes of the metadata or of the checksum received so far
+        "partial",
+        "metadata_length",
+        "legacy_metadata",
+        "file",
+        "filename",
+        # The offset the content ends at: the filesize, or the end of a stripe
+        "filesize",
+        "received",
+        "started",
+        "metadata_started",
+        # The perf_counter() time of the last event, see ConnectionGuard
+        "last_activity",
+        "sequence",
+        "transfer_id",
+        # The name of the file in the PartialStore, the transfer ID if resumable
+        "partial_name",
+        # (index, count, filesize of the whole file) of a striped upload
+        "stripe",
+        "content_hash",
+        # The content hash of the content received so far, if it is the whole file
+        "content_digest",
+        # The replies not sent yet
+        "outgoing",
+        "watching_output",
+        "writes",
+        # Not watched for input while the writer pool drains the file
+        "paused",
+        # Not watched for input while out of tokens, see RateLimiter
+        "throttled",
+        "rate_buckets",
+        "decompressor",
+        "frame_length",
+        "checksum_algorithm",
+        "checksum",
+        "checksum_start",
+        # The offset the spliced content is hashed up to, see SpliceReceiver
+        "hashed",
+    )
+
+    def __init__(self, client_socket: socket.socket, peer: tuple[str, int]):
+        """
+        Initializes the connection, waiting for the metadata of the first file.
+
+        Args:
+            client_socket: The socket connected to the client.
+            peer: The address of the client.
+        """
+        self.socket = client_socket
+        self.peer = peer
+        self.state = State.RECEIVE_METADATA_LENGTH
+        self.partial = bytearray()
+        self.metadata_length = 0
+        self.legacy_metadata = False
+        self.file: io.FileIO | None = None
+        self.filename: str | None = None
+        self.filesize = 0
+        self.received = 0
+        self.started = 0.0
+        self.metadata_started = self.last_activity = time.perf_counter()
+        self.sequence: int | None = None
+        self.transfer_id: str | None = None
+        self.partial_name: str | None = None
+        self.stripe: tuple[int, int, int] | None = None
+        self.content_hash: str | None = None
+        self.content_digest = None
+        self.outgoing = bytearray()
+        self.watching_output = False
+        self.writes = None
+        self.paused = False
+        self.throttled = False
+        self.rate_buckets = ()
+        self.decompressor = None
+        self.frame_length: int | None = None
+        self.checksum_algorithm: str | None = None
+        self.checksum = None
+        self.checksum_start = 0
+        self.hashed = 0
+
+    def wait_for_next_file(self) -> None:
+        """Resets the state of the received file, waiting for the next pipelined one."""
+        self.state = State.RECEIVE_METADATA_LENGTH
+        self.file = None
+        self.writes = None
+        self.decompressor = None
+        self.metadata_started = time.perf_counter()
@@ -0,0 +1,221 @@
+import logging
+import math
+import resource
+import time
+
+from connection import Connection, State
+from timer_wheel import TimerWheel
+
+# The precision of the timeouts in seconds
+TIMEOUT_TICK = 1.0
+# The file descriptors kept out of the connection cap, for the listening socket,
+# epoll, the journal, the writer pool, the metrics and the stores
+DESCRIPTOR_HEADROOM = 64
+# A connection holds its socket and the file it receives
+DESCRIPTORS_PER_CONNECTION = 2
+# The time accepting is suspended for when the process is out of file descriptors
+ACCEPT_BACKOFF = 0.5
+
+
+class ConnectionGuard:
+    """
+    Protects the epoll engine from clients holding connections without using them:
+    caps the connections in total and per client IP address, and times out
+    the connections that are too slow.
+
+    - The header timeout limits the time to send the metadata of a file.
+    - The idle timeout limits the time without any event on the connection.
+    - The transfer timeout limits the time to send the content of a file.
+
+    The deadlines are kept in a timer wheel. Activity only moves a connection's
+    deadline later, so the event loop just records it, and a connection taken
+    out of the wheel before its actual deadline is scheduled again.
+
+    The total cap is clamped to the file descriptors the process may open, and
+    accepting is suspended for a while if they run out anyway.
+    """
+
+    def __init__(
+        self,
+        max_connections: int,
+        max_connections_per_ip: int,
+        header_timeout: float,
+        idle_timeout: float,
+        transfer_timeout: float,
+    ):
+        """
+        Initializes the guard. A limit of 0 turns the limit off, but for the cap
+        of the file descriptors.
+
+        Args:
+            max_connections: The maximum number of connections.
+            max_connections_per_ip: The maximum number of connections of a client
+                IP address.
+            header_timeout: The header timeout in seconds.
+            idle_timeout: The idle timeout in seconds.
+            transfer_timeout: The transfer timeout in seconds.
+        """
+        self._max_connections = min(
+            max_connections or math.inf, descriptor_connection_cap()
+        )
+        if self._max_connections < (max_connections or math.inf):
+            logging.warning(
+                f"Connections capped at {self._max_connections} "
+                "by the limit of open files"
+            )
+        self._max_connections_per_ip = max_connections_per_ip or math.inf
+        self._header_timeout = header_timeout or math.inf
+        self._idle_timeout = idle_timeout or math.inf
+        self._transfer_timeout = transfer_timeout or math.inf
+        self._connections = 0
+        self._connections_per_ip: dict[str, int] = {}
+        self._timers = (
+            TimerWheel(TIMEOUT_TICK)
+            if header_timeout or idle_timeout or transfer_timeout
+            else None
+        )
+        self._accept_resumes: float | None = None
+
+    def admit(self, connection: Connection, now: float) -> bool:
+        """
+        Counts a new connection and schedules its timeouts, unless it is over a cap.
+
+        Args:
+            connection: The accepted connection.
+            now: The current perf_counter() time.
+
+        Returns:
+            True if the connection is admitted, False if it is to be refused.
+        """
+        ip = connection.peer[0]
+        connections_of_ip = self._connections_per_ip.get(ip, 0)
+        if self._connections >= self._max_connections:
+            logging.warning(f"Refused {connection.peer}: too many connections")
+            return False
+        if connections_of_ip >= self._max_connections_per_ip:
+            logging.warning(
+                f"Refused {connection.peer}: too many connections from {ip}"
+            )
+            return False
+
+        self._connections += 1
+        self._connections_per_ip[ip] = connections_of_ip + 1
+        if self._timers:
+            self._timers.schedule(connection, self._deadline(connection, now))
+        return True
+
+    def release(self, connection: Connection) -> None:
+        """
+        Stops counting a closed connection and cancels its timeouts.
+
+        Args:
+            connection: The connection admitted by admit().
+        """
+        self._connections -= 1
+        ip = connection.peer[0]
+        self._connections_per_ip[ip] -= 1
+        if not self._connections_per_ip[ip]:
+            del self._connections_per_ip[ip]
+        if self._timers:
+            self._timers.cancel(connection)
+
+    def suspend_accepting(self, now: float) -> None:
+        """
+        Suspends accepting for ACCEPT_BACKOFF seconds, after accept() ran out of
+        file descriptors. The caller stops watching the listening socket.
+
+        Args:
+            now: The current perf_counter() time.
+        """
+        self._accept_resumes = now + ACCEPT_BACKOFF
+
+    def resume_accepting(self, now: float) -> bool:
+        """
+        Ends a suspension of accepting that is due.
+
+        Args:
+            now: The current perf_counter() time.
+
+        Returns:
+            True if the caller is to watch the listening socket again.
+        """
+        if self._accept_resumes is None or now < self._accept_resumes:
+            return False
+        self._accept_resumes = None
+        return True
+
+    def time_until_check(self) -> float | None:
+        """
+        Returns the time left until the next check of the timeouts, or the end of
+        a suspension of accepting.
+
+        Returns:
+            The time in seconds, or None if neither is pending.
+        """
+        timeout = self._timers.time_until_next_tick() if self._timers else None
+        if self._accept_resumes is not None:
+            # perf_counter() as the timer wheel's
+            until_resume = max(self._accept_resumes - time.perf_counter(), 0)
+            timeout = until_resume if timeout is None else min(timeout, until_resume)
+        return timeout
+
+    def expired(self, now: float) -> list[Connection]:
+        """
+        Takes the connections past a deadline out of the wheel, and schedules again
+        those whose deadline has moved.
+
+        Args:
+            now: The current perf_counter() time.
+
+        Returns:
+            The timed out connections.
+        """
+        if not self._timers:
+            return []
+
+        expired = []
+        for connection in self._timers.expire(now):
+            if connection.paused or connection.throttled:
+                # Waiting for the writer pool, the sync thread or the rate limiter,
+                # not for the client
+                connection.last_activity = now
+            deadline = self._deadline(connection, now)
+            if deadline <= now:
+                expired.append(connection)
+            elif deadline != math.inf:
+                # Otherwise none of the timeouts left to the connection is on
+                self._timers.schedule(connection, deadline)
+
+        return expired
+
+    def _deadline(self, connection: Connection, now: float) -> float:
+        """
+        Computes the earliest time a connection may time out at. A phase that may
+        start after now, e.g. the next file of a pipelined transfer, starts its
+        timeout no earlier than now.
+        """
+        deadline = connection.last_activity + self._idle_timeout
+        if connection.state <= State.RECEIVE_METADATA_BODY:
+            return min(
+                deadline,
+                connection.metadata_started + self._header_timeout,
+                now + self._transfer_timeout,
+            )
+        if connection.state <= State.RECEIVE_CHECKSUM:
+            deadline = min(deadline, connection.started + self._transfer_timeout)
+            if connection.sequence is not None:
+                deadline = min(deadline, now + self._header_timeout)
+        return deadline
+
+
+def descriptor_connection_cap() -> float:
+    """
+    Returns the number of connections the soft limit of open files leaves room for.
+
+    Returns:
+        The number of connections, inf if the open files are unlimited.
+    """
+    soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit == resource.RLIM_INFINITY:
+        return math.inf
+    return max((soft_limit - DESCRIPTOR_HEADROOM) // DESCRIPTORS_PER_CONNECTION, 1)
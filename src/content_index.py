@@ -0,0 +1,162 @@
+import logging
+import os
+import queue
+import re
+import threading
+import time
+
+import protocol
+from filename_index import FilenameIndex
+from partial_store import COLLECTION_INTERVAL
+
+OBJECTS_DIRECTORY = ".objects"
+CONTENT_HASH_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+
+class ContentIndex:
+    """
+    An index of the stored files by content hash, so a file the server already has
+    is saved as a hard link instead of being transferred again.
+
+    Every indexed file is hard-linked into the .objects subdirectory under its
+    content hash, which makes the index persistent and shared by worker processes.
+    The hash claimed by the client cannot be trusted: a file hashed while it was
+    received is indexed if the digest matches, any other file (e.g. a resumed one)
+    is hashed by a verifier thread before it is indexed, off the event loop thread.
+    Objects whose files were all removed from the storage directory are removed too.
+    Stored files are expected not to be modified in place, as they share the inode.
+    """
+
+    def __init__(self, directory: str):
+        """
+        Initializes the index, creating its directory and starting the verifier thread.
+
+        Args:
+            directory: The directory where the files are saved.
+        """
+        self._storage_directory = directory
+        self._directory = os.path.join(directory, OBJECTS_DIRECTORY)
+        self._next_collection = time.monotonic()
+        self._queue = queue.SimpleQueue()
+        os.makedirs(self._directory, exist_ok=True)
+
+        self._thread = threading.Thread(target=self._run, name="content-index")
+        self._thread.start()
+
+    def link(
+        self,
+        content_hash: str,
+        filesize: int,
+        filename: str,
+        filename_index: FilenameIndex,
+    ) -> str | None:
+        """
+        Saves a file with the given content as a hard link to the stored copy.
+
+        Args:
+            content_hash: The hex digest of the file content (see protocol.content_hash).
+            filesize: The size of the file in bytes.
+            filename: The original filename.
+            filename_index: The index of the filenames in the storage directory.
+
+        Returns:
+            The unique filename the file is saved under, or None if there is no
+            stored copy and the file must be transferred.
+
+        Raises:
+            ValueError: If the content hash is malformed.
+        """
+        if not CONTENT_HASH_PATTERN.fullmatch(content_hash):
+            raise ValueError(f"Invalid content hash: {content_hash!r}")
+
+        path = os.path.join(self._directory, content_hash)
+        try:
+            if os.stat(path).st_size != filesize:
+                return None
+            # Fails if the collection removed the object in the meantime
+            return filename_index.link_unique(path, filename)
+        except FileNotFoundError:
+            return None
+
+    def add(
+        self, content_hash: str, filename: str, digest: object = None
+    ) -> str | None:
+        """
+        Queues a received file to be indexed, if its content matches the hash
+        claimed by the client.
+
+        Args:
+            content_hash: The hex digest claimed by the client.
+            filename: The name the file is saved under.
+            digest: The content digest of the whole file computed while it was
+                received (see protocol.create_content_digest), None to have the
+                verifier thread hash the file.
+
+        Returns:
+            The content hash if the digest verifies it, None otherwise.
+        """
+        if not CONTENT_HASH_PATTERN.fullmatch(content_hash):
+            return None
+        if digest is None:
+            self._queue.put((content_hash, filename, False))
+            return None
+        if digest.hexdigest() != content_hash:
+            logging.warning(f"Content hash mismatch of {filename}, not indexed")
+            return None
+
+        self._queue.put((content_hash, filename, True))
+        return content_hash
+
+    def time_until_collection(self) -> float:
+        """
+        Returns the time left until the next removal of unreferenced objects.
+
+        Returns:
+            The time in seconds.
+        """
+        return max(self._next_collection - time.monotonic(), 0.0)
+
+    def collect_if_due(self) -> None:
+        """Removes the objects no stored file links to anymore, if it is time."""
+        if self.time_until_collection():
+            return
+        self._next_collection = time.monotonic() + COLLECTION_INTERVAL
+
+        with os.scandir(self._directory) as entries:
+            for entry in entries:
+                try:
+                    if "." not in entry.name and entry.stat().st_nlink == 1:
+                        os.remove(entry.path)
+                except OSError:
+                    continue
+
+    def close(self) -> None:
+        """Indexes the queued files and stops the verifier thread."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        """Verifies and indexes the queued files until close() is called."""
+        while (item := self._queue.get()) is not None:
+            self._index(*item)
+
+    def _index(self, content_hash: str, filename: str, verified: bool) -> None:
+        """
+        Hard-links a received file into the index if its content matches the hash,
+        which is only computed if it was not verified while the file was received.
+        """
+        path = os.path.join(self._storage_directory, filename)
+        try:
+            if not verified:
+                with open(path, "rb") as file:
+                    if protocol.content_hash(file) != content_hash:
+                        logging.warning(
+                            f"Content hash mismatch of {filename}, not indexed"
+                        )
+                        return
+
+            os.link(path, os.path.join(self._directory, content_hash))
+        except FileExistsError:
+            pass
+        except OSError as e:
+            logging.error(f"Error indexing {filename}: {e}")
@@ -0,0 +1,410 @@
+import collections
+import concurrent.futures
+import errno
+import io
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Callable
+
+from filename_index import FilenameIndex
+
+# When the received files are synced to disk: "none" leaves it to the OS, "commit"
+# syncs every file before it is acknowledged, "periodic" syncs the files committed
+# since the last sync every FILE_FSYNC_INTERVAL seconds
+FSYNC_POLICIES = ("none", "commit", "periodic")
+
+
+def preallocate(file: io.FileIO, size: int) -> None:
+    """
+    Allocates the extents of a file up front, so it is written without fragmenting
+    and a full disk is detected before the content is received. Falls back to
+    extending the file where posix_fallocate() is unsupported.
+
+    Args:
+        file: The file opened for writing.
+        size: The size of the file in bytes.
+
+    Raises:
+        OSError: If the disk has no room for the file.
+    """
+    if not size:
+        return
+    try:
+        os.posix_fallocate(file.fileno(), 0, size)
+    except AttributeError:
+        pass
+    except OSError as e:
+        if e.errno in (errno.ENOSPC, errno.EFBIG):
+            raise
+    else:
+        return
+
+    if os.fstat(file.fileno()).st_size < size:
+        os.truncate(file.fileno(), size)
+
+
+class QueuedFile:
+    """
+    A file written by the writer pool: the event loop queues the received buffers,
+    and a writer thread drains them in order.
+    """
+
+    def __init__(self, pool: "WriterPool", file: io.FileIO, descriptor_no: int):
+        """
+        Initializes the queue of the file.
+
+        Args:
+            pool: The writer pool draining the queue.
+            file: The file opened for unbuffered writing.
+            descriptor_no: The file descriptor number of the connection.
+        """
+        self.file = file
+        self.descriptor_no = descriptor_no
+        self.pending = 0
+        self.error: OSError | None = None
+
+        self._pool = pool
+        self._buffers: collections.deque[memoryview] = collections.deque()
+        self._scheduled = False
+        self._waiting = False
+        self._close_callback: Callable[[], None] | None = None
+
+    @property
+    def over_high_water(self) -> bool:
+        """Whether the queue holds enough bytes for the socket to stop being read."""
+        return self.pending >= self._pool.high_water
+
+    def write(self, buffer: memoryview) -> None:
+        """
+        Queues a buffer to be written. The buffer must not be reused by the caller.
+
+        Args:
+            buffer: The data to write.
+        """
+        with self._pool.lock:
+            self._buffers.append(buffer)
+            self.pending += len(buffer)
+            self._schedule()
+
+    def notify_when_drained(self) -> bool:
+        """
+        Asks the pool to report the file by WriterPool.drained() once all the queued
+        buffers are written.
+
+        Returns:
+            True if the queue is already drained, and nothing will be reported.
+        """
+        with self._pool.lock:
+            if not self._scheduled:
+                return True
+            self._waiting = True
+            return False
+
+    def close(self, callback: Callable[[], None] = None) -> None:
+        """
+        Closes the file once all the queued buffers are written.
+
+        Args:
+            callback: The function called after the file is closed, from a writer
+                thread (optional).
+        """
+        with self._pool.lock:
+            self._close_callback = callback or (lambda: None)
+            self._schedule()
+
+    def _schedule(self) -> None:
+        """Hands the queue to a writer thread, unless one is draining it already."""
+        if not self._scheduled:
+            self._scheduled = True
+            self._pool.submit(self._drain)
+
+    def _drain(self) -> None:
+        """Writes the queued buffers, closing the file afterwards if requested."""
+        while True:
+            with self._pool.lock:
+                if not self._buffers:
+                    self._scheduled = False
+                    waiting, self._waiting = self._waiting, False
+                    close_callback = self._close_callback
+                    break
+                buffer = self._buffers.popleft()
+
+            size = len(buffer)
+            try:
+                # A failed file is drained without writing, the loop aborts it
+                while buffer and not self.error:
+                    buffer = buffer[self.file.write(buffer) :]
+            except OSError as e:
+                self.error = e
+
+            with self._pool.lock:
+                self.pending -= size
+
+        if close_callback:
+            try:
+                self.file.close()
+                close_callback()
+            except Exception as e:
+                logging.error(f"Error closing {self.file.name}: {e}")
+        elif waiting:
+            self._pool.notify(self)
+
+
+class WriterPool:
+    """
+    A bounded pool of threads writing the received files, so a slow disk never
+    stalls the event loop.
+
+    The event loop stops reading a socket while the queue of its file is over the
+    high-water mark, and resumes once the pool reports the queue as drained through
+    a wake-up pipe watched by epoll.
+    """
+
+    def __init__(self, threads: int, high_water: int):
+        """
+        Initializes the pool and creates its wake-up pipe.
+
+        Args:
+            threads: The number of writer threads.
+            high_water: The number of queued bytes per file over which
+                the socket stops being read.
+        """
+        self.high_water = high_water
+        self.lock = threading.Lock()
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(threads, "writer")
+        self._drained: queue.SimpleQueue[QueuedFile] = queue.SimpleQueue()
+        self._wake_read, self._wake_write = os.pipe()
+        os.set_blocking(self._wake_read, False)
+        os.set_blocking(self._wake_write, False)
+
+    def fileno(self) -> int:
+        """
+        Returns the file descriptor that becomes readable when files are drained.
+
+        Returns:
+            The read end of the wake-up pipe.
+        """
+        return self._wake_read
+
+    def open(self, file: io.FileIO, descriptor_no: int) -> QueuedFile:
+        """
+        Starts writing a file through the pool.
+
+        Args:
+            file: The file opened for unbuffered writing.
+            descriptor_no: The file descriptor number of the connection.
+
+        Returns:
+            The queue of the file.
+        """
+        return QueuedFile(self, file, descriptor_no)
+
+    def submit(self, function: Callable[[], None]) -> None:
+        """Runs a function on a writer thread."""
+        self._executor.submit(function)
+
+    def notify(self, queued_file: QueuedFile) -> None:
+        """Reports a drained file to the event loop, from a writer thread."""
+        self._drained.put(queued_file)
+        try:
+            os.write(self._wake_write, b"\0")
+        except BlockingIOError:
+            pass  # the pipe is full, so the loop is going to wake up anyway
+
+    def drained(self) -> list[QueuedFile]:
+        """
+        Returns the files drained since the last call, see QueuedFile.notify_when_drained().
+
+        Returns:
+            The drained files.
+        """
+        try:
+            while os.read(self._wake_read, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        drained = []
+        while not self._drained.empty():
+            drained.append(self._drained.get())
+        return drained
+
+    def close(self) -> None:
+        """Waits for the queued writes and stops the writer threads."""
+        self._executor.shutdown()
+        os.close(self._wake_read)
+        os.close(self._wake_write)
+
+
+class FileSync:
+    """
+    Moves the received files into the storage directory, atomically and as durably
+    as the fsync policy asks (see FSYNC_POLICIES). A file is synced before it is
+    renamed, and the directory after, so a crash never leaves a committed name
+    without its content.
+
+    The commits of the "commit" policy wait for the disk, so the epoll engine runs
+    them on a sync thread with commit_later(), which reports them to the event loop
+    through a wake-up pipe watched by epoll, like the WriterPool.
+    """
+
+    def __init__(self, directory: str, policy: str, interval: float):
+        """
+        Initializes the committer.
+
+        Args:
+            directory: The storage directory.
+            policy: The fsync policy, one of FSYNC_POLICIES.
+            interval: The time in seconds between the syncs of the periodic policy.
+
+        Raises:
+            ValueError: If the fsync policy is unknown.
+        """
+        if policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {policy}")
+
+        self._directory = directory
+        self._policy = policy
+        self._interval = interval
+        self._pending: list[str] = []
+        self._next_sync = time.monotonic() + interval
+
+        self.deferred = policy == "commit"
+        self._executor: concurrent.futures.ThreadPoolExecutor | None = None
+        self._committed: queue.SimpleQueue[tuple] = queue.SimpleQueue()
+        self._wake_read = self._wake_write = None
+        if self.deferred:
+            self._executor = concurrent.futures.ThreadPoolExecutor(1, "file-sync")
+            self._wake_read, self._wake_write = os.pipe()
+            os.set_blocking(self._wake_read, False)
+            os.set_blocking(self._wake_write, False)
+
+    def fileno(self) -> int | None:
+        """
+        Returns the file descriptor that becomes readable when files are committed
+        by the sync thread.
+
+        Returns:
+            The read end of the wake-up pipe, None if the commits are not deferred.
+        """
+        return self._wake_read
+
+    def commit(self, path: str, filename: str, filename_index: FilenameIndex) -> str:
+        """
+        Moves a completely received file to the storage directory under a unique name,
+        by linking it there and removing the received path, so the name never
+        appears with an incomplete or empty file.
+
+        Args:
+            path: The path of the received file, on the storage directory's filesystem.
+            filename: The original filename.
+            filename_index: The index of the filenames in the storage directory.
+
+        Returns:
+            The unique filename the file is saved under.
+        """
+        if self._policy == "commit":
+            sync_file(path)
+
+        filename = filename_index.link_unique(path, filename)
+        os.remove(path)
+
+        if self._policy == "commit":
+            sync_file(self._directory)
+        elif self._policy == "periodic":
+            self._pending.append(filename)
+        return filename
+
+    def commit_later(self, commit: Callable[[], str | None], owner: object) -> None:
+        """
+        Runs a commit on the sync thread, and reports it by committed() once done.
+
+        Args:
+            commit: The function committing the file, returning its saved filename.
+            owner: The object reported along with the result, e.g. the connection.
+        """
+
+        def run() -> None:
+            filename = error = None
+            try:
+                filename = commit()
+            except Exception as e:
+                error = e
+            self._committed.put((owner, filename, error))
+            try:
+                os.write(self._wake_write, b"\0")
+            except BlockingIOError:
+                pass  # the pipe is full, so the loop is going to wake up anyway
+
+        self._executor.submit(run)
+
+    def committed(self) -> list[tuple[object, str | None, Exception | None]]:
+        """
+        Returns the commits done by the sync thread since the last call.
+
+        Returns:
+            The owner, the saved filename and the error, None if the commit
+            succeeded, of every commit.
+        """
+        try:
+            while os.read(self._wake_read, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        committed = []
+        while not self._committed.empty():
+            committed.append(self._committed.get())
+        return committed
+
+    def close(self) -> None:
+        """Waits for the deferred commits and stops the sync thread."""
+        if self.deferred:
+            self._executor.shutdown()
+            os.close(self._wake_read)
+            os.close(self._wake_write)
+
+    def time_until_sync(self) -> float | None:
+        """
+        Returns the time left until the next periodic sync.
+
+        Returns:
+            The time in seconds, or None if no files are waiting to be synced.
+        """
+        if not self._pending:
+            return None
+        return max(self._next_sync - time.monotonic(), 0.0)
+
+    def sync_if_due(self) -> None:
+        """Syncs the files committed since the last sync, if it is time."""
+        if not self._pending or self.time_until_sync():
+            return
+        self._next_sync = time.monotonic() + self._interval
+
+        paths = [os.path.join(self._directory, filename) for filename in self._pending]
+        self._pending = []
+        for path in paths + [self._directory]:
+            try:
+                sync_file(path)
+            except FileNotFoundError:
+                continue  # removed in the meantime
+            except OSError as e:
+                logging.error(f"Error syncing {path}: {e}")
+
+
+def sync_file(path: str) -> None:
+    """
+    Flushes the content of a file, or the entries of a directory, to disk.
+
+    Args:
+        path: The path of the file or directory.
+    """
+    file_descriptor = os.open(path, os.O_RDONLY)
+    try:
+        os.fdatasync(file_descriptor)
+    finally:
+        os.close(file_descriptor)
@@ -0,0 +1,92 @@
+import logging
+import os
+import re
+import threading
+
+SUFFIX_PATTERN = re.compile(r"(.*) \((\d+)\)")
+
+
+class FilenameIndex:
+    """
+    An in-memory index of the filenames in the storage directory.
+
+    Maps every base name and extension to the next free "name (N).ext" suffix,
+    so a unique filename is found in O(1) instead of scanning the directory.
+    Files are linked under a lock, as the files committed off the event loop
+    are linked from another thread.
+    """
+
+    def __init__(self, directory: str):
+        """
+        Initializes the index with the files already present in the directory.
+
+        Args:
+            directory: The directory where the files are saved.
+        """
+        self._directory = directory
+        self._names: set[str] = set()
+        self._next_suffixes: dict[tuple[str, str], int] = {}
+        self._lock = threading.Lock()
+
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                self.add(entry.name)
+
+        logging.info(f"Indexed {len(self._names)} files in {directory}")
+
+    def add(self, filename: str) -> None:
+        """
+        Marks the filename as taken.
+
+        Args:
+            filename: The filename present in the directory.
+        """
+        self._names.add(filename)
+
+        name, ext = os.path.splitext(filename)
+        match = SUFFIX_PATTERN.fullmatch(name)
+        if match:
+            key = match[1], ext
+            number = int(match[2]) + 1
+            self._next_suffixes[key] = max(self._next_suffixes.get(key, 1), number)
+
+    def link_unique(self, path: str, filename: str) -> str:
+        """
+        Hard-links a file into the directory under a unique name, appending a number
+        to the filename if a file with the same name already exists.
+
+        link() fails if the name exists, like O_EXCL, so a name is never handed out
+        twice, even when other processes save files into the same directory at the
+        same time, and the name only ever appears with the complete file.
+
+        Args:
+            path: The path of the file, on the directory's filesystem.
+            filename: The original filename.
+
+        Returns:
+            The unique filename the file is linked under.
+
+        Raises:
+            FileNotFoundError: If the file does not exist.
+        """
+        with self._lock:
+            return self._link_unique(path, filename)
+
+    def _link_unique(self, path: str, filename: str) -> str:
+        """Hard-links a file under a unique name, see link_unique()."""
+        name, ext = os.path.splitext(filename)
+        unique_filename = filename
+        while True:
+            if unique_filename not in self._names:
+                try:
+                    os.link(path, os.path.join(self._directory, unique_filename))
+                except FileExistsError:
+                    pass  # created behind the index's back, e.g. by another worker
+                else:
+                    self.add(unique_filename)
+                    return unique_filename
+
+                self.add(unique_filename)
+
+            number = self._next_suffixes.get((name, ext), 1)
+            unique_filename = f"{name} ({number}){ext}"
@@ -0,0 +1,505 @@
+from __future__ import annotations
+
+import collections
+import enum
+import logging
+import os
+import threading
+import time
+from typing import Iterator
+
+import tqdm
+from PyQt6.QtCore import (
+    QAbstractTableModel,
+    QModelIndex,
+    QObject,
+    Qt,
+    QTimer,
+    pyqtSignal,
+)
+from PyQt6.QtGui import QPainter
+from PyQt6.QtWidgets import (
+    QApplication,
+    QStyle,
+    QStyledItemDelegate,
+    QStyleOptionProgressBar,
+    QStyleOptionViewItem,
+)
+
+import client_cli
+from transfer_progress import PROGRESS_INTERVAL, TransferProgress
+
+# The weight of the latest sample in the throughputs shown
+THROUGHPUT_SMOOTHING = 0.3
+# Files up to this size are pipelined on the connection of a worker, larger ones
+# are sent on a connection of their own, resumable and deduplicated
+PIPELINE_MAX_SIZE = 2**20
+# The time a pipelined connection waits for more small files, e.g. of a directory
+# still being expanded, before it is closed
+PIPELINE_IDLE = 1.0
+
+
+class ItemState(enum.IntEnum):
+    """The states of a queued file, in the order they are passed."""
+
+    QUEUED = 0
+    SENDING = 1
+    SENT = 2
+    FAILED = 3
+    CANCELED = 4
+
+
+class TransferItem:
+    """A file in the transfer queue, with the server it is sent to."""
+
+    __slots__ = ("path", "host", "port", "size", "state", "progress", "error")
+
+    def __init__(self, path: str, host: str, port: int, size: int):
+        """
+        Initializes the item, queued.
+
+        Args:
+            path: The path of the file.
+            host: The IP address of the server.
+            port: The port number of the server.
+            size: The size of the file in bytes.
+        """
+        self.path = path
+        self.host = host
+        self.port = port
+        self.size = size
+        self.state = ItemState.QUEUED
+        self.progress = TransferProgress(size)
+        self.error = ""
+
+
+class TransferQueue:
+    """
+    The files queued by the GUI, and a pool of worker threads sending them. A large
+    file is sent over a connection of its own with client_cli.send_file(), so it is
+    resumed and deduplicated. Small files are sent back to back over one pipelined
+    connection per worker with client_cli.send_files(), kept open while small files
+    for the same server are queued, so they cost no connection setup or round trip
+    each. Either way, every file is acknowledged and canceled on its own.
+
+    The workers only change the states and progress counters of the items; the
+    GUI samples them with a timer (see TransferQueueModel), so no signal is
+    emitted per file or chunk, however many files are queued.
+    """
+
+    def __init__(self, workers: int):
+        """
+        Initializes the queue and starts the worker threads.
+
+        Args:
+            workers: The number of files sent concurrently.
+        """
+        # Appended to by add(), replaced by clear_finished() in the GUI thread, which
+        # reads it unlocked
+        self.items: list[TransferItem] = []
+        self._pending: collections.deque[TransferItem] = collections.deque()
+        self._condition = threading.Condition()
+        self._workers = 0
+        self._threads = 0
+        self._closed = False
+        self.set_workers(workers)
+
+    def set_workers(self, workers: int) -> None:
+        """
+        Changes the number of files sent concurrently. Surplus workers stop once
+        their current file is sent.
+
+        Args:
+            workers: The number of worker threads.
+        """
+        with self._condition:
+            self._workers = workers
+            while self._threads < workers:
+                self._threads += 1
+                threading.Thread(target=self._work, name="sender", daemon=True).start()
+            self._condition.notify_all()
+
+    def add(self, paths: list[str], host: str, port: int) -> None:
+        """
+        Queues files, directories and glob patterns to be sent. They are expanded
+        in a thread of their own, so a large directory does not block the GUI.
+
+        Args:
+            paths: The paths of files or directories, or glob patterns.
+            host: The IP address of the server.
+            port: The port number of the server.
+        """
+        threading.Thread(
+            target=self._expand, args=(paths, host, port), daemon=True
+        ).start()
+
+    def cancel(self, item: TransferItem) -> None:
+        """
+        Cancels a queued file, or stops sending it before its next chunk.
+
+        Args:
+            item: The item to cancel.
+        """
+        with self._condition:
+            if item.state == ItemState.QUEUED:
+                item.state = ItemState.CANCELED
+            elif item.state == ItemState.SENDING:
+                item.progress.cancel()
+
+    def retry(self, item: TransferItem) -> None:
+        """
+        Queues a failed or canceled file again; the server resumes it from the bytes
+        it already has.
+
+        Args:
+            item: The item to retry.
+        """
+        with self._condition:
+            if item.state not in (ItemState.FAILED, ItemState.CANCELED):
+                return
+            item.state = ItemState.QUEUED
+            item.progress = TransferProgress(item.size)
+            item.error = ""
+            self._pending.append(item)
+            self._condition.notify()
+
+    def clear_finished(self) -> None:
+        """Removes the sent, failed and canceled files from the queue."""
+        with self._condition:
+            self.items = [
+                item
+                for item in self.items
+                if item.state in (ItemState.QUEUED, ItemState.SENDING)
+            ]
+
+    def close(self) -> None:
+        """Cancels all the files and stops the worker threads."""
+        with self._condition:
+            self._closed = True
+            self._workers = 0
+            for item in self.items:
+                if item.state == ItemState.QUEUED:
+                    item.state = ItemState.CANCELED
+                elif item.state == ItemState.SENDING:
+                    item.progress.cancel()
+            self._pending.clear()
+            self._condition.notify_all()
+
+    def _expand(self, paths: list[str], host: str, port: int) -> None:
+        """Queues the files the paths expand to, see add()."""
+        for path in client_cli.iter_file_paths(paths):
+            try:
+                item = TransferItem(path, host, port, os.path.getsize(path))
+            except OSError as e:
+                item = TransferItem(path, host, port, 0)
+                item.state = ItemState.FAILED
+                item.error = e.strerror
+
+            with self._condition:
+                if self._closed:
+                    return
+                self.items.append(item)
+                if item.state == ItemState.QUEUED:
+                    self._pending.append(item)
+                    self._condition.notify()
+
+    def _work(self) -> None:
+        """Sends the queued files until the worker is surplus, see set_workers()."""
+        while True:
+            with self._condition:
+                while not self._pending and self._threads <= self._workers:
+                    self._condition.wait()
+                if self._threads > self._workers:
+                    self._threads -= 1
+                    return
+                item = self._pending.popleft()
+                # Canceled while queued, or queued twice by a retry
+                if item.state != ItemState.QUEUED:
+                    continue
+                item.state = ItemState.SENDING
+
+            if item.size <= PIPELINE_MAX_SIZE:
+                self._send_pipelined(item)
+            else:
+                self._send(item)
+
+    def _send(self, item: TransferItem) -> None:
+        """Sends the file of an item, leaving it sent, failed or canceled."""
+        try:
+            sent = client_cli.send_file(item.path, item.host, item.port, item.progress)
+        except Exception as e:
+            logging.error(f"Failed to send {item.path}: {e}")
+            with self._condition:
+                item.error = str(e)
+                item.state = ItemState.FAILED
+            return
+
+        with self._condition:
+            item.state = ItemState.SENT if sent else ItemState.CANCELED
+
+    def _send_pipelined(self, first: TransferItem) -> None:
+        """
+        Sends the file of a small item, then the small files queued after it for
+        the same server, over one pipelined connection. Every item is left sent,
+        failed or canceled as soon as its reply arrives.
+        """
+        batch = {first.path: first}
+
+        def paths() -> Iterator[str]:
+            yield first.path
+            while item := self._next_pipelined(first, batch):
+                batch[item.path] = item
+                yield item.path
+
+        def finish(path: str, error: str | None) -> None:
+            item = batch[path]
+            with self._condition:
+                if error is None:
+                    item.state = ItemState.SENT
+                elif item.progress.cancelled.is_set():
+                    item.state = ItemState.CANCELED
+                else:
+                    logging.error(f"Failed to send {path}: {error}")
+                    item.error = error
+                    item.state = ItemState.FAILED
+
+        try:
+            client_cli.send_files(
+                paths(),
+                first.host,
+                first.port,
+                file_progress=lambda path: batch[path].progress,
+                on_result=finish,
+            )
+        except Exception as e:
+            logging.error(f"Failed to send files to {first.host}:{first.port}: {e}")
+            with self._condition:
+                for item in batch.values():
+                    if item.state == ItemState.SENDING:
+                        item.error = str(e)
+                        item.state = ItemState.FAILED
+
+    def _next_pipelined(
+        self, first: TransferItem, batch: dict[str, TransferItem]
+    ) -> TransferItem | None:
+        """
+        Takes the next queued item to pipeline after the first one of a batch, if it
+        is a small file for the same server, waiting up to PIPELINE_IDLE seconds for
+        one to be queued.
+
+        Returns:
+            The item, sending, or None to close the connection.
+        """
+        deadline = time.monotonic() + PIPELINE_IDLE
+        with self._condition:
+            while self._threads <= self._workers:
+                # Canceled while queued, or queued twice by a retry
+                while self._pending and self._pending[0].state != ItemState.QUEUED:
+                    self._pending.popleft()
+                if self._pending:
+                    item = self._pending[0]
+                    if (
+                        item.size > PIPELINE_MAX_SIZE
+                        or (item.host, item.port) != (first.host, first.port)
+                        # Replies are told apart by path
+                        or item.path in batch
+                    ):
+                        return None
+                    self._pending.popleft()
+                    item.state = ItemState.SENDING
+                    return item
+
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    return None
+                self._condition.wait(timeout)
+
+        return None
+
+
+class ThroughputMeter:
+    """The smoothed throughput of a byte count sampled at intervals."""
+
+    __slots__ = ("rate", "_sent", "_time")
+
+    def __init__(self):
+        """Initializes the meter, with nothing sampled."""
+        self.rate = 0.0
+        self._sent: int | None = None
+        self._time = 0.0
+
+    def sample(self, sent: int, now: float) -> float:
+        """
+        Updates the throughput with a sample of the byte count.
+
+        Args:
+            sent: The number of bytes sent so far.
+            now: The monotonic() time of the sample.
+
+        Returns:
+            The throughput in bytes per second.
+        """
+        if self._sent is not None and now > self._time:
+            rate = max(sent - self._sent, 0) / (now - self._time)
+            self.rate = (
+                rate
+                if not self.rate
+                else self.rate + THROUGHPUT_SMOOTHING * (rate - self.rate)
+            )
+        self._sent = sent
+        self._time = now
+        return self.rate
+
+
+class TransferQueueModel(QAbstractTableModel):
+    """
+    A table model of a TransferQueue, with a row per file. A timer samples the
+    queue every PROGRESS_INTERVAL seconds, inserting the rows of the files queued
+    in the meantime and refreshing the visible rows, and emits a summary with the
+    aggregate throughput and ETA.
+    """
+
+    COLUMNS = ("File", "Size", "Progress", "Status")
+    PROGRESS_COLUMN = 2
+
+    summary_change = pyqtSignal(str)
+
+    def __init__(self, queue: TransferQueue, parent: QObject = None):
+        """
+        Initializes the model and starts sampling the queue.
+
+        Args:
+            queue: The queue to show.
+            parent: The parent object (optional).
+        """
+        super().__init__(parent)
+
+        self._queue = queue
+        self._rows = 0
+        self._counts: collections.Counter[ItemState] = collections.Counter()
+        self._meters: dict[TransferItem, ThroughputMeter] = {}
+
+        self._timer = QTimer(self)
+        self._timer.setInterval(int(PROGRESS_INTERVAL * 1000))
+        self._timer.timeout.connect(self._sample)
+        self._timer.start()
+
+    def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        return 0 if parent.isValid() else self._rows
+
+    def columnCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.COLUMNS)
+
+    def headerData(
+        self,
+        section: int,
+        orientation: Qt.Orientation,
+        role: int = Qt.ItemDataRole.DisplayRole,
+    ) -> object:
+        if (
+            orientation == Qt.Orientation.Horizontal
+            and role == Qt.ItemDataRole.DisplayRole
+        ):
+            return self.COLUMNS[section]
+        return None
+
+    def data(self, index: QModelIndex, role: int = Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+
+        item = self._queue.items[index.row()]
+        column = index.column()
+        if role == Qt.ItemDataRole.ToolTipRole:
+            return item.error or item.path
+        if role != Qt.ItemDataRole.DisplayRole:
+            return None
+
+        if column == 0:
+            return item.path
+        if column == 1:
+            return tqdm.tqdm.format_sizeof(item.size, "B", 1024)
+        if column == self.PROGRESS_COLUMN:
+            if item.state == ItemState.SENT or not item.size:
+                return 100 if item.state == ItemState.SENT else 0
+            return min(item.progress.sent * 100 // item.size, 100)
+        return self._status(item)
+
+    def item(self, row: int) -> TransferItem:
+        """Returns the item shown in a row."""
+        return self._queue.items[row]
+
+    def clear_finished(self) -> None:
+        """Removes the rows of the sent, failed and canceled files."""
+        self.beginResetModel()
+        self._queue.clear_finished()
+        self._rows = len(self._queue.items)
+        self.endResetModel()
+
+    def _status(self, item: TransferItem) -> str:
+        """Returns the status text of an item."""
+        if item.state == ItemState.SENDING:
+            meter = self._meters.get(item)
+            rate = meter.rate if meter else 0.0
+            return f"Sending, {tqdm.tqdm.format_sizeof(rate, 'B/s', 1024)}"
+        if item.state == ItemState.FAILED:
+            return f"Failed: {item.error}"
+        return item.state.name.capitalize()
+
+    def _sample(self) -> None:
+        """Syncs the rows with the queue, and emits the summary."""
+        items = self._queue.items
+        if len(items) > self._rows:
+            self.beginInsertRows(QModelIndex(), self._rows, len(items) - 1)
+            self._rows = len(items)
+            self.endInsertRows()
+
+        now = time.monotonic()
+        counts = collections.Counter()
+        meters = {}
+        throughput = 0.0
+        left = 0
+        for item in items[: self._rows]:
+            counts[item.state] += 1
+            if item.state == ItemState.SENDING:
+                meter = meters[item] = self._meters.get(item) or ThroughputMeter()
+                throughput += meter.sample(item.progress.sent, now)
+                left += max(item.size - item.progress.sent, 0)
+            elif item.state == ItemState.QUEUED:
+                left += item.size
+        self._meters = meters
+
+        # Only the visible rows are repainted
+        if self._rows and (counts != self._counts or meters):
+            self.dataChanged.emit(
+                self.index(0, 0), self.index(self._rows - 1, len(self.COLUMNS) - 1)
+            )
+        self._counts = counts
+
+        summary = ", ".join(
+            f"{counts[state]} {state.name.lower()}" for state in ItemState
+        )
+        if meters:
+            eta = tqdm.tqdm.format_interval(left / throughput) if throughput else "?"
+            summary += (
+                f" | {tqdm.tqdm.format_sizeof(throughput, 'B/s', 1024)}, {eta} left"
+            )
+        self.summary_change.emit(summary)
+
+
+class ProgressDelegate(QStyledItemDelegate):
+    """Paints the progress column as progress bars, without a widget per row."""
+
+    def paint(
+        self, painter: QPainter, option: QStyleOptionViewItem, index: QModelIndex
+    ) -> None:
+        bar = QStyleOptionProgressBar()
+        bar.rect = option.rect.adjusted(2, 2, -2, -2)
+        bar.state = QStyle.StateFlag.State_Enabled | QStyle.StateFlag.State_Horizontal
+        bar.minimum = 0
+        bar.maximum = 100
+        bar.progress = index.data()
+        bar.text = f"{bar.progress}%"
+        bar.textVisible = True
+        QApplication.style().drawControl(
+            QStyle.ControlElement.CE_ProgressBar, bar, painter
+        )
@@ -0,0 +1,245 @@
+import bisect
+import logging
+import socket
+
+import select
+
+from connection import Connection
+
+# Requests larger than this are not metrics scrapes
+MAX_REQUEST_SIZE = 8192
+
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+LOOP_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+SIZE_BUCKETS = tuple(2**exponent for exponent in range(10, 34, 2))
+
+
+class Histogram:
+    """A Prometheus histogram: observation counts per upper bound, sum and count."""
+
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: tuple[float, ...]):
+        """
+        Initializes the histogram.
+
+        Args:
+            bounds: The upper bounds of the buckets, in ascending order.
+        """
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        """Counts a value in the first bucket whose bound is not less than it."""
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def render(self, name: str, description: str) -> list[str]:
+        """Returns the lines of the histogram in the Prometheus text format."""
+        lines = [f"# HELP {name} {description}", f"# TYPE {name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.bounds + ("+Inf",), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+        lines += [f"{name}_sum {self.sum}", f"{name}_count {cumulative}"]
+        return lines
+
+
+class Metrics:
+    """
+    The metrics of the epoll engine, updated by the event loop as plain
+    attributes, so an update costs an addition. The event loop passes None
+    instead when the metrics are off, and skips every update.
+    """
+
+    def __init__(self):
+        self.connections_total = 0
+        self.connections_refused_total = 0
+        self.connections_timed_out_total = 0
+        self.bytes_received_total = 0
+        self.files_received_total = 0
+        self.files_failed_total = 0
+        self.metadata_seconds = Histogram(DURATION_BUCKETS)
+        self.transfer_seconds = Histogram(DURATION_BUCKETS)
+        self.file_size_bytes = Histogram(SIZE_BUCKETS)
+        self.poll_batch_size = Histogram(BATCH_BUCKETS)
+        self.loop_iteration_seconds = Histogram(LOOP_BUCKETS)
+
+    def render(self, connections: dict[int, Connection]) -> str:
+        """
+        Renders the metrics in the Prometheus text format.
+
+        Args:
+            connections: The active connections, counted by state at render time.
+
+        Returns:
+            The exposition text.
+        """
+        states = {}
+        for connection in connections.values():
+            states[connection.state.name] = states.get(connection.state.name, 0) + 1
+
+        lines = []
+        for name, description in (
+            ("connections_total", "Accepted connections."),
+            ("connections_refused_total", "Connections reset for being over a cap."),
+            ("connections_timed_out_total", "Connections closed by a timeout."),
+            ("bytes_received_total", "Payload bytes received, after decompression."),
+            ("files_received_total", "Files received completely."),
+            ("files_failed_total", "Files whose reception was aborted or rejected."),
+        ):
+            lines += [
+                f"# HELP server_{name} {description}",
+                f"# TYPE server_{name} counter",
+                f"server_{name} {getattr(self, name)}",
+            ]
+
+        lines += [
+            "# HELP server_connections Active connections by state.",
+            "# TYPE server_connections gauge",
+        ]
+        lines += [
+            f'server_connections{{state="{state}"}} {count}'
+            for state, count in sorted(states.items())
+        ]
+
+        for name, description in (
+            ("metadata_seconds", "Time until the metadata of a file is received."),
+            ("transfer_seconds", "Time from the metadata to the end of the content."),
+            ("file_size_bytes", "Sizes of the received files."),
+            ("poll_batch_size", "Events returned by a single epoll.poll()."),
+            ("loop_iteration_seconds", "Time spent handling the events of a poll."),
+        ):
+            lines += getattr(self, name).render(f"server_{name}", description)
+
+        return "\n".join(lines) + "\n"
+
+
+class MetricsEndpoint:
+    """
+    A minimal HTTP endpoint serving GET /metrics, handled by the event loop like
+    the client connections, so the metrics are read without locking.
+    """
+
+    def __init__(self, metrics: Metrics, host: str, port: int, epoll: select.epoll):
+        """
+        Starts listening and registers the socket with epoll.
+
+        Args:
+            metrics: The metrics to serve.
+            host: The host address to bind the endpoint to.
+            port: The port number to bind the endpoint to.
+            epoll: The epoll object of the event loop.
+        """
+        self.metrics = metrics
+        self._epoll = epoll
+        self._server_socket = socket.create_server((host, port))
+        self._server_socket.setblocking(False)
+        # The socket, the received request and the unsent response of every scrape
+        self._requests: dict[int, tuple[socket.socket, bytearray, bytearray]] = {}
+        epoll.register(self._server_socket.fileno(), select.EPOLLIN)
+        logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+    def owns(self, descriptor_no: int) -> bool:
+        """Checks whether an event belongs to the endpoint."""
+        return (
+            descriptor_no == self._server_socket.fileno()
+            or descriptor_no in self._requests
+        )
+
+    def handle_event(
+        self, descriptor_no: int, connections: dict[int, Connection]
+    ) -> None:
+        """
+        Accepts a scraper, receives its request, or sends the rest of its reply.
+
+        Args:
+            descriptor_no: The file descriptor number of the event.
+            connections: The active connections, for the state gauges.
+        """
+        if descriptor_no == self._server_socket.fileno():
+            try:
+                client_socket, _ = self._server_socket.accept()
+            except BlockingIOError:
+                return
+            client_socket.setblocking(False)
+            self._epoll.register(client_socket.fileno(), select.EPOLLIN)
+            self._requests[client_socket.fileno()] = (
+                client_socket,
+                bytearray(),
+                bytearray(),
+            )
+            return
+
+        client_socket, request, response = self._requests[descriptor_no]
+        try:
+            if not response:
+                chunk = client_socket.recv(MAX_REQUEST_SIZE)
+                request += chunk
+                if chunk and b"\r\n\r\n" not in request:
+                    if len(request) < MAX_REQUEST_SIZE:
+                        return
+                elif chunk:
+                    response += self._reply(request, connections)
+                    self._send(descriptor_no, client_socket, response)
+                    return
+            else:
+                self._send(descriptor_no, client_socket, response)
+                return
+        except BlockingIOError:
+            return
+        except OSError as e:
+            logging.warning(f"Error serving metrics: {e}")
+
+        self._close(descriptor_no)
+
+    def _reply(self, request: bytearray, connections: dict[int, Connection]) -> bytes:
+        """Returns the response with the metrics, or 404 for any other request."""
+        if request.startswith((b"GET /metrics ", b"GET /metrics?")):
+            status = "200 OK"
+            body = self.metrics.render(connections).encode()
+        else:
+            status = "404 Not Found"
+            body = b"Not found\n"
+
+        return (
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode() + body
+        )
+
+    def _send(
+        self, descriptor_no: int, client_socket: socket.socket, response: bytearray
+    ) -> None:
+        """
+        Sends as much of the response as the socket accepts without blocking, like
+        server.send_replies(), watching the socket for EPOLLOUT while some is left,
+        and closes it once all is sent.
+
+        Raises:
+            OSError: If the scraper closed the connection in the middle.
+        """
+        try:
+            del response[: client_socket.send(response)]
+        except BlockingIOError:
+            pass
+
+        if response:
+            self._epoll.modify(descriptor_no, select.EPOLLOUT)
+        else:
+            self._close(descriptor_no)
+
+    def _close(self, descriptor_no: int) -> None:
+        """Closes the connection of a scraper."""
+        client_socket, _, _ = self._requests.pop(descriptor_no)
+        self._epoll.unregister(descriptor_no)
+        client_socket.close()
+
+    def close(self) -> None:
+        """Closes the endpoint and the pending scrapes."""
+        for client_socket, _, _ in self._requests.values():
+            client_socket.close()
+        self._server_socket.close()
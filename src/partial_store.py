@@ -0,0 +1,213 @@
+import fcntl
+import io
+import json
+import logging
+import os
+import re
+import secrets
+import time
+
+from disk_writer import FileSync, preallocate
+from filename_index import FilenameIndex
+
+PARTIAL_DIRECTORY = ".partial"
+TRANSFER_ID_PATTERN = re.compile(r"[0-9a-f]{1,64}")
+COLLECTION_INTERVAL = 60
+
+
+class PartialStore:
+    """
+    Keeps the partially received files of resumable uploads, so an interrupted
+    transfer continues from the received offset instead of byte 0.
+
+    Every upload is stored under its transfer ID in the .partial subdirectory,
+    next to a <transfer ID>.json file holding its filename, size and received offset.
+    Partial files not resumed for longer than the TTL are removed.
+
+    The other uploads are received in the store too, under a random name, so
+    the storage directory never shows an incomplete file; their files are removed
+    instead of kept when the transfer is interrupted.
+    """
+
+    def __init__(self, directory: str, ttl: float, file_sync: FileSync):
+        """
+        Initializes the store, creating its directory if needed.
+
+        Args:
+            directory: The directory where the files are saved.
+            ttl: The time in seconds after which abandoned partial files are removed.
+            file_sync: The committer of the completed files.
+        """
+        self._directory = os.path.join(directory, PARTIAL_DIRECTORY)
+        self._ttl = ttl
+        self.file_sync = file_sync
+        self._next_collection = time.monotonic()
+        os.makedirs(self._directory, exist_ok=True)
+
+    def open(
+        self, transfer_id: str, filename: str, filesize: int
+    ) -> tuple[io.FileIO, int]:
+        """
+        Opens the partial file of an upload, creating it if the upload is new.
+
+        Args:
+            transfer_id: The client-chosen ID of the upload (hex digits).
+            filename: The original filename.
+            filesize: The size of the complete file in bytes.
+
+        Returns:
+            A tuple containing the file opened for unbuffered writing at the resume
+            offset, and the resume offset.
+
+        Raises:
+            ValueError: If the transfer ID is malformed.
+            BlockingIOError: If the upload is in progress on another connection.
+        """
+        if not TRANSFER_ID_PATTERN.fullmatch(transfer_id):
+            raise ValueError(f"Invalid transfer ID: {transfer_id!r}")
+
+        path = os.path.join(self._directory, transfer_id)
+        file = open(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), "rb+", buffering=0)
+        try:
+            # Released when the file is closed, also guards against other workers
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+            offset = 0
+            try:
+                with open(f"{path}.json") as state_file:
+                    state = json.load(state_file)
+                if (state["filename"], state["filesize"]) == (filename, filesize):
+                    offset = min(state["offset"], os.fstat(file.fileno()).st_size)
+            except (OSError, ValueError, KeyError):
+                pass
+
+            file.truncate(offset)
+            preallocate(file, filesize)
+            file.seek(offset)
+        except Exception:
+            file.close()
+            raise
+
+        if offset:
+            logging.info(f"Resuming {filename} at {offset} of {filesize} bytes")
+        return file, offset
+
+    def create(self, filesize: int) -> tuple[io.FileIO, str]:
+        """
+        Creates the file of an upload that is not resumable.
+
+        Args:
+            filesize: The size of the complete file in bytes.
+
+        Returns:
+            A tuple containing the file opened for unbuffered writing, and its name
+            in the store, to commit or discard it by.
+        """
+        # Never a transfer ID, as the dash is not a hex digit
+        name = f"upload-{secrets.token_hex(8)}"
+        path = os.path.join(self._directory, name)
+        # Readable, so the receiver can checksum the content it spliced into it
+        file = open(
+            os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644),
+            "rb+",
+            buffering=0,
+        )
+        try:
+            # Keeps the file from being collected while it is received
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            preallocate(file, filesize)
+        except Exception:
+            file.close()
+            os.remove(path)
+            raise
+
+        return file, name
+
+    def discard(self, name: str) -> None:
+        """
+        Removes the file of an interrupted upload that is not resumable.
+
+        Args:
+            name: The name of the file in the store, see create().
+        """
+        try:
+            os.remove(os.path.join(self._directory, name))
+        except OSError as e:
+            logging.error(f"Error removing the partial file {name}: {e}")
+
+    def save(self, transfer_id: str, filename: str, filesize: int, offset: int) -> None:
+        """
+        Persists the received offset of an interrupted upload.
+
+        Args:
+            transfer_id: The ID of the upload.
+            filename: The original filename.
+            filesize: The size of the complete file in bytes.
+            offset: The number of bytes received so far.
+        """
+        path = os.path.join(self._directory, f"{transfer_id}.json")
+        try:
+            with open(f"{path}.tmp", "w") as state_file:
+                json.dump(
+                    {"filename": filename, "filesize": filesize, "offset": offset},
+                    state_file,
+                )
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            logging.error(f"Error saving the offset of {filename}: {e}")
+
+    def commit(
+        self, transfer_id: str, filename: str, filename_index: FilenameIndex
+    ) -> str:
+        """
+        Moves a completely received file from the store to the storage directory.
+
+        Args:
+            transfer_id: The ID of the upload, or the name of the file of an upload
+                that is not resumable (see create()).
+            filename: The original filename.
+            filename_index: The index of the filenames in the storage directory.
+
+        Returns:
+            The unique filename the file is saved under.
+        """
+        path = os.path.join(self._directory, transfer_id)
+        filename = self.file_sync.commit(path, filename, filename_index)
+        try:
+            os.remove(f"{path}.json")
+        except FileNotFoundError:
+            pass
+
+        return filename
+
+    def time_until_collection(self) -> float:
+        """
+        Returns the time left until the next removal of abandoned partial files.
+
+        Returns:
+            The time in seconds.
+        """
+        return max(self._next_collection - time.monotonic(), 0.0)
+
+    def collect_if_due(self) -> None:
+        """Removes the partial files not resumed for longer than the TTL, if it is time."""
+        if self.time_until_collection():
+            return
+        self._next_collection = time.monotonic() + COLLECTION_INTERVAL
+
+        expiration = time.time() - self._ttl
+        with os.scandir(self._directory) as entries:
+            for entry in entries:
+                if "." in entry.name or entry.stat().st_mtime > expiration:
+                    continue
+                try:
+                    with open(entry.path, "rb") as file:
+                        # Skips uploads in progress
+                        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        os.remove(entry.path)
+                    for suffix in (".json", ".json.tmp"):
+                        if os.path.exists(entry.path + suffix):
+                            os.remove(entry.path + suffix)
+                    logging.info(f"Removed abandoned partial file {entry.name}")
+                except OSError:
+                    continue
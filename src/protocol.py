@@ -0,0 +1,356 @@
+import hashlib
+import io
+import os
+import socket
+import struct
+
+# Sent by the server after a single-file transfer, before closing the connection
+LEGACY_ACK = b"1"
+
+# Replies of the server to pipelined or resumable files: kind, sequence number, value
+REPLY = struct.Struct("!BIQ")
+REPLY_ACK = 1
+# Sent before the content of a resumable file, the value is the offset to resume from
+REPLY_READY = 2
+# Sent instead of REPLY_READY when the server already has the content of the file
+REPLY_DUPLICATE = 3
+# Sent instead of REPLY_READY when the server cannot decompress the offered codec,
+# the content is to be sent uncompressed
+REPLY_READY_RAW = 4
+# Sent instead of the acknowledgement when the checksum of the received content does
+# not match the client's, the value is the server's checksum
+REPLY_CHECKSUM_MISMATCH = 5
+
+# The content of a file with the "sum" field is followed by its checksum, computed
+# with the field's algorithm (see checksum) over the content sent on the connection
+CHECKSUM = struct.Struct("!Q")
+
+# The compressed content of a file with the "codec" field is sent as frames of
+# compressor output, each prefixed with its length; it ends with the frame that
+# completes the decompressed filesize. A frame decompresses to MAX_FRAME_SIZE bytes
+# at most, so the memory a frame takes is bounded however large the file is
+FRAME_LENGTH = struct.Struct("!I")
+MAX_FRAME_SIZE = 4 * 2**20
+
+# The metadata frame: magic, version, flags (reserved), length of the TLV block.
+# The magic never starts the legacy text header, which starts with a digit
+FRAME_HEADER = struct.Struct("!2sBBI")
+FRAME_MAGIC = b"\xf7F"
+PROTOCOL_VERSION = 1
+MAX_METADATA_SIZE = 2**16
+
+# Every field of the TLV block: type, length of the value, value
+TLV_HEADER = struct.Struct("!BH")
+TLV_FILENAME = 1  # UTF-8
+TLV_FILESIZE = 2  # FILESIZE
+TLV_SEQUENCE = 3  # SEQUENCE
+TLV_TRANSFER_ID = 4  # ASCII
+TLV_CONTENT_HASH = 5  # raw digest
+TLV_CODEC = 6  # ASCII
+TLV_STRIPE = 7  # STRIPE
+TLV_CHECKSUM = 8  # ASCII
+FILESIZE = struct.Struct("!Q")
+SEQUENCE = struct.Struct("!I")
+# The index of a stripe of a striped upload and the number of stripes, see stripe_range()
+STRIPE = struct.Struct("!II")
+
+# The optional fields by the names the legacy header and the server use
+FIELD_TYPES = {
+    "seq": TLV_SEQUENCE,
+    "tid": TLV_TRANSFER_ID,
+    "hash": TLV_CONTENT_HASH,
+    "codec": TLV_CODEC,
+    "stripe": TLV_STRIPE,
+    "sum": TLV_CHECKSUM,
+}
+FIELD_NAMES = {tlv_type: name for name, tlv_type in FIELD_TYPES.items()}
+
+
+class ChecksumMismatchError(ValueError):
+    """Raised when the content received by the server does not match its checksum."""
+
+
+def encode_metadata(filename: str, filesize: int, **fields: object) -> bytes:
+    """
+    Encodes the metadata frame of a file: FRAME_HEADER followed by a block of TLV
+    fields, with the filename, the filesize and the optional fields.
+
+    Args:
+        filename: The name of the file.
+        filesize: The size of the file in bytes.
+        **fields: The optional fields, keys of FIELD_TYPES, e.g. seq for
+            pipelined transfers, or stripe ("index/count") for striped uploads.
+
+    Returns:
+        The encoded metadata frame, built in a single buffer.
+
+    Raises:
+        KeyError: If a field is unknown.
+    """
+    values = [
+        (TLV_FILENAME, filename.encode()),
+        (TLV_FILESIZE, FILESIZE.pack(filesize)),
+    ]
+    for key, value in fields.items():
+        tlv_type = FIELD_TYPES[key]
+        if tlv_type == TLV_SEQUENCE:
+            values.append((tlv_type, SEQUENCE.pack(int(value))))
+        elif tlv_type == TLV_CONTENT_HASH:
+            values.append((tlv_type, bytes.fromhex(value)))
+        elif tlv_type == TLV_STRIPE:
+            values.append((tlv_type, STRIPE.pack(*parse_stripe(str(value)))))
+        else:
+            values.append((tlv_type, str(value).encode()))
+
+    metadata_length = sum(TLV_HEADER.size + len(value) for _, value in values)
+    frame = bytearray(FRAME_HEADER.size + metadata_length)
+    FRAME_HEADER.pack_into(frame, 0, FRAME_MAGIC, PROTOCOL_VERSION, 0, metadata_length)
+    offset = FRAME_HEADER.size
+    for tlv_type, value in values:
+        TLV_HEADER.pack_into(frame, offset, tlv_type, len(value))
+        offset += TLV_HEADER.size
+        frame[offset : offset + len(value)] = value
+        offset += len(value)
+
+    return bytes(frame)
+
+
+def is_frame(header_start: bytes) -> bool:
+    """
+    Tells a metadata frame from the legacy text header by its first byte, which is
+    a digit of the metadata length in the legacy header.
+
+    Args:
+        header_start: At least the first byte of the header.
+
+    Returns:
+        True if the header starts a metadata frame.
+    """
+    return header_start[0] == FRAME_MAGIC[0]
+
+
+def parse_frame_header(header: bytes) -> int:
+    """
+    Parses the header of a metadata frame (see FRAME_HEADER).
+
+    Args:
+        header: The FRAME_HEADER.size bytes of the header.
+
+    Returns:
+        The length of the TLV block that follows.
+
+    Raises:
+        ValueError: If the magic is wrong, the version is newer than PROTOCOL_VERSION,
+            or the block is too long.
+    """
+    magic, version, _, metadata_length = FRAME_HEADER.unpack(header)
+    if magic != FRAME_MAGIC:
+        raise ValueError(f"Invalid frame magic: {magic!r}")
+    if version > PROTOCOL_VERSION:
+        raise ValueError(f"Unsupported protocol version: {version}")
+    if metadata_length > MAX_METADATA_SIZE:
+        raise ValueError(f"Metadata too long: {metadata_length}")
+    return metadata_length
+
+
+def parse_frame_metadata(block: bytes) -> tuple[str, int, dict[str, str]]:
+    """
+    Parses the TLV block of a metadata frame, slicing it without copies.
+    Fields of unknown types are skipped, so newer clients can add them.
+
+    Args:
+        block: The TLV block.
+
+    Returns:
+        A tuple containing the filename, filesize and the optional fields,
+        in the form parse_legacy_metadata() returns them.
+
+    Raises:
+        ValueError: If the metadata is malformed.
+    """
+    view = memoryview(block)
+    filename = filesize = None
+    fields = {}
+    offset = 0
+    while offset < len(view):
+        tlv_type, length = TLV_HEADER.unpack_from(view, offset)
+        offset += TLV_HEADER.size
+        value = view[offset : offset + length]
+        if len(value) < length:
+            raise ValueError("Truncated metadata field")
+        offset += length
+
+        if tlv_type == TLV_FILENAME:
+            filename = str(value, "utf-8")
+        elif tlv_type == TLV_FILESIZE:
+            (filesize,) = FILESIZE.unpack(value)
+        elif tlv_type == TLV_SEQUENCE:
+            fields["seq"] = str(SEQUENCE.unpack(value)[0])
+        elif tlv_type == TLV_CONTENT_HASH:
+            fields["hash"] = value.hex()
+        elif tlv_type == TLV_STRIPE:
+            fields["stripe"] = "{}/{}".format(*STRIPE.unpack(value))
+        elif tlv_type in FIELD_NAMES:
+            fields[FIELD_NAMES[tlv_type]] = str(value, "ascii")
+
+    if filesize is None:
+        raise ValueError("Missing filesize")
+    validate_filename(filename)
+    return filename, filesize, fields
+
+
+def validate_filename(filename: str | None) -> None:
+    """
+    Checks that the filename is a plain file name the server can save under.
+
+    Args:
+        filename: The filename.
+
+    Raises:
+        ValueError: If the filename is missing, or is a path or a special name.
+    """
+    if not filename or filename in (".", "..") or "/" in filename or "\0" in filename:
+        raise ValueError(f"Invalid filename: {filename!r}")
+
+
+def parse_stripe(stripe: str) -> tuple[int, int]:
+    """
+    Parses the stripe field of a striped upload.
+
+    Args:
+        stripe: The field value, "index/count".
+
+    Returns:
+        A tuple containing the index of the stripe and the number of stripes.
+
+    Raises:
+        ValueError: If the field is malformed.
+    """
+    index, count = map(int, stripe.split("/"))
+    if not 0 <= index < count:
+        raise ValueError(f"Invalid stripe: {stripe!r}")
+    return index, count
+
+
+def stripe_range(filesize: int, index: int, count: int) -> tuple[int, int]:
+    """
+    Computes the range of a file sent over one of the connections of a striped
+    upload, which splits the file into count stripes of nearly equal size.
+
+    Args:
+        filesize: The size of the complete file in bytes.
+        index: The index of the stripe.
+        count: The number of stripes.
+
+    Returns:
+        The offsets of the start and the end of the stripe.
+    """
+    return filesize * index // count, filesize * (index + 1) // count
+
+
+def encode_legacy_metadata(filename: str, filesize: int, **fields: object) -> bytes:
+    """
+    Encodes the legacy metadata header of a file, still accepted from old clients:
+    the space-padded metadata length followed by "filename/filesize", with the
+    optional fields appended as "/key=value".
+
+    Args:
+        filename: The name of the file.
+        filesize: The size of the file in bytes.
+        **fields: The optional fields, e.g. seq for pipelined transfers.
+
+    Returns:
+        The encoded metadata header.
+
+    Notes:
+        METADATA_LENGTH_SIZE is an environment variable that specifies the size of the
+        metadata length in bytes. Must be set before running the script (see .env).
+    """
+    file_info = "/".join(
+        [filename, str(filesize)] + [f"{key}={value}" for key, value in fields.items()]
+    ).encode()
+    metadata_size = int(os.getenv("METADATA_LENGTH_SIZE"))
+    return f"{len(file_info):<{metadata_size}}".encode() + file_info
+
+
+def parse_legacy_metadata(file_info: bytes) -> tuple[str, int, dict[str, str]]:
+    """
+    Parses the legacy metadata body (without the length) encoded by
+    encode_legacy_metadata().
+
+    Args:
+        file_info: The metadata body.
+
+    Returns:
+        A tuple containing the filename, filesize and the optional fields.
+
+    Raises:
+        ValueError: If the metadata is malformed.
+    """
+    filename, filesize, *fields = file_info.decode().split("/")
+    validate_filename(filename)
+
+    filesize = int(filesize)
+    if filesize < 0:
+        raise ValueError(f"Invalid filesize: {filesize}")
+
+    return filename, filesize, dict(field.split("=", 1) for field in fields)
+
+
+def send_buffers(sock: socket.socket, *buffers: bytes) -> None:
+    """
+    Sends several buffers as one message with sendmsg(), without joining them
+    into a new bytes object first.
+
+    Args:
+        sock: The blocking socket to send to.
+        *buffers: The buffers to send, in order.
+    """
+    views = [memoryview(buffer) for buffer in buffers]
+    while views:
+        sent = sock.sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views.pop(0))
+        if views:
+            views[0] = views[0][sent:]
+
+
+def encode_reply(kind: int, sequence: int, value: int = 0) -> bytes:
+    """
+    Encodes a server reply to a pipelined or resumable file.
+
+    Args:
+        kind: The reply kind, e.g. REPLY_ACK.
+        sequence: The sequence number of the file.
+        value: The kind-specific value.
+
+    Returns:
+        The encoded reply.
+    """
+    return REPLY.pack(kind, sequence, value)
+
+
+def create_content_digest() -> object:
+    """
+    Creates the digest the content hash of a file is computed with, for a file
+    hashed incrementally as it is received.
+
+    Returns:
+        A BLAKE2b-256 hashlib object, its hexdigest() the content hash.
+    """
+    return hashlib.blake2b(digest_size=32)
+
+
+def content_hash(file: io.BufferedIOBase) -> str:
+    """
+    Computes the content hash of a file in a single streaming pass, from the current
+    position to the end.
+
+    Args:
+        file: The file opened for binary reading.
+
+    Returns:
+        The BLAKE2b-256 hex digest of the content.
+    """
+    digest = hashlib.file_digest(file, create_content_digest)
+    return digest.hexdigest()
@@ -0,0 +1,226 @@
+import collections
+import heapq
+import itertools
+import time
+
+from connection import Connection
+
+# The seconds of traffic a bucket holds at most, the longest burst over the rate
+BURST_SECONDS = 0.1
+# The seconds of traffic an exhausted bucket earns before it is shared again, so
+# the connections are not woken up for every few bytes earned
+WAKE_SECONDS = 0.01
+
+
+class TokenBucket:
+    """
+    A token bucket: earns rate tokens (bytes) per second up to its capacity, and is
+    charged the bytes received. A charge over the tokens left is a debt paid back
+    from the tokens earned next, so a whole compressed frame can be received at once.
+
+    Once its tokens fall below a receive, the bucket closes until it has earned
+    WAKE_SECONDS of traffic, so it is spent in receives of a useful size.
+    """
+
+    __slots__ = (
+        "rate",
+        "capacity",
+        "low",
+        "high",
+        "tokens",
+        "updated",
+        "open",
+        "quantum",
+    )
+
+    def __init__(self, rate: float, chunk_size: int):
+        """
+        Initializes the bucket, full.
+
+        Args:
+            rate: The rate in bytes per second.
+            chunk_size: The maximum number of bytes moved per receive, the least
+                capacity of the bucket however low the rate is.
+        """
+        self.rate = rate
+        self.capacity = max(rate * BURST_SECONDS, chunk_size)
+        self.low = chunk_size
+        self.high = min(max(rate * WAKE_SECONDS, chunk_size), self.capacity)
+        self.tokens = self.capacity
+        self.updated = time.perf_counter()
+        self.open = True
+        # The share of the tokens of each connection ready in the current round
+        self.quantum = 0.0
+
+    def refill(self, now: float) -> None:
+        """Adds the tokens earned since the last refill, opening or closing the bucket."""
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.capacity)
+        self.updated = now
+        self.open = self.tokens >= (self.low if self.open else self.high)
+
+    def time_until_open(self) -> float:
+        """Returns the time in seconds until the bucket opens again."""
+        return max(self.high - self.tokens, 0.0) / self.rate
+
+
+class RateLimiter:
+    """
+    Shapes the bandwidth the epoll engine receives file content at, with token
+    buckets capping the total rate, the rate per client IP address and the rate
+    per connection.
+
+    A bucket limiting several connections is shared fairly: each round of the event
+    loop, every ready connection may take an equal share (quantum) of its tokens,
+    so the connections polled first cannot drain it. A connection left without
+    tokens is parked, i.e. its socket is not watched for input, until its buckets
+    open again.
+    """
+
+    def __init__(
+        self,
+        max_rate: float,
+        max_rate_per_ip: float,
+        max_rate_per_connection: float,
+        chunk_size: int,
+    ):
+        """
+        Initializes the limiter. A rate of 0 turns the limit off.
+
+        Args:
+            max_rate: The maximum total rate in bytes per second.
+            max_rate_per_ip: The maximum rate of a client IP address in bytes
+                per second.
+            max_rate_per_connection: The maximum rate of a connection in bytes
+                per second.
+            chunk_size: The maximum number of bytes moved per receive.
+        """
+        self._max_rate_per_ip = max_rate_per_ip
+        self._max_rate_per_connection = max_rate_per_connection
+        self._chunk_size = chunk_size
+        self._global = TokenBucket(max_rate, chunk_size) if max_rate else None
+        self._ip_buckets: dict[str, TokenBucket] = {}
+        self._connections_per_ip: dict[str, int] = {}
+        self._now = time.perf_counter()
+        # (wake time, tie-breaker, connection) of the parked connections
+        self._parked: list[tuple[float, int, Connection]] = []
+        self._sequence = itertools.count()
+
+    def admit(self, connection: Connection) -> None:
+        """
+        Assigns the buckets limiting a new connection.
+
+        Args:
+            connection: The accepted connection.
+        """
+        buckets = []
+        if self._global:
+            buckets.append(self._global)
+        if self._max_rate_per_ip:
+            ip = connection.peer[0]
+            if ip not in self._ip_buckets:
+                self._ip_buckets[ip] = TokenBucket(
+                    self._max_rate_per_ip, self._chunk_size
+                )
+                self._connections_per_ip[ip] = 0
+            self._connections_per_ip[ip] += 1
+            buckets.append(self._ip_buckets[ip])
+        if self._max_rate_per_connection:
+            buckets.append(TokenBucket(self._max_rate_per_connection, self._chunk_size))
+        connection.rate_buckets = tuple(buckets)
+
+    def release(self, connection: Connection) -> None:
+        """
+        Forgets the bucket of a client IP address once its last connection is closed.
+
+        Args:
+            connection: The connection admitted by admit().
+        """
+        if not self._max_rate_per_ip:
+            return
+        ip = connection.peer[0]
+        self._connections_per_ip[ip] -= 1
+        if not self._connections_per_ip[ip]:
+            del self._connections_per_ip[ip]
+            del self._ip_buckets[ip]
+
+    def begin_round(self, now: float, ready: list[Connection]) -> None:
+        """
+        Starts a round of the event loop, sharing the tokens of every bucket among
+        the ready connections it limits.
+
+        Args:
+            now: The perf_counter() time the events were polled at.
+            ready: The connections with events polled.
+        """
+        self._now = now
+        shares = collections.Counter(
+            bucket for connection in ready for bucket in connection.rate_buckets
+        )
+        for bucket, count in shares.items():
+            bucket.refill(now)
+            bucket.quantum = bucket.tokens / count if bucket.open else 0.0
+
+    def allowance(self, connection: Connection) -> int:
+        """
+        Returns the number of bytes a connection may receive in the current round.
+
+        Args:
+            connection: The connection.
+
+        Returns:
+            The number of bytes, 0 if the connection is to be parked.
+        """
+        allowance = self._chunk_size
+        for bucket in connection.rate_buckets:
+            allowance = min(allowance, bucket.quantum, bucket.tokens)
+        return max(int(allowance), 0)
+
+    def charge(self, connection: Connection, count: int) -> None:
+        """
+        Takes the received bytes from the buckets of a connection.
+
+        Args:
+            connection: The connection.
+            count: The number of bytes received.
+        """
+        for bucket in connection.rate_buckets:
+            bucket.tokens -= count
+
+    def park(self, connection: Connection) -> None:
+        """
+        Schedules the wake-up of a connection without tokens, for when its buckets
+        open again.
+
+        Args:
+            connection: The connection, no longer watched for input.
+        """
+        delay = max(bucket.time_until_open() for bucket in connection.rate_buckets)
+        heapq.heappush(
+            self._parked, (self._now + delay, next(self._sequence), connection)
+        )
+
+    def time_until_wake(self) -> float | None:
+        """
+        Returns the time left until the next parked connection is woken up.
+
+        Returns:
+            The time in seconds, or None if no connections are parked.
+        """
+        if not self._parked:
+            return None
+        return max(self._parked[0][0] - time.perf_counter(), 0.0)
+
+    def woken(self, now: float) -> list[Connection]:
+        """
+        Takes the connections due to be woken up out of the parked ones.
+
+        Args:
+            now: The current perf_counter() time.
+
+        Returns:
+            The connections, possibly closed in the meantime.
+        """
+        woken = []
+        while self._parked and self._parked[0][0] <= now:
+            woken.append(heapq.heappop(self._parked)[2])
+        return woken
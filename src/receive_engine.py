@@ -0,0 +1,290 @@
+import fcntl
+import logging
+import os
+import socket
+
+import protocol
+from connection import Connection
+
+# Caps the memory allocated per recv() of a compressed frame
+FRAME_RECV_SIZE = 2**18
+# The size of the reads of the spliced content, to hash it from the page cache
+HASH_READ_SIZE = 2**18
+
+
+class BufferReceiver:
+    """
+    Receives data with recv_into() into a preallocated buffer and writes that
+    buffer out without creating intermediate bytes objects. The connection's
+    checksum and content digest, if any, are updated from the same buffer.
+
+    A single buffer is shared by all connections: it is fully written out after
+    every call, and the event loop serves one connection at a time.
+    """
+
+    def __init__(self, bufsize: int):
+        """
+        Initializes the receiver and allocates its buffer.
+
+        Args:
+            bufsize: The maximum number of bytes moved per call.
+        """
+        self.bufsize = bufsize
+        self._buffer = memoryview(bytearray(bufsize))
+
+    def receive(
+        self, connection: Connection, client_socket: socket.socket, count: int
+    ) -> int:
+        """
+        Moves up to count bytes from the client socket to the connection's file.
+
+        Args:
+            connection: The state of the connection.
+            client_socket: The socket connected to the client.
+            count: The maximum number of bytes to move.
+
+        Returns:
+            The number of bytes moved, 0 if the client closed the connection.
+
+        Raises:
+            BlockingIOError: If there is no data available on the socket.
+        """
+        received = client_socket.recv_into(self._buffer, min(count, self.bufsize))
+        view = self._buffer[:received]
+        if connection.checksum:
+            connection.checksum.update(view)
+        if connection.content_digest:
+            connection.content_digest.update(view)
+        while view:
+            view = view[connection.file.write(view) :]
+
+        return received
+
+    def close(self) -> None:
+        """Releases the resources held by the receiver."""
+
+
+class SpliceReceiver(BufferReceiver):
+    """
+    Receives data with splice() through a pipe, so the payload goes from
+    the socket to the file inside the kernel and never reaches Python.
+    The content of connections with a checksum or a content digest is hashed from
+    the page cache once HASH_READ_SIZE bytes are spliced, or the file is complete,
+    read back into a preallocated buffer while it is still cached, instead of being
+    received with recv_into() and copied again by write().
+
+    A single pipe is shared by all connections: it is fully drained after
+    every call, and the event loop serves one connection at a time.
+    """
+
+    def __init__(self, bufsize: int):
+        """
+        Initializes the receiver and creates its pipe.
+
+        Args:
+            bufsize: The maximum number of bytes moved per call.
+
+        Raises:
+            OSError: If the pipe cannot be created.
+        """
+        self.bufsize = bufsize
+        self._read_fd, self._write_fd = os.pipe()
+        try:
+            pipe_size = fcntl.fcntl(self._write_fd, fcntl.F_SETPIPE_SZ, bufsize)
+            self.bufsize = min(bufsize, pipe_size)
+        except OSError:
+            # The default pipe capacity (64 KiB on Linux) is used then
+            self.bufsize = min(bufsize, fcntl.fcntl(self._write_fd, fcntl.F_GETPIPE_SZ))
+        self._buffer = memoryview(bytearray(HASH_READ_SIZE))
+
+    def receive(
+        self, connection: Connection, client_socket: socket.socket, count: int
+    ) -> int:
+        """
+        Moves up to count bytes from the client socket to the connection's file.
+
+        Args:
+            connection: The state of the connection.
+            client_socket: The socket connected to the client.
+            count: The maximum number of bytes to move.
+
+        Returns:
+            The number of bytes moved, 0 if the client closed the connection.
+
+        Raises:
+            BlockingIOError: If there is no data available on the socket.
+        """
+        received = os.splice(
+            client_socket.fileno(),
+            self._write_fd,
+            min(count, self.bufsize),
+            flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK,
+        )
+
+        file_descriptor = connection.file.fileno()
+        pending = received
+        while pending:
+            pending -= os.splice(
+                self._read_fd, file_descriptor, pending, flags=os.SPLICE_F_MOVE
+            )
+
+        if connection.checksum or connection.content_digest:
+            end = connection.received + received
+            if end - connection.hashed >= HASH_READ_SIZE or end == connection.filesize:
+                self._hash(connection, file_descriptor, end)
+
+        return received
+
+    def _hash(self, connection: Connection, file_descriptor: int, end: int) -> None:
+        """Hashes the spliced content of a connection up to the end offset."""
+        while connection.hashed < end:
+            view = self._buffer[: min(end - connection.hashed, HASH_READ_SIZE)]
+            view = view[: os.preadv(file_descriptor, [view], connection.hashed)]
+            if connection.checksum:
+                connection.checksum.update(view)
+            if connection.content_digest:
+                connection.content_digest.update(view)
+            connection.hashed += len(view)
+
+    def close(self) -> None:
+        """Releases the resources held by the receiver."""
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
+
+class QueuedReceiver:
+    """
+    Receives data with recv_into() into a new buffer per call and queues it to
+    the connection's writer pool (see disk_writer), so the event loop never
+    waits for the disk.
+    """
+
+    def __init__(self, bufsize: int):
+        """
+        Initializes the receiver.
+
+        Args:
+            bufsize: The maximum number of bytes moved per call.
+        """
+        self.bufsize = bufsize
+
+    def receive(
+        self, connection: Connection, client_socket: socket.socket, count: int
+    ) -> int:
+        """
+        Moves up to count bytes from the client socket to the queue of the
+        connection's file.
+
+        Args:
+            connection: The state of the connection.
+            client_socket: The socket connected to the client.
+            count: The maximum number of bytes to move.
+
+        Returns:
+            The number of bytes moved, 0 if the client closed the connection.
+
+        Raises:
+            BlockingIOError: If there is no data available on the socket.
+        """
+        # The buffer is owned by the queue until it is written, so it is never reused
+        buffer = memoryview(bytearray(min(count, self.bufsize)))
+        received = client_socket.recv_into(buffer)
+        if received:
+            if connection.checksum:
+                connection.checksum.update(buffer[:received])
+            if connection.content_digest:
+                connection.content_digest.update(buffer[:received])
+            connection.writes.write(buffer[:received])
+
+        return received
+
+    def close(self) -> None:
+        """Releases the resources held by the receiver."""
+
+
+def receive_compressed(
+    connection: Connection, client_socket: socket.socket, count: int
+) -> int:
+    """
+    Receives the next compressed frame from the client socket (see protocol.FRAME_LENGTH)
+    and moves its decompressed content to the connection's file, or to its queue if
+    the file is written by the writer pool. A partially received frame is kept in
+    the connection until the rest arrives.
+
+    Args:
+        connection: The state of the connection.
+        client_socket: The socket connected to the client.
+        count: The number of decompressed bytes left in the file.
+
+    Returns:
+        The number of decompressed bytes moved, 0 if the client closed the connection.
+
+    Raises:
+        BlockingIOError: If no complete frame is available on the socket.
+        ValueError: If a frame is malformed, or decompresses past the filesize or
+            MAX_FRAME_SIZE; the decompressor stops right there, so a decompression
+            bomb is never held in memory.
+    """
+    partial = connection.partial
+    decompressed = b""
+    while not decompressed:
+        frame_length = connection.frame_length
+        size = frame_length or protocol.FRAME_LENGTH.size
+        while len(partial) < size:
+            chunk = client_socket.recv(min(size - len(partial), FRAME_RECV_SIZE))
+            if not chunk:
+                return 0
+            partial += chunk
+
+        if not frame_length:
+            (frame_length,) = protocol.FRAME_LENGTH.unpack(partial)
+            if not 0 < frame_length <= protocol.MAX_FRAME_SIZE:
+                raise ValueError(f"Invalid compressed frame length: {frame_length}")
+            connection.frame_length = frame_length
+            partial.clear()
+            continue
+
+        decompressed = connection.decompressor.decompress(
+            partial, min(count, protocol.MAX_FRAME_SIZE)
+        )
+        connection.frame_length = None
+        partial.clear()
+
+    if connection.checksum:
+        connection.checksum.update(decompressed)
+    if connection.content_digest:
+        connection.content_digest.update(decompressed)
+    if connection.writes:
+        connection.writes.write(memoryview(decompressed))
+    else:
+        view = memoryview(decompressed)
+        while view:
+            view = view[connection.file.write(view) :]
+
+    return len(decompressed)
+
+
+def create_receiver(
+    bufsize: int, queued: bool = False
+) -> "SpliceReceiver | BufferReceiver | QueuedReceiver":
+    """
+    Creates the fastest receiver available on the current platform.
+
+    Args:
+        bufsize: The maximum number of bytes moved per call.
+        queued: Whether the files are written by a writer pool (see disk_writer).
+
+    Returns:
+        A QueuedReceiver if queued, otherwise a SpliceReceiver on Linux,
+        a BufferReceiver elsewhere.
+    """
+    if queued:
+        return QueuedReceiver(bufsize)
+
+    if hasattr(os, "splice"):
+        try:
+            return SpliceReceiver(bufsize)
+        except OSError as e:
+            logging.warning(f"splice() is unavailable, falling back to recv_into: {e}")
+
+    return BufferReceiver(bufsize)
@@ -0,0 +1,86 @@
+import os
+import socket
+import struct
+
+# The bounds of the sendfile() window in bytes
+MIN_WINDOW = 2**16
+MAX_WINDOW = 2**24
+# A call lasts this long at least, so the work done between calls is amortized
+MIN_CALL_SECONDS = 0.005
+# The weight of the latest call in the throughput estimate
+THROUGHPUT_SMOOTHING = 0.25
+# tcpi_rtt of the struct tcp_info of Linux, in microseconds
+TCP_INFO_RTT = struct.Struct("=I")
+TCP_INFO_RTT_OFFSET = 68
+
+
+def measure_rtt(client_socket: socket.socket) -> float | None:
+    """
+    Reads the kernel's smoothed round-trip time of a TCP connection.
+
+    Args:
+        client_socket: The connected socket.
+
+    Returns:
+        The round-trip time in seconds, None where TCP_INFO is unsupported.
+    """
+    if not hasattr(socket, "TCP_INFO"):
+        return None
+    try:
+        info = client_socket.getsockopt(
+            socket.IPPROTO_TCP,
+            socket.TCP_INFO,
+            TCP_INFO_RTT_OFFSET + TCP_INFO_RTT.size,
+        )
+    except OSError:
+        return None
+    if len(info) < TCP_INFO_RTT_OFFSET + TCP_INFO_RTT.size:
+        return None
+    return TCP_INFO_RTT.unpack_from(info, TCP_INFO_RTT_OFFSET)[0] / 1e6
+
+
+class SendWindow:
+    """
+    Sizes the sendfile() calls of an upload. Every call returns to Python, so
+    the window grows with the measured throughput until a call lasts
+    MIN_CALL_SECONDS, or a round trip on links with a longer RTT, keeping
+    the bandwidth-delay product in flight per call.
+
+    A SEND_WINDOW other than 0 fixes the window instead, e.g. to benchmark it.
+    """
+
+    def __init__(self, client_socket: socket.socket):
+        """
+        Initializes the window, starting at MIN_WINDOW.
+
+        Args:
+            client_socket: The connected socket the file is sent over.
+        """
+        self._socket = client_socket
+        self._fixed = int(os.getenv("SEND_WINDOW"))
+        self._throughput = 0.0
+        self.size = self._fixed or MIN_WINDOW
+
+    def update(self, sent: int, elapsed: float) -> None:
+        """
+        Resizes the window from the duration of the last call.
+
+        Args:
+            sent: The number of bytes the call sent.
+            elapsed: The duration of the call in seconds.
+        """
+        if self._fixed:
+            return
+
+        throughput = sent / max(elapsed, 1e-6)
+        self._throughput = (
+            throughput
+            if not self._throughput
+            else self._throughput
+            + THROUGHPUT_SMOOTHING * (throughput - self._throughput)
+        )
+        call_seconds = max(MIN_CALL_SECONDS, measure_rtt(self._socket) or 0.0)
+        # Doubles at most per call, so a burst into an empty socket buffer is not
+        # mistaken for the throughput of the link
+        size = min(self._throughput * call_seconds, self.size * 2, MAX_WINDOW)
+        self.size = int(max(size, MIN_WINDOW))
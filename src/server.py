@@ -1,185 +1,867 @@
 import argparse
-import csv
+import errno
 import logging
 import os
+import signal
 import socket
+import struct
 import sys
-from datetime import datetime
+import time
 
 import dotenv
 import select
 
+import async_server
+import checksum
+import compression
+import protocol
+import receive_engine
+from attribute_journal import AttributeJournal
+from attribute_store import AttributeStore, DATABASE_NAME
+from content_index import ContentIndex
+from disk_writer import FileSync, WriterPool
+from connection import Connection, State
+from connection_guard import ConnectionGuard
+from filename_index import FilenameIndex
+from metrics import Metrics, MetricsEndpoint
+from partial_store import PartialStore
+from rate_limiter import RateLimiter
+from stripe_store import StripeStore
 
-def generate_unique_filename(directory: str, filename: str) -> str:
+
+def receive_partial(
+    connection: Connection, client_socket: socket.socket, size: int
+) -> bool:
     """
-    Generates a unique filename in the specified directory by appending a number
-    if a file with the same name already exists.
+    Receives the bytes that are available on the socket into the connection's
+    partial buffer, without waiting for the rest to arrive.
 
     Args:
-        directory: The directory where the file will be saved.
-        filename: The original filename.
+        connection: The state of the connection.
+        client_socket: The socket connected to the client.
+        size: The number of bytes the partial buffer must reach.
 
     Returns:
-        A unique filename with an appended number if needed.
-    """
-    name, ext = os.path.splitext(filename)
-    files_in_directory = os.listdir(directory)
+        True if the partial buffer holds size bytes, False if more are to come.
 
-    same_name_count = sum(
-        1
-        for f in files_in_directory
-        if f.startswith(f"{name} (") and f.endswith(f"){ext}") or f == filename
-    )
-
-    if same_name_count:
-        filename = f"{name} ({same_name_count}){ext}"
+    Raises:
+        EOFError: If the client closed the connection before sending anything.
+        ConnectionError: If the client closed the connection in the middle.
+    """
+    partial = connection.partial
+    while len(partial) < size:
+        try:
+            chunk = client_socket.recv(size - len(partial))
+        except BlockingIOError:
+            return False
+        if not chunk:
+            if not partial:
+                raise EOFError("Socket closed")
+            raise ConnectionError("Socket closed prematurely")
+        partial += chunk
 
-    return filename
+    return True
 
 
-def receive_metadata(client_socket: socket.socket, directory: str) -> tuple[str, int]:
+def receive_metadata(
+    connection: Connection, client_socket: socket.socket
+) -> tuple[str, int, dict[str, str]] | None:
     """
-    Receives metadata from the client socket, including the filename and filesize.
+    Receives metadata from the client socket, including the filename, filesize
+    and optional fields (see protocol.encode_metadata).
+
+    The metadata length and body are received incrementally: whatever has arrived is
+    kept in the connection, so a slow client never blocks the event loop. Both the
+    binary metadata frame and the legacy text header of old clients are accepted,
+    told apart by the first byte.
 
     Args:
+        connection: The state of the connection.
         client_socket: The socket connected to the client.
-        directory: The directory where the file will be saved.
 
     Returns:
-        A tuple containing the unique filename and filesize.
+        A tuple containing the filename, filesize and optional fields, or None
+        if the metadata has not been received completely yet.
     """
     try:
-        metadata_size = int(os.getenv("METADATA_LENGTH_SIZE"))
-        metadata_length_data = b""
-        while len(metadata_length_data) < metadata_size:
-            try:
-                chunk = client_socket.recv(metadata_size - len(metadata_length_data))
-                if not chunk:
-                    raise ConnectionError("Socket closed prematurely")
-                metadata_length_data += chunk
-            except BlockingIOError:
-                continue
+        if connection.state is State.RECEIVE_METADATA_LENGTH:
+            if not receive_partial(connection, client_socket, 1):
+                return None
 
-        metadata_length = int(metadata_length_data.decode().strip())
-        file_info_data = b""
-        while len(file_info_data) < metadata_length:
-            try:
-                chunk = client_socket.recv(metadata_length - len(file_info_data))
-                if not chunk:
-                    raise ConnectionError("Socket closed prematurely")
-                file_info_data += chunk
-            except BlockingIOError:
-                continue
+            connection.legacy_metadata = not protocol.is_frame(connection.partial)
+            if connection.legacy_metadata:
+                header_size = int(os.getenv("METADATA_LENGTH_SIZE"))
+            else:
+                header_size = protocol.FRAME_HEADER.size
+            if not receive_partial(connection, client_socket, header_size):
+                return None
 
-        filename, filesize = file_info_data.decode().split("/")
-        filename = generate_unique_filename(directory, filename)
-        filesize = int(filesize)
-        logging.info(f"Receiving {filename} ({filesize} bytes)")
-        return filename, filesize
+            if connection.legacy_metadata:
+                metadata_length = int(connection.partial.decode().strip())
+            else:
+                metadata_length = protocol.parse_frame_header(connection.partial)
+            connection.metadata_length = metadata_length
+            connection.partial.clear()
+            connection.state = State.RECEIVE_METADATA_BODY
+
+        if not receive_partial(connection, client_socket, connection.metadata_length):
+            return None
+
+        if connection.legacy_metadata:
+            metadata = protocol.parse_legacy_metadata(connection.partial)
+        else:
+            metadata = protocol.parse_frame_metadata(connection.partial)
+        connection.partial.clear()
+        return metadata
+    except EOFError:
+        raise
     except Exception as e:
         logging.error(f"Error receiving metadata: {e}")
         raise
 
 
 def handle_new_connection(
-    epoll: select.epoll, server_socket: socket.socket, connections: dict[int, dict]
+    epoll: select.epoll,
+    server_socket: socket.socket,
+    connections: dict[int, Connection],
+    guard: ConnectionGuard,
+    limiter: RateLimiter | None,
+    metrics: Metrics | None,
 ) -> None:
     """
     Handles a new incoming connection by accepting it, setting it to non-blocking,
-    and registering it with epoll.
+    and registering it with epoll. A connection over the caps of the guard is
+    reset right away, before any of its data is read. If the process is out of
+    file descriptors, the listening socket is not watched until the guard resumes
+    accepting, instead of polling it in a busy loop.
 
     Args:
         epoll: The epoll object for managing multiple connections.
         server_socket: The server socket accepting new connections.
-        connections: A dictionary tracking active connections.
+        connections: The connections by file descriptor number.
+        guard: The guard capping and timing out the connections.
+        limiter: The limiter of the receive rates, None if the rates are unlimited.
+        metrics: The metrics to update, None if they are off.
     """
-    client_socket, addr = server_socket.accept()
-    logging.info(f"Connection from {addr}")
+    try:
+        client_socket, addr = server_socket.accept()
+    except (BlockingIOError, InterruptedError):
+        return  # the queued connection is gone already
+    except OSError as e:
+        if e.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+            logging.error(f"Error accepting a connection, suspending accepting: {e}")
+            epoll.modify(server_socket.fileno(), 0)
+            guard.suspend_accepting(time.perf_counter())
+        else:
+            # e.g. ECONNABORTED, the client reset the connection while it was queued
+            logging.warning(f"Error accepting a connection: {e}")
+        return
+
+    connection = Connection(client_socket, addr)
+    if not guard.admit(connection, connection.last_activity):
+        if metrics:
+            metrics.connections_refused_total += 1
+        # Resets the connection instead of closing it, so it leaves no TIME_WAIT
+        client_socket.setsockopt(
+            socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0)
+        )
+        client_socket.close()
+        return
 
+    if limiter:
+        limiter.admit(connection)
+    logging.info(f"Connection from {addr}")
     client_socket.setblocking(False)
     epoll.register(client_socket.fileno(), select.EPOLLIN)
-    connections[client_socket.fileno()] = {
-        "socket": client_socket,
-        "state": "RECEIVE_METADATA",
-        "file": None,
-        "filename": None,
-        "filesize": 0,
-        "received": 0,
-    }
+    connections[client_socket.fileno()] = connection
+    if metrics:
+        metrics.connections_total += 1
 
 
 def handle_metadata_reception(
-    connection: dict[str], client_socket: socket.socket, directory: str
+    connection: Connection,
+    client_socket: socket.socket,
+    epoll: select.epoll,
+    descriptor_no: int,
+    filename_index: FilenameIndex,
+    partial_store: PartialStore,
+    stripe_store: StripeStore,
+    content_index: ContentIndex,
+    receiver: "receive_engine.SpliceReceiver | receive_engine.BufferReceiver",
+    journal: "AttributeJournal | AttributeStore",
+    writer_pool: WriterPool | None,
+    limiter: RateLimiter | None,
+    metrics: Metrics | None,
 ) -> None:
     """
     Handles the reception of metadata from the client, including the filename and filesize.
 
+    If the metadata carries a transfer ID, the upload is resumable: the server replies
+    with the offset to resume from, and keeps the partial file if the connection drops.
+    If it also carries a content hash of a file the server already has, the server
+    saves the file as a hard link and replies that the content need not be sent.
+    If it carries a compression codec, the content is received compressed (see
+    protocol.FRAME_LENGTH); a resumable upload falls back to uncompressed content
+    if the codec is not installed. If it carries a stripe, the connection receives
+    one range of a file sent over several connections (see StripeStore).
+    If it carries a checksum algorithm, the content is checksummed while it is
+    received, and verified against the checksum that follows it.
+
     Args:
-        connection: A dictionary containing connection-specific information.
+        connection: The state of the connection.
         client_socket: The socket connected to the client.
-        directory: The directory where the file will be saved.
+        epoll: The epoll object for managing multiple connections.
+        descriptor_no: The file descriptor number for the connection.
+        filename_index: The index of the filenames in the storage directory.
+        partial_store: The store of the partially received files.
+        stripe_store: The store of the striped uploads.
+        content_index: The index of the stored files by content hash.
+        receiver: The receiver moving data from the socket to the file (unused).
+        journal: The journal of the received files' attributes.
+        writer_pool: The pool writing the files, None to write them on the loop thread.
+        limiter: The limiter of the receive rates (unused, see INPUT_HANDLERS).
+        metrics: The metrics to update, None if they are off.
     """
     try:
-        filename, filesize = receive_metadata(client_socket, directory)
-        filepath = os.path.join(directory, filename)
-        file = open(filepath, "wb")
-        connection.update(
-            {
-                "state": "RECEIVE_FILE",
-                "file": file,
-                "filename": filename,
-                "filesize": filesize,
-            }
+        metadata = receive_metadata(connection, client_socket)
+        if not metadata:
+            return
+        if metrics:
+            metrics.metadata_seconds.observe(
+                time.perf_counter() - connection.metadata_started
+            )
+
+        filename, filesize, fields = metadata
+        sequence = int(fields["seq"]) if "seq" in fields else None
+        transfer_id = fields.get("tid")
+        content_hash = fields.get("hash")
+        if transfer_id and content_hash:
+            linked_filename = content_index.link(
+                content_hash, filesize, filename, filename_index
+            )
+            if linked_filename:
+                peer = connection.peer
+                journal.append(
+                    linked_filename, filesize, f"{peer[0]}:{peer[1]}", 0.0, content_hash
+                )
+                logging.info(f"Saved {linked_filename} from {peer} as a duplicate")
+
+                connection.outgoing += protocol.encode_reply(
+                    protocol.REPLY_DUPLICATE, sequence or 0
+                )
+                connection.outgoing += protocol.LEGACY_ACK
+                connection.state = State.CLOSING
+                send_replies(connection, client_socket, epoll, descriptor_no)
+                return
+
+        codec = fields.get("codec")
+        if codec and not compression.is_available(codec):
+            if not transfer_id:
+                raise ValueError(f"Unsupported compression codec: {codec}")
+            codec = None
+
+        stripe = None
+        end = filesize
+        partial_name = transfer_id
+        if "stripe" in fields:
+            if not transfer_id or codec:
+                raise ValueError("A stripe requires a transfer ID and no codec")
+            index, count = protocol.parse_stripe(fields["stripe"])
+            file, offset, end = stripe_store.open(transfer_id, filesize, index, count)
+            stripe = (index, count, filesize)
+        elif transfer_id:
+            file, offset = partial_store.open(transfer_id, filename, filesize)
+            connection.outgoing += protocol.encode_reply(
+                (
+                    protocol.REPLY_READY
+                    if codec or "codec" not in fields
+                    else protocol.REPLY_READY_RAW
+                ),
+                sequence or 0,
+                offset,
+            )
+            send_replies(connection, client_socket, epoll, descriptor_no)
+        else:
+            file, partial_name = partial_store.create(filesize)
+            offset = 0
+
+        algorithm = fields.get("sum")
+        if algorithm and not checksum.is_available(algorithm):
+            logging.warning(f"Cannot verify {filename}, {algorithm} is not installed")
+
+        logging.info(f"Receiving {filename} ({filesize} bytes)")
+        connection.state = State.RECEIVE_FILE
+        connection.file = file
+        connection.filename = filename
+        # A stripe is received from its start offset up to its end offset
+        connection.filesize = end
+        connection.received = offset
+        connection.started = time.perf_counter()
+        connection.sequence = sequence
+        connection.transfer_id = transfer_id
+        connection.partial_name = partial_name
+        connection.stripe = stripe
+        connection.content_hash = content_hash
+        # Hashed while received unless resumed, so it needs no verification pass
+        connection.content_digest = (
+            protocol.create_content_digest()
+            if content_hash and not stripe and not offset
+            else None
+        )
+        connection.writes = (
+            writer_pool.open(file, descriptor_no) if writer_pool else None
+        )
+        connection.decompressor = codec and compression.create_decompressor(codec)
+        connection.checksum_algorithm = algorithm
+        connection.checksum = (
+            checksum.create_checksum(algorithm)
+            if algorithm and checksum.is_available(algorithm)
+            else None
         )
+        connection.checksum_start = connection.hashed = offset
+    except EOFError:
+        if (
+            connection.state is State.RECEIVE_METADATA_LENGTH
+            and connection.sequence is not None
+        ):
+            # The client has sent all files of a pipelined transfer
+            connection.state = State.CLOSING
+            send_replies(connection, client_socket, epoll, descriptor_no)
+        else:
+            logging.warning(f"Connection closed by client: {connection.peer}")
+            cleanup_connection(connection, client_socket, epoll, descriptor_no)
     except Exception as e:
         logging.error(f"Error in metadata reception: {e}")
-        cleanup_connection(connection, client_socket)
+        cleanup_connection(connection, client_socket, epoll, descriptor_no)
 
 
 def handle_file_reception(
-    connection: dict[str],
+    connection: Connection,
     client_socket: socket.socket,
     epoll: select.epoll,
     descriptor_no: int,
-    directory: str,
-    bufsize: int,
+    filename_index: FilenameIndex,
+    partial_store: PartialStore,
+    stripe_store: StripeStore,
+    content_index: ContentIndex,
+    receiver: "receive_engine.SpliceReceiver | receive_engine.BufferReceiver",
+    journal: "AttributeJournal | AttributeStore",
+    writer_pool: WriterPool | None,
+    limiter: RateLimiter | None,
+    metrics: Metrics | None,
 ) -> None:
     """
     Handles the reception of the actual file data from the client.
 
+    The data is moved from the socket to the file by the receiver without being
+    turned into Python objects (see receive_engine), unless it is compressed and
+    must be decompressed (see receive_engine.receive_compressed). If the file is written by
+    the writer pool, the socket stops being read while the queue of the file is
+    over the high-water mark, and the file is completed once the queue is drained.
+    A file whose checksum does not match is discarded and rejected. A connection
+    out of tokens of the rate limiter is parked until its buckets open again.
+
     Args:
-        connection: A dictionary containing connection-specific information.
+        connection: The state of the connection.
         client_socket: The socket connected to the client.
         epoll: The epoll object for managing multiple connections.
         descriptor_no: The file descriptor number for the connection.
-        directory: The directory where the file will be saved.
-        bufsize: The buffer size for receiving data.
+        filename_index: The index of the filenames in the storage directory.
+        partial_store: The store of the partially received files.
+        stripe_store: The store of the striped uploads.
+        content_index: The index of the stored files by content hash.
+        receiver: The receiver moving data from the socket to the file.
+        journal: The journal of the received files' attributes.
+        writer_pool: The pool writing the files (unused, see INPUT_HANDLERS).
+        limiter: The limiter of the receive rates, None if the rates are unlimited.
+        metrics: The metrics to update, None if they are off.
     """
     try:
-        chunk = client_socket.recv(bufsize)
-        if chunk:
-            connection["file"].write(chunk)
-            connection["received"] += len(chunk)
-            if connection["received"] == connection["filesize"]:
-                finalize_file_reception(connection, directory)
-                cleanup_connection(
-                    connection, client_socket, epoll, descriptor_no, True
+        writes = connection.writes
+        if writes and writes.error:
+            raise writes.error
+
+        remaining = connection.filesize - connection.received
+        count = remaining
+        if limiter and remaining:
+            count = min(remaining, limiter.allowance(connection))
+            if not count:
+                throttle_input(connection, epoll, descriptor_no, True)
+                limiter.park(connection)
+                return
+
+        if connection.decompressor:
+            # A whole frame is received, the limiter is charged its excess later
+            received = remaining and receive_engine.receive_compressed(
+                connection, client_socket, remaining
+            )
+        else:
+            received = remaining and receiver.receive(connection, client_socket, count)
+        if received or not remaining:
+            connection.received += received
+            if limiter:
+                limiter.charge(connection, received)
+            if metrics:
+                metrics.bytes_received_total += received
+            if writes and (
+                connection.received == connection.filesize or writes.over_high_water
+            ):
+                if not writes.notify_when_drained():
+                    # Resumed by handle_drained_files()
+                    watch_input(connection, epoll, descriptor_no, False)
+                    return
+                if writes.error:
+                    raise writes.error
+
+            if connection.received == connection.filesize:
+                if not receive_checksum(connection, client_socket):
+                    return
+                complete_file_reception(
+                    connection,
+                    client_socket,
+                    epoll,
+                    descriptor_no,
+                    filename_index,
+                    partial_store,
+                    stripe_store,
+                    content_index,
+                    journal,
+                    metrics,
                 )
         else:
-            logging.warning(
-                f"Connection closed by client: {client_socket.getpeername()}"
-            )
+            logging.warning(f"Connection closed by client: {connection.peer}")
+            abort_file_reception(connection, partial_store, metrics)
             cleanup_connection(connection, client_socket, epoll, descriptor_no)
-            os.remove(os.path.join(directory, connection["filename"]))
     except BlockingIOError:
         return
+    except protocol.ChecksumMismatchError as e:
+        logging.error(f"Error in file reception: {e}")
+        reject_file_reception(
+            connection,
+            client_socket,
+            epoll,
+            descriptor_no,
+            partial_store,
+            metrics,
+        )
     except Exception as e:
         logging.error(f"Error in file reception: {e}")
+        abort_file_reception(connection, partial_store, metrics)
+        cleanup_connection(connection, client_socket, epoll, descriptor_no)
+
+
+def receive_checksum(connection: Connection, client_socket: socket.socket) -> bool:
+    """
+    Receives the checksum that follows the content of a file, if the metadata
+    announced one, and compares it with the checksum of the received content.
+
+    Args:
+        connection: The state of the connection.
+        client_socket: The socket connected to the client.
+
+    Returns:
+        True if the content is verified or has no checksum, False if the checksum
+        has not been received completely yet.
+
+    Raises:
+        ChecksumMismatchError: If the checksums differ.
+        ConnectionError: If the client closed the connection in the middle.
+    """
+    if not connection.checksum_algorithm:
+        return True
+
+    connection.state = State.RECEIVE_CHECKSUM
+    if not receive_partial(connection, client_socket, protocol.CHECKSUM.size):
+        return False
+
+    (expected,) = protocol.CHECKSUM.unpack(connection.partial)
+    connection.partial.clear()
+    if connection.checksum and connection.checksum.intdigest() != expected:
+        raise protocol.ChecksumMismatchError(
+            f"Checksum mismatch of {connection.filename}: "
+            f"{connection.checksum.intdigest():#x} != {expected:#x}"
+        )
+
+    return True
+
+
+def reject_file_reception(
+    connection: Connection,
+    client_socket: socket.socket,
+    epoll: select.epoll,
+    descriptor_no: int,
+    partial_store: PartialStore,
+    metrics: Metrics | None,
+) -> None:
+    """
+    Discards a file whose checksum does not match, see abort_file_reception(),
+    and replies with the mismatch instead of the acknowledgement. A resumable
+    upload keeps the content received before this connection.
+
+    Args:
+        connection: The state of the connection.
+        client_socket: The socket connected to the client.
+        epoll: The epoll object for managing multiple connections.
+        descriptor_no: The file descriptor number for the connection.
+        partial_store: The store of the partially received files.
+        metrics: The metrics to update, None if they are off.
+    """
+    connection.received = connection.checksum_start
+    abort_file_reception(connection, partial_store, metrics)
+    connection.outgoing += protocol.encode_reply(
+        protocol.REPLY_CHECKSUM_MISMATCH,
+        connection.sequence or 0,
+        connection.checksum.intdigest(),
+    )
+
+    if connection.sequence is None:
+        connection.state = State.CLOSING
+    else:
+        # Pipelined transfer: wait for the next file
+        connection.wait_for_next_file()
+        watch_input(connection, epoll, descriptor_no, True)
+    send_replies(connection, client_socket, epoll, descriptor_no)
+
+
+def complete_file_reception(
+    connection: Connection,
+    client_socket: socket.socket,
+    epoll: select.epoll,
+    descriptor_no: int,
+    filename_index: FilenameIndex,
+    partial_store: PartialStore,
+    stripe_store: StripeStore,
+    content_index: ContentIndex,
+    journal: "AttributeJournal | AttributeStore",
+    metrics: Metrics | None,
+) -> None:
+    """
+    Completes a received file and acknowledges it: closes a single-file connection,
+    or waits for the next file of a pipelined one.
+
+    A commit waiting for the disk runs on the sync thread of the FileSync, so it
+    never stalls the other connections; the connection is not read meanwhile, and
+    handle_committed_files() records and acknowledges the file once it is done.
+
+    Args:
+        connection: The state of the connection.
+        client_socket: The socket connected to the client.
+        epoll: The epoll object for managing multiple connections.
+        descriptor_no: The file descriptor number for the connection.
+        filename_index: The index of the filenames in the storage directory.
+        partial_store: The store of the partially received files.
+        stripe_store: The store of the striped uploads.
+        content_index: The index of the stored files by content hash.
+        journal: The journal of the received files' attributes.
+        metrics: The metrics to update, None if they are off.
+    """
+    # The queue of a file written by the writer pool is drained already
+    connection.writes = None
+    connection.file.close()
+
+    file_sync = partial_store.file_sync
+    if file_sync.deferred:
+        connection.state = State.COMMITTING
+        watch_input(connection, epoll, descriptor_no, False)
+        file_sync.commit_later(
+            lambda: commit_file_reception(
+                connection, filename_index, partial_store, stripe_store
+            ),
+            connection,
+        )
+        return
+
+    filename = commit_file_reception(
+        connection, filename_index, partial_store, stripe_store
+    )
+    record_file_reception(connection, filename, content_index, journal, metrics)
+    acknowledge_file_reception(connection, client_socket, epoll, descriptor_no)
+
+
+def acknowledge_file_reception(
+    connection: Connection,
+    client_socket: socket.socket,
+    epoll: select.epoll,
+    descriptor_no: int,
+) -> None:
+    """
+    Acknowledges a completed file: closes a single-file connection, or waits for
+    the next file of a pipelined one.
+
+    Args:
+        connection: The state of the connection.
+        client_socket: The socket connected to the client.
+        epoll: The epoll object for managing multiple connections.
+        descriptor_no: The file descriptor number for the connection.
+    """
+    if connection.sequence is None:
+        cleanup_connection(connection, client_socket, epoll, descriptor_no, True)
+        return
+
+    # Pipelined transfer: acknowledge the file and wait for the next one
+    connection.outgoing += protocol.encode_reply(
+        protocol.REPLY_ACK, connection.sequence
+    )
+    connection.wait_for_next_file()
+    watch_input(connection, epoll, descriptor_no, True)
+    send_replies(connection, client_socket, epoll, descriptor_no)
+
+
+def abort_file_reception(
+    connection: Connection,
+    partial_store: PartialStore,
+    metrics: Metrics | None,
+) -> None:
+    """
+    Handles an interrupted file reception: keeps the partial file of a resumable
+    upload, persisting its received offset, or removes the file otherwise.
+    The file of a striped upload is kept for the stripe to be sent again.
+
+    A file written by the writer pool is handled by a writer thread once its
+    queued buffers are written.
+
+    Args:
+        connection: The state of the connection.
+        partial_store: The store of the partially received files.
+        metrics: The metrics to update, None if they are off.
+    """
+    if metrics:
+        metrics.files_failed_total += 1
+
+    transfer_id = connection.transfer_id
+    partial_name = connection.partial_name
+    stripe = connection.stripe
+    filename = connection.filename
+    filesize = connection.filesize
+    received = connection.received
+
+    def discard() -> None:
+        if stripe:
+            return
+        if transfer_id:
+            partial_store.save(transfer_id, filename, filesize, received)
+            return
+        partial_store.discard(partial_name)
+
+    if connection.writes:
+        connection.writes.close(discard)
+        connection.writes = connection.file = None
+        return
+
+    connection.file.close()
+    discard()
+
+
+def watch_input(
+    connection: Connection, epoll: select.epoll, descriptor_no: int, watching: bool
+) -> None:
+    """
+    Starts or stops watching the socket for EPOLLIN, e.g. while the queue of
+    the connection's file is drained by the writer pool.
+
+    Args:
+        connection: The state of the connection.
+        epoll: The epoll object for managing multiple connections.
+        descriptor_no: The file descriptor number for the connection.
+        watching: Whether the socket is to be read.
+    """
+    paused = not watching
+    if connection.paused == paused:
+        return
+
+    connection.paused = paused
+    update_events(connection, epoll, descriptor_no)
+
+
+def throttle_input(
+    connection: Connection, epoll: select.epoll, descriptor_no: int, throttled: bool
+) -> None:
+    """
+    Stops or starts again watching the socket for EPOLLIN while the connection
+    is out of tokens, see RateLimiter.
+
+    Args:
+        connection: The state of the connection.
+        epoll: The epoll object for managing multiple connections.
+        descriptor_no: The file descriptor number for the connection.
+        throttled: Whether the socket is to be left unread.
+    """
+    if connection.throttled == throttled:
+        return
+
+    connection.throttled = throttled
+    update_events(connection, epoll, descriptor_no)
+
+
+def update_events(
+    connection: Connection, epoll: select.epoll, descriptor_no: int
+) -> None:
+    """
+    Watches the socket for the events the connection waits for: EPOLLIN unless
+    the connection is CLOSING, paused or throttled, EPOLLOUT while replies are left.
+
+    Args:
+        connection: The state of the connection.
+        epoll: The epoll object for managing multiple connections.
+        descriptor_no: The file descriptor number for the connection.
+    """
+    reading = not (
+        connection.state is State.CLOSING or connection.paused or connection.throttled
+    )
+    epoll.modify(
+        descriptor_no,
+        (select.EPOLLIN if reading else 0)
+        | (select.EPOLLOUT if connection.watching_output else 0),
+    )
+
+
+def handle_drained_files(
+    connections: dict[int, Connection],
+    epoll: select.epoll,
+    filename_index: FilenameIndex,
+    partial_store: PartialStore,
+    stripe_store: StripeStore,
+    content_index: ContentIndex,
+    journal: "AttributeJournal | AttributeStore",
+    writer_pool: WriterPool,
+    guard: ConnectionGuard,
+    limiter: RateLimiter | None,
+    metrics: Metrics | None,
+) -> None:
+    """
+    Resumes the connections whose files the writer pool has drained: completes
+    the fully received files, and reads the sockets of the others again.
+
+    Args:
+        connections: The connections by file descriptor number.
+        epoll: The epoll object for managing multiple connections.
+        filename_index: The index of the filenames in the storage directory.
+        partial_store: The store of the partially received files.
+        stripe_store: The store of the striped uploads.
+        content_index: The index of the stored files by content hash.
+        journal: The journal of the received files' attributes.
+        writer_pool: The pool writing the files.
+        guard: The guard capping and timing out the connections.
+        limiter: The limiter of the receive rates, None if the rates are unlimited.
+        metrics: The metrics to update, None if they are off.
+    """
+    for writes in writer_pool.drained():
+        connection = connections.get(writes.descriptor_no)
+        if not connection or connection.writes is not writes:
+            continue  # aborted in the meantime
+
+        descriptor_no = writes.descriptor_no
+        client_socket = connection.socket
+        if writes.error:
+            logging.error(f"Error writing {connection.filename}: {writes.error}")
+            abort_file_reception(connection, partial_store, metrics)
+            cleanup_connection(connection, client_socket, epoll, descriptor_no)
+        elif (
+            connection.received == connection.filesize
+            and not connection.checksum_algorithm
+        ):
+            complete_file_reception(
+                connection,
+                client_socket,
+                epoll,
+                descriptor_no,
+                filename_index,
+                partial_store,
+                stripe_store,
+                content_index,
+                journal,
+                metrics,
+            )
+        else:
+            # A file followed by its checksum is completed by handle_file_reception()
+            watch_input(connection, epoll, descriptor_no, True)
+
+        if connection.state is State.CLOSED:
+            release_connection(connection, descriptor_no, connections, guard, limiter)
+
+
+def handle_committed_files(
+    connections: dict[int, Connection],
+    epoll: select.epoll,
+    partial_store: PartialStore,
+    content_index: ContentIndex,
+    journal: "AttributeJournal | AttributeStore",
+    guard: ConnectionGuard,
+    limiter: RateLimiter | None,
+    metrics: Metrics | None,
+) -> None:
+    """
+    Records and acknowledges the files the sync thread has committed, see
+    complete_file_reception(). A file whose client hung up in the meantime is
+    still recorded, as it is saved.
+
+    Args:
+        connections: The connections by file descriptor number.
+        epoll: The epoll object for managing multiple connections.
+        partial_store: The store of the partially received files.
+        content_index: The index of the stored files by content hash.
+        journal: The journal of the received files' attributes.
+        guard: The guard capping and timing out the connections.
+        limiter: The limiter of the receive rates, None if the rates are unlimited.
+        metrics: The metrics to update, None if they are off.
+    """
+    for connection, filename, error in partial_store.file_sync.committed():
+        client_socket = connection.socket
+        descriptor_no = client_socket.fileno()
+        if error:
+            logging.error(f"Error committing {connection.filename}: {error}")
+            abort_file_reception(connection, partial_store, metrics)
+            if connection.state is not State.CLOSED:
+                cleanup_connection(connection, client_socket, epoll, descriptor_no)
+        else:
+            record_file_reception(connection, filename, content_index, journal, metrics)
+            if connection.state is not State.CLOSED:
+                acknowledge_file_reception(
+                    connection, client_socket, epoll, descriptor_no
+                )
+
+        # A connection closed before is released already, with a socket number of -1
+        if connection.state is State.CLOSED and descriptor_no in connections:
+            release_connection(connection, descriptor_no, connections, guard, limiter)
+
+
+def send_replies(
+    connection: Connection,
+    client_socket: socket.socket,
+    epoll: select.epoll,
+    descriptor_no: int,
+) -> None:
+    """
+    Sends as much of the queued replies as the socket accepts without blocking.
+    Watches the socket for EPOLLOUT while some replies are left, and closes a
+    CLOSING connection once all of them are sent.
+
+    Args:
+        connection: The state of the connection.
+        client_socket: The socket connected to the client.
+        epoll: The epoll object for managing multiple connections.
+        descriptor_no: The file descriptor number for the connection.
+    """
+    outgoing = connection.outgoing
+    try:
+        if outgoing:
+            del outgoing[: client_socket.send(outgoing)]
+    except BlockingIOError:
+        pass
+    except Exception as e:
+        logging.error(f"Error sending replies: {e}")
         cleanup_connection(connection, client_socket, epoll, descriptor_no)
+        return
+
+    if not outgoing and connection.state is State.CLOSING:
+        cleanup_connection(connection, client_socket, epoll, descriptor_no)
+    elif bool(outgoing) != connection.watching_output:
+        connection.watching_output = bool(outgoing)
+        update_events(connection, epoll, descriptor_no)
 
 
 def cleanup_connection(
-    connection: dict[str],
+    connection: Connection,
     client_socket: socket.socket,
     epoll: select.epoll = None,
     descriptor_no: int = None,
@@ -190,45 +872,198 @@ def cleanup_connection(
     and unregistering from epoll if provided.
 
     Args:
-        connection: A dictionary containing connection-specific information.
+        connection: The state of the connection.
         client_socket: The socket connected to the client.
         epoll: The epoll object for managing multiple connections (optional).
         descriptor_no: The file descriptor number for the connection (optional).
         success: A flag indicating whether the file reception was successful.
     """
+    connection.state = State.CLOSED
     try:
-        if connection["file"]:
-            connection["file"].close()
+        if connection.writes:
+            connection.writes.close()
+        elif connection.file:
+            connection.file.close()
         if epoll and descriptor_no:
             epoll.unregister(descriptor_no)
         if success:
-            client_socket.sendall(b"1")
+            client_socket.sendall(protocol.LEGACY_ACK)
 
-        logging.info(f"Closed connection from {client_socket.getpeername()}")
+        logging.info(f"Closed connection from {connection.peer}")
         client_socket.close()
     except Exception as e:
         logging.error(f"Error in cleanup: {e}")
 
 
-def finalize_file_reception(connection: dict[str], directory: str) -> None:
+def release_connection(
+    connection: Connection,
+    descriptor_no: int,
+    connections: dict[int, Connection],
+    guard: ConnectionGuard,
+    limiter: RateLimiter | None,
+) -> None:
+    """
+    Forgets a closed connection, so its descriptor number can be reused.
+
+    Args:
+        connection: The state of the connection.
+        descriptor_no: The file descriptor number the connection had.
+        connections: The connections by file descriptor number.
+        guard: The guard capping and timing out the connections.
+        limiter: The limiter of the receive rates, None if the rates are unlimited.
+    """
+    del connections[descriptor_no]
+    guard.release(connection)
+    if limiter:
+        limiter.release(connection)
+
+
+def time_out_connections(
+    guard: ConnectionGuard,
+    limiter: RateLimiter | None,
+    now: float,
+    connections: dict[int, Connection],
+    epoll: select.epoll,
+    partial_store: PartialStore,
+    metrics: Metrics | None,
+) -> None:
+    """
+    Closes the connections past one of their timeouts, keeping the partial files
+    of resumable uploads like any other interrupted reception.
+
+    Args:
+        guard: The guard capping and timing out the connections.
+        limiter: The limiter of the receive rates, None if the rates are unlimited.
+        now: The current perf_counter() time.
+        connections: The connections by file descriptor number.
+        epoll: The epoll object for managing multiple connections.
+        partial_store: The store of the partially received files.
+        metrics: The metrics to update, None if they are off.
+    """
+    for connection in guard.expired(now):
+        logging.warning(
+            f"Connection from {connection.peer} timed out in {connection.state.name}"
+        )
+        if metrics:
+            metrics.connections_timed_out_total += 1
+
+        descriptor_no = connection.socket.fileno()
+        if connection.state in (State.RECEIVE_FILE, State.RECEIVE_CHECKSUM):
+            abort_file_reception(connection, partial_store, metrics)
+        cleanup_connection(connection, connection.socket, epoll, descriptor_no)
+        release_connection(connection, descriptor_no, connections, guard, limiter)
+
+
+def wake_connections(limiter: RateLimiter, now: float, epoll: select.epoll) -> None:
     """
-    Finalizes the file reception by closing the file and logging the received file's details.
+    Watches the sockets of the parked connections due to be woken up again.
 
     Args:
-        connection: A dictionary containing connection-specific information.
-        directory: The directory where the file is saved.
+        limiter: The limiter of the receive rates.
+        now: The current perf_counter() time.
+        epoll: The epoll object for managing multiple connections.
+    """
+    for connection in limiter.woken(now):
+        if connection.state is not State.CLOSED:
+            throttle_input(connection, epoll, connection.socket.fileno(), False)
+
+
+def commit_file_reception(
+    connection: Connection,
+    filename_index: FilenameIndex,
+    partial_store: PartialStore,
+    stripe_store: StripeStore,
+) -> str | None:
     """
-    connection["file"].close()
-    attributes_file_path = os.path.join(directory, "file_attributes.csv")
-    with open(attributes_file_path, "a", newline="") as attr_file:
-        if not os.path.getsize(attributes_file_path):
-            csv.writer(attr_file).writerow(("Timestamp", "Filename"))
+    Moves a completely received and closed file to the storage directory. A stripe
+    of a striped upload is only marked as received, unless it completes the file.
+    Runs on the sync thread when the commit waits for the disk, so it only reads
+    the connection.
+
+    Args:
+        connection: The state of the connection.
+        filename_index: The index of the filenames in the storage directory.
+        partial_store: The store of the partially received files.
+        stripe_store: The store of the striped uploads.
 
-        csv.writer(attr_file).writerow(
-            (datetime.now().isoformat(), connection["filename"])
+    Returns:
+        The unique filename the file is saved under, None if the stripe did not
+        complete it.
+    """
+    if connection.stripe:
+        index, count, _ = connection.stripe
+        return stripe_store.finish(
+            connection.transfer_id,
+            connection.filename,
+            index,
+            count,
+            filename_index,
         )
+
+    return partial_store.commit(
+        connection.partial_name, connection.filename, filename_index
+    )
+
+
+def record_file_reception(
+    connection: Connection,
+    filename: str | None,
+    content_index: ContentIndex,
+    journal: "AttributeJournal | AttributeStore",
+    metrics: Metrics | None,
+) -> None:
+    """
+    Records a committed file by logging its details and appending them to the
+    journal. A stripe of a striped upload is only logged, unless it completed the file.
+
+    Args:
+        connection: The state of the connection.
+        filename: The unique filename the file is saved under, None if the stripe
+            did not complete it.
+        content_index: The index of the stored files by content hash.
+        journal: The journal of the received files' attributes.
+        metrics: The metrics to update, None if they are off.
+    """
+    duration = time.perf_counter() - connection.started
+    peer = connection.peer
+    if metrics:
+        metrics.transfer_seconds.observe(duration)
+    if connection.stripe:
+        index, count, filesize = connection.stripe
+        start, end = protocol.stripe_range(filesize, index, count)
+        logging.info(
+            f"Received stripe {index + 1}/{count} of {connection.filename} "
+            f"from {peer} ({end - start} bytes in {duration:.3f} s)"
+        )
+        if filename:
+            if metrics:
+                metrics.files_received_total += 1
+                metrics.file_size_bytes.observe(filesize)
+            journal.append(filename, filesize, f"{peer[0]}:{peer[1]}", duration)
+            logging.info(f"Saved {filename} from {peer} ({filesize} bytes, striped)")
+        return
+
+    connection.filename = filename
+    content_hash = None
+    if connection.content_hash:
+        content_hash = content_index.add(
+            connection.content_hash, connection.filename, connection.content_digest
+        )
+    if metrics:
+        metrics.files_received_total += 1
+        metrics.file_size_bytes.observe(connection.received)
+
+    journal.append(
+        connection.filename,
+        connection.received,
+        f"{peer[0]}:{peer[1]}",
+        duration,
+        content_hash,
+    )
     logging.info(
-        f"Saved {connection['filename']} from {connection['socket'].getpeername()}"
+        f"Saved {connection.filename} from {peer} "
+        f"({connection.received} bytes in {duration:.3f} s, "
+        f"{connection.received / max(duration, 1e-9) / 2**20:.1f} MiB/s)"
     )
 
 
@@ -237,71 +1072,353 @@ def handle_event(
     event: int,
     epoll: select.epoll,
     server_socket: socket.socket,
-    connections: dict[int, dict[str]],
-    directory: str,
-    bufsize: int,
+    connections: dict[int, Connection],
+    filename_index: FilenameIndex,
+    partial_store: PartialStore,
+    stripe_store: StripeStore,
+    content_index: ContentIndex,
+    receiver: "receive_engine.SpliceReceiver | receive_engine.BufferReceiver",
+    journal: "AttributeJournal | AttributeStore",
+    writer_pool: WriterPool | None,
+    guard: ConnectionGuard,
+    limiter: RateLimiter | None,
+    now: float,
+    metrics_endpoint: MetricsEndpoint | None,
 ) -> None:
     """
-    Handles different events such as new connections and data reception.
+    Handles different events such as new connections, data reception,
+    files drained by the writer pool and metrics scrapes.
 
     Args:
         descriptor_no: The file descriptor number for the connection.
         event: The event mask indicating the type of event.
         epoll: The epoll object for managing multiple connections.
         server_socket: The server socket accepting new connections.
-        connections: A dictionary tracking active connections.
-        directory: The directory where the file will be saved.
-        bufsize: The buffer size for receiving data.
+        connections: The connections by file descriptor number.
+        filename_index: The index of the filenames in the storage directory.
+        partial_store: The store of the partially received files.
+        stripe_store: The store of the striped uploads.
+        content_index: The index of the stored files by content hash.
+        receiver: The receiver moving data from the socket to the file.
+        journal: The journal of the received files' attributes.
+        writer_pool: The pool writing the files, None to write them on the loop thread.
+        guard: The guard capping and timing out the connections.
+        limiter: The limiter of the receive rates, None if the rates are unlimited.
+        now: The perf_counter() time the event was polled at.
+        metrics_endpoint: The endpoint serving the metrics to update, None if they
+            are off.
     """
+    metrics = metrics_endpoint.metrics if metrics_endpoint else None
     if descriptor_no == server_socket.fileno():
-        handle_new_connection(epoll, server_socket, connections)
-    elif event & select.EPOLLIN:
-        connection = connections[descriptor_no]
-        client_socket = connection["socket"]
-
-        if connection["state"] == "RECEIVE_METADATA":
-            handle_metadata_reception(connection, client_socket, directory)
-        if connection["state"] == "RECEIVE_FILE":
-            handle_file_reception(
+        handle_new_connection(
+            epoll, server_socket, connections, guard, limiter, metrics
+        )
+        return
+    if metrics_endpoint and metrics_endpoint.owns(descriptor_no):
+        metrics_endpoint.handle_event(descriptor_no, connections)
+        return
+    if writer_pool and descriptor_no == writer_pool.fileno():
+        handle_drained_files(
+            connections,
+            epoll,
+            filename_index,
+            partial_store,
+            stripe_store,
+            content_index,
+            journal,
+            writer_pool,
+            guard,
+            limiter,
+            metrics,
+        )
+        return
+    if descriptor_no == partial_store.file_sync.fileno():
+        handle_committed_files(
+            connections,
+            epoll,
+            partial_store,
+            content_index,
+            journal,
+            guard,
+            limiter,
+            metrics,
+        )
+        return
+
+    connection = connections.get(descriptor_no)
+    if not connection:
+        return  # released by an earlier event of the same poll, e.g. a drained file
+    client_socket = connection.socket
+    connection.last_activity = now
+
+    if event & select.EPOLLOUT:
+        send_replies(connection, client_socket, epoll, descriptor_no)
+    if event & select.EPOLLIN:
+        handler = INPUT_HANDLERS.get(connection.state)
+        if handler and not (connection.paused or connection.throttled):
+            arguments = (
                 connection,
                 client_socket,
                 epoll,
                 descriptor_no,
-                directory,
-                bufsize,
+                filename_index,
+                partial_store,
+                stripe_store,
+                content_index,
+                receiver,
+                journal,
+                writer_pool,
+                limiter,
+                metrics,
             )
+            handler(*arguments)
+            # The content may have arrived along with the metadata
+            if (
+                handler is handle_metadata_reception
+                and connection.state is State.RECEIVE_FILE
+            ):
+                handle_file_reception(*arguments)
+    elif event & (select.EPOLLHUP | select.EPOLLERR):
+        if connection.state is State.CLOSING:
+            cleanup_connection(connection, client_socket, epoll, descriptor_no)
+        elif connection.state is not State.CLOSED and (
+            connection.paused or connection.throttled
+        ):
+            # Not watched for input, so no receive fails on the reset connection
+            logging.warning(f"Connection from {connection.peer} reset while waiting")
+            if connection.state in (State.RECEIVE_FILE, State.RECEIVE_CHECKSUM):
+                abort_file_reception(connection, partial_store, metrics)
+            cleanup_connection(connection, client_socket, epoll, descriptor_no)
+
+    if connection.state is State.CLOSED:
+        release_connection(connection, descriptor_no, connections, guard, limiter)
+
+
+# The handlers of the input of every state, taking the same arguments. A CLOSING
+# connection only sends its replies, and a CLOSED one is not watched anymore
+INPUT_HANDLERS = {
+    State.RECEIVE_METADATA_LENGTH: handle_metadata_reception,
+    State.RECEIVE_METADATA_BODY: handle_metadata_reception,
+    State.RECEIVE_FILE: handle_file_reception,
+    State.RECEIVE_CHECKSUM: handle_file_reception,
+}
 
 
-def start_server(directory: str, host: str, port: int) -> None:
+def create_server_socket(
+    host: str, port: int, reuse_port: bool = False
+) -> socket.socket:
     """
-    Starts the file transfer server, setting up the server socket, epoll object,
-    and entering the main event loop.
+    Creates a non-blocking listening server socket.
 
     Args:
-        directory: The directory where the file will be saved.
         host: The host address to bind the server to.
         port: The port number to bind the server to.
-    """
-    if not os.path.exists(directory):
-        os.makedirs(directory)
+        reuse_port: Whether to set SO_REUSEPORT, letting several processes
+            bind the same port with the kernel balancing connections between them.
 
-    epoll = server_socket = None
+    Returns:
+        The listening server socket.
+
+    Notes:
+        SOCKET_RCVBUF is an environment variable that sets the receive buffer of
+        the connections, 0 leaves it to the kernel's autotuning (see .env). It is
+        set before listen(), so the accepted sockets inherit it and negotiate
+        a window scale large enough for it.
+    """
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     try:
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        receive_buffer = int(os.getenv("SOCKET_RCVBUF"))
+        if receive_buffer:
+            server_socket.setsockopt(
+                socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer
+            )
         server_socket.bind((host, port))
         server_socket.listen(socket.SOMAXCONN)
         server_socket.setblocking(False)
+    except Exception:
+        server_socket.close()
+        raise
+
+    return server_socket
+
+
+def open_attributes(
+    directory: str, attributes: str
+) -> "AttributeJournal | AttributeStore":
+    """
+    Opens the storage of the received files' attributes.
+
+    Args:
+        directory: The directory where the files are saved.
+        attributes: The storage kind: "csv" for the file_attributes.csv journal,
+            "sqlite" for the indexed database (importing the journal once).
+
+    Returns:
+        The journal or store the attributes are appended to.
+    """
+    csv_path = os.path.join(directory, "file_attributes.csv")
+    settings = (
+        int(os.getenv("ATTRIBUTES_FLUSH_RECORDS")),
+        float(os.getenv("ATTRIBUTES_FLUSH_INTERVAL")),
+        os.getenv("ATTRIBUTES_FSYNC"),
+    )
+    if attributes == "sqlite":
+        return AttributeStore(
+            os.path.join(directory, DATABASE_NAME), *settings, csv_path
+        )
+
+    return AttributeJournal(csv_path, *settings)
+
+
+def serve(
+    directory: str,
+    server_socket: socket.socket,
+    filename_index: FilenameIndex,
+    attributes: str,
+    engine: str = "epoll",
+    writer_threads: int = 0,
+    metrics_port: int = 0,
+) -> None:
+    """
+    Runs the event loop of the chosen engine on the server socket.
+
+    Args:
+        directory: The directory where the file will be saved.
+        server_socket: The listening server socket.
+        filename_index: The index of the filenames in the storage directory.
+        attributes: The storage kind of the received files' attributes.
+        engine: The event loop: "epoll" for the hand-rolled one, "asyncio" for
+            the asyncio engine (see async_server).
+        writer_threads: The number of threads writing the files of the epoll engine,
+            0 to write them on the loop thread.
+        metrics_port: The local port serving the metrics of the epoll engine,
+            0 to keep them off.
+    """
+    if engine == "asyncio":
+        if metrics_port:
+            logging.warning("Metrics are only collected by the epoll engine")
+        journal = open_attributes(directory, attributes)
+        try:
+            async_server.serve(directory, server_socket, filename_index, journal)
+        finally:
+            journal.close()
+        return
 
+    serve_epoll(
+        directory,
+        server_socket,
+        filename_index,
+        attributes,
+        writer_threads,
+        metrics_port,
+    )
+
+
+def serve_epoll(
+    directory: str,
+    server_socket: socket.socket,
+    filename_index: FilenameIndex,
+    attributes: str,
+    writer_threads: int = 0,
+    metrics_port: int = 0,
+) -> None:
+    """
+    Sets up the epoll object and runs the main event loop on the server socket.
+    The connections are capped and timed out by a ConnectionGuard, and their
+    receive rates shaped by a RateLimiter, whose limits are set in .env (0 turns
+    a limit off).
+
+    Args:
+        directory: The directory where the file will be saved.
+        server_socket: The listening server socket.
+        filename_index: The index of the filenames in the storage directory.
+        attributes: The storage kind of the received files' attributes.
+        writer_threads: The number of threads writing the files,
+            0 to write them on the loop thread.
+        metrics_port: The port serving the metrics on localhost, 0 to keep them off.
+    """
+    epoll = receiver = journal = content_index = writer_pool = metrics_endpoint = None
+    file_sync = None
+    try:
+        file_sync = FileSync(
+            directory,
+            os.getenv("FILE_FSYNC"),
+            float(os.getenv("FILE_FSYNC_INTERVAL")),
+        )
+        partial_store = PartialStore(
+            directory, float(os.getenv("PARTIAL_TTL")), file_sync
+        )
+        stripe_store = StripeStore(
+            directory, float(os.getenv("PARTIAL_TTL")), file_sync
+        )
+        content_index = ContentIndex(directory)
         epoll = select.epoll()
         epoll.register(server_socket.fileno(), select.EPOLLIN)
 
-        bufsize = int(os.getenv("CONNECTION_BUFSIZE"))
+        if writer_threads:
+            writer_pool = WriterPool(
+                writer_threads, int(os.getenv("WRITER_HIGH_WATER"))
+            )
+            epoll.register(writer_pool.fileno(), select.EPOLLIN)
+        if file_sync.deferred:
+            epoll.register(file_sync.fileno(), select.EPOLLIN)
+
+        receiver = receive_engine.create_receiver(
+            int(os.getenv("CONNECTION_BUFSIZE")), queued=bool(writer_pool)
+        )
+        journal = open_attributes(directory, attributes)
         connections = {}
+        guard = ConnectionGuard(
+            int(os.getenv("MAX_CONNECTIONS")),
+            int(os.getenv("MAX_CONNECTIONS_PER_IP")),
+            float(os.getenv("HEADER_TIMEOUT")),
+            float(os.getenv("IDLE_TIMEOUT")),
+            float(os.getenv("TRANSFER_TIMEOUT")),
+        )
+        rates = (
+            float(os.getenv("MAX_RATE")),
+            float(os.getenv("MAX_RATE_PER_IP")),
+            float(os.getenv("MAX_RATE_PER_CONNECTION")),
+        )
+        limiter = RateLimiter(*rates, receiver.bufsize) if any(rates) else None
+        if metrics_port:
+            metrics_endpoint = MetricsEndpoint(
+                Metrics(), "127.0.0.1", metrics_port, epoll
+            )
+        metrics = metrics_endpoint.metrics if metrics_endpoint else None
 
-        logging.info(f"Server listening on {host}:{port}")
         while True:
-            events = epoll.poll()
+            timeout = min(
+                partial_store.time_until_collection(),
+                stripe_store.time_until_collection(),
+                content_index.time_until_collection(),
+            )
+            for optional_timeout in (
+                journal.time_until_flush(),
+                guard.time_until_check(),
+                file_sync.time_until_sync(),
+                limiter and limiter.time_until_wake(),
+            ):
+                if optional_timeout is not None:
+                    timeout = min(timeout, optional_timeout)
+
+            events = epoll.poll(timeout)
+            now = time.perf_counter()
+            if metrics:
+                metrics.poll_batch_size.observe(len(events))
+            if limiter:
+                limiter.begin_round(
+                    now,
+                    [
+                        connections[descriptor_no]
+                        for descriptor_no, _ in events
+                        if descriptor_no in connections
+                    ],
+                )
+                wake_connections(limiter, now, epoll)
             for descriptor_no, event in events:
                 handle_event(
                     descriptor_no,
@@ -309,16 +1426,229 @@ def start_server(directory: str, host: str, port: int) -> None:
                     epoll,
                     server_socket,
                     connections,
-                    directory,
-                    bufsize,
+                    filename_index,
+                    partial_store,
+                    stripe_store,
+                    content_index,
+                    receiver,
+                    journal,
+                    writer_pool,
+                    guard,
+                    limiter,
+                    now,
+                    metrics_endpoint,
                 )
-    except Exception as e:
-        logging.error(f"Server error: {e}")
+            time_out_connections(
+                guard, limiter, now, connections, epoll, partial_store, metrics
+            )
+            if guard.resume_accepting(now):
+                epoll.modify(server_socket.fileno(), select.EPOLLIN)
+            if metrics:
+                metrics.loop_iteration_seconds.observe(time.perf_counter() - now)
+            journal.flush_if_due()
+            file_sync.sync_if_due()
+            partial_store.collect_if_due()
+            stripe_store.collect_if_due()
+            content_index.collect_if_due()
     finally:
+        if metrics_endpoint:
+            metrics_endpoint.close()
         if epoll:
             epoll.unregister(server_socket.fileno())
             epoll.close()
-        server_socket.close()
+        if writer_pool:
+            writer_pool.close()
+        if file_sync:
+            file_sync.close()
+        if receiver:
+            receiver.close()
+        if journal:
+            journal.close()
+        if content_index:
+            content_index.close()
+
+
+def run_worker(
+    directory: str,
+    host: str,
+    port: int,
+    filename_index: FilenameIndex,
+    attributes: str,
+    engine: str,
+    writer_threads: int,
+    metrics_port: int,
+) -> None:
+    """
+    Runs a worker process with its own SO_REUSEPORT socket and event loop.
+    Never returns: the process exits with a non-zero code if the worker crashes.
+
+    Args:
+        directory: The directory where the file will be saved.
+        host: The host address to bind the server to.
+        port: The port number to bind the server to.
+        filename_index: The index of the filenames in the storage directory.
+        attributes: The storage kind of the received files' attributes.
+        engine: The event loop of the worker, "epoll" or "asyncio".
+        writer_threads: The number of threads writing the files of the epoll engine.
+        metrics_port: The port serving the metrics of the worker, 0 to keep them off.
+    """
+    exit_code = 0
+    try:
+        with create_server_socket(host, port, reuse_port=True) as server_socket:
+            logging.info(f"Worker {os.getpid()} listening on {host}:{port}")
+            serve(
+                directory,
+                server_socket,
+                filename_index,
+                attributes,
+                engine,
+                writer_threads,
+                metrics_port,
+            )
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        logging.error(f"Worker {os.getpid()} error: {e}")
+        exit_code = 1
+    finally:
+        os._exit(exit_code)
+
+
+def supervise_workers(
+    directory: str,
+    host: str,
+    port: int,
+    workers: int,
+    filename_index: FilenameIndex,
+    attributes: str,
+    engine: str,
+    writer_threads: int,
+    metrics_port: int,
+) -> None:
+    """
+    Forks the worker processes and restarts any of them that crashes.
+
+    Args:
+        directory: The directory where the file will be saved.
+        host: The host address to bind the server to.
+        port: The port number to bind the server to.
+        workers: The number of worker processes.
+        filename_index: The index of the filenames in the storage directory,
+            inherited by every worker.
+        attributes: The storage kind of the received files' attributes.
+        engine: The event loop of the workers, "epoll" or "asyncio".
+        writer_threads: The number of threads writing the files of every worker.
+        metrics_port: The metrics port of the first worker, the others serving theirs
+            on the following ports; 0 to keep them off.
+    """
+    # The worker index of every pid, so a restarted worker keeps its metrics port
+    worker_pids = {}
+
+    def spawn_worker(index: int) -> None:
+        pid = os.fork()
+        if not pid:
+            run_worker(
+                directory,
+                host,
+                port,
+                filename_index,
+                attributes,
+                engine,
+                writer_threads,
+                metrics_port + index if metrics_port else 0,
+            )
+        worker_pids[pid] = index
+
+    try:
+        for index in range(workers):
+            spawn_worker(index)
+
+        while worker_pids:
+            pid, status = os.wait()
+            if pid not in worker_pids:
+                continue
+            index = worker_pids.pop(pid)
+
+            exit_code = os.waitstatus_to_exitcode(status)
+            if exit_code:
+                logging.warning(f"Worker {pid} crashed ({exit_code}), restarting")
+                time.sleep(1)  # prevents a restart storm if workers fail on startup
+                spawn_worker(index)
+    finally:
+        for pid in worker_pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except (ChildProcessError, ProcessLookupError):
+                pass
+
+
+def start_server(
+    directory: str,
+    host: str,
+    port: int,
+    workers: int = 1,
+    attributes: str = "csv",
+    engine: str = "epoll",
+    writer_threads: int = 0,
+    metrics_port: int = 0,
+) -> None:
+    """
+    Starts the file transfer server, setting up the server socket, epoll object,
+    and entering the main event loop.
+
+    Args:
+        directory: The directory where the file will be saved.
+        host: The host address to bind the server to.
+        port: The port number to bind the server to.
+        workers: The number of worker processes, each running its own event loop.
+        attributes: The storage kind of the received files' attributes,
+            "csv" or "sqlite".
+        engine: The event loop, "epoll" or "asyncio".
+        writer_threads: The number of threads writing the files of the epoll engine,
+            0 to write them on the loop thread.
+        metrics_port: The port serving the metrics on localhost (one port per worker,
+            starting from it), 0 to keep them off.
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    # Stops the server (and workers) like Ctrl+C, so the attribute journals get flushed
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    filename_index = FilenameIndex(directory)
+    if workers > 1:
+        supervise_workers(
+            directory,
+            host,
+            port,
+            workers,
+            filename_index,
+            attributes,
+            engine,
+            writer_threads,
+            metrics_port,
+        )
+        return
+
+    server_socket = None
+    try:
+        server_socket = create_server_socket(host, port)
+        logging.info(f"Server listening on {host}:{port}")
+        serve(
+            directory,
+            server_socket,
+            filename_index,
+            attributes,
+            engine,
+            writer_threads,
+            metrics_port,
+        )
+    except Exception as e:
+        logging.error(f"Server error: {e}")
+    finally:
+        if server_socket:
+            server_socket.close()
 
 
 def main() -> None:
@@ -337,10 +1667,59 @@ def main() -> None:
         default=12345,
         help="Port to bind the server to (default: 12345)",
     )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes sharing the port (default: 1)",
+    )
+    parser.add_argument(
+        "-a",
+        "--attributes",
+        choices=("csv", "sqlite"),
+        default="csv",
+        help="Storage of the received files' attributes: file_attributes.csv "
+        "or an indexed SQLite database, see attributes_query.py (default: csv)",
+    )
+    parser.add_argument(
+        "-e",
+        "--engine",
+        choices=("epoll", "asyncio"),
+        default="epoll",
+        help="Event loop: the epoll one, or asyncio (with uvloop if installed) "
+        "writing to disk from a thread pool (default: epoll)",
+    )
+    parser.add_argument(
+        "-t",
+        "--writer-threads",
+        type=int,
+        default=0,
+        help="Number of threads writing the files of the epoll engine, for slow "
+        "disks; 0 writes them on the event loop thread (default: 0)",
+    )
+    parser.add_argument(
+        "-m",
+        "--metrics-port",
+        type=int,
+        default=0,
+        help="Port serving Prometheus metrics of the epoll engine at "
+        "http://127.0.0.1:PORT/metrics, one port per worker starting from it; "
+        "0 turns the metrics off (default: 0)",
+    )
     args = parser.parse_args()
 
     try:
-        start_server(os.path.abspath(args.directory), args.host, args.port)
+        start_server(
+            os.path.abspath(args.directory),
+            args.host,
+            args.port,
+            args.workers,
+            args.attributes,
+            args.engine,
+            args.writer_threads,
+            args.metrics_port,
+        )
     except Exception as e:
         logging.error(f"Failed to start server: {e}")
 
@@ -0,0 +1,154 @@
+import fcntl
+import io
+import logging
+import os
+import time
+
+import protocol
+from disk_writer import FileSync, preallocate
+from filename_index import FilenameIndex
+from partial_store import COLLECTION_INTERVAL, TRANSFER_ID_PATTERN
+
+STRIPES_DIRECTORY = ".stripes"
+
+
+class StripeStore:
+    """
+    Keeps the files of striped uploads, whose ranges (stripes) arrive over several
+    connections at once, until every stripe has arrived.
+
+    Every upload is stored preallocated under its transfer ID in the .stripes
+    subdirectory. Every connection writes its stripe through its own file descriptor
+    positioned at the stripe's offset, and marks it done with a <transfer ID>.<index>
+    file, so the stripes may be received by different worker processes.
+    Uploads not completed for longer than the TTL are removed.
+    """
+
+    def __init__(self, directory: str, ttl: float, file_sync: FileSync):
+        """
+        Initializes the store, creating its directory if needed.
+
+        Args:
+            directory: The directory where the files are saved.
+            ttl: The time in seconds after which abandoned uploads are removed.
+            file_sync: The committer of the completed files.
+        """
+        self._directory = os.path.join(directory, STRIPES_DIRECTORY)
+        self._ttl = ttl
+        self._file_sync = file_sync
+        self._next_collection = time.monotonic()
+        os.makedirs(self._directory, exist_ok=True)
+
+    def open(
+        self, transfer_id: str, filesize: int, index: int, count: int
+    ) -> tuple[io.FileIO, int, int]:
+        """
+        Opens the file of a striped upload at the offset of a stripe, creating and
+        preallocating the file if the stripe is the first to arrive.
+
+        Args:
+            transfer_id: The client-chosen ID of the upload (hex digits).
+            filesize: The size of the complete file in bytes.
+            index: The index of the stripe.
+            count: The number of stripes.
+
+        Returns:
+            A tuple containing the file opened for unbuffered writing at the stripe's
+            offset, and the offsets of the stripe's start and end.
+
+        Raises:
+            ValueError: If the transfer ID or the stripe is malformed.
+        """
+        if not TRANSFER_ID_PATTERN.fullmatch(transfer_id):
+            raise ValueError(f"Invalid transfer ID: {transfer_id!r}")
+        if not 0 <= index < count:
+            raise ValueError(f"Invalid stripe: {index}/{count}")
+
+        path = os.path.join(self._directory, transfer_id)
+        file = open(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), "rb+", buffering=0)
+        try:
+            preallocate(file, filesize)
+            start, end = protocol.stripe_range(filesize, index, count)
+            file.seek(start)
+        except Exception:
+            file.close()
+            raise
+
+        return file, start, end
+
+    def finish(
+        self,
+        transfer_id: str,
+        filename: str,
+        index: int,
+        count: int,
+        filename_index: FilenameIndex,
+    ) -> str | None:
+        """
+        Marks a stripe as received, and moves the file to the storage directory
+        if it was the last one.
+
+        Args:
+            transfer_id: The ID of the upload.
+            filename: The original filename.
+            index: The index of the received stripe.
+            count: The number of stripes.
+            filename_index: The index of the filenames in the storage directory.
+
+        Returns:
+            The unique filename the file is saved under, or None if some stripes
+            have not arrived yet.
+        """
+        path = os.path.join(self._directory, transfer_id)
+        markers = [f"{path}.{i}" for i in range(count)]
+        open(markers[index], "w").close()
+
+        try:
+            lock_file = open(path, "rb")
+        except FileNotFoundError:
+            return None  # committed by another stripe in the meantime
+
+        with lock_file:
+            # Only one of the stripes finishing at the same time commits the file
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if not all(map(os.path.exists, markers)) or not os.path.exists(path):
+                return None
+
+            filename = self._file_sync.commit(path, filename, filename_index)
+            for marker in markers:
+                os.remove(marker)
+
+        return filename
+
+    def time_until_collection(self) -> float:
+        """
+        Returns the time left until the next removal of abandoned uploads.
+
+        Returns:
+            The time in seconds.
+        """
+        return max(self._next_collection - time.monotonic(), 0.0)
+
+    def collect_if_due(self) -> None:
+        """Removes the uploads not completed for longer than the TTL, if it is time."""
+        if self.time_until_collection():
+            return
+        self._next_collection = time.monotonic() + COLLECTION_INTERVAL
+
+        expiration = time.time() - self._ttl
+        with os.scandir(self._directory) as entries:
+            names = [entry.name for entry in entries]
+
+        for name in names:
+            path = os.path.join(self._directory, name)
+            try:
+                # Every stripe written to the file updates its modification time
+                if "." in name or os.stat(path).st_mtime > expiration:
+                    continue
+                os.remove(path)
+                for marker in names:
+                    if marker.startswith(f"{name}."):
+                        os.remove(os.path.join(self._directory, marker))
+                logging.info(f"Removed abandoned striped upload {name}")
+            except OSError:
+                continue
@@ -0,0 +1,88 @@
+import math
+import time
+
+
+class TimerWheel:
+    """
+    A hashed timing wheel: a ring of slots, one per tick, holding the items due
+    in that tick. Scheduling, cancelling and expiring an item take constant time,
+    however many items are scheduled.
+
+    A deadline more than a round of the ring ahead shares its slot with an earlier
+    tick, so its item comes out early; the caller checks the item's actual deadline
+    and schedules it again. Deadlines are perf_counter() times.
+    """
+
+    def __init__(self, tick: float, size: int = 512):
+        """
+        Initializes the wheel.
+
+        Args:
+            tick: The duration of a slot in seconds, the precision of the deadlines.
+            size: The number of slots.
+        """
+        self._tick = tick
+        self._slots: list[set] = [set() for _ in range(size)]
+        self._slot_of: dict[object, int] = {}
+        self._current_tick = int(time.perf_counter() / tick)
+
+    def schedule(self, item: object, deadline: float) -> None:
+        """
+        Schedules an item, replacing its previous deadline.
+
+        Args:
+            item: The hashable item.
+            deadline: The time the item is due at.
+        """
+        self.cancel(item)
+        tick = max(math.ceil(deadline / self._tick), self._current_tick + 1)
+        slot = tick % len(self._slots)
+        self._slots[slot].add(item)
+        self._slot_of[item] = slot
+
+    def cancel(self, item: object) -> None:
+        """
+        Removes an item from the wheel, if it is scheduled.
+
+        Args:
+            item: The item.
+        """
+        slot = self._slot_of.pop(item, None)
+        if slot is not None:
+            self._slots[slot].discard(item)
+
+    def time_until_next_tick(self) -> float | None:
+        """
+        Returns the time left until the next slot is due.
+
+        Returns:
+            The time in seconds, or None if no items are scheduled.
+        """
+        if not self._slot_of:
+            return None
+        return max((self._current_tick + 1) * self._tick - time.perf_counter(), 0.0)
+
+    def expire(self, now: float) -> list:
+        """
+        Removes the items of the slots passed since the last call.
+
+        Args:
+            now: The current perf_counter() time.
+
+        Returns:
+            The items that may be due, see the class docstring.
+        """
+        target_tick = int(now / self._tick)
+        expired = []
+        # Every slot is visited once at most, even after a long stall
+        last_tick = min(target_tick, self._current_tick + len(self._slots))
+        for tick in range(self._current_tick + 1, last_tick + 1):
+            slot = self._slots[tick % len(self._slots)]
+            if slot:
+                for item in slot:
+                    del self._slot_of[item]
+                expired += slot
+                slot.clear()
+
+        self._current_tick = max(self._current_tick, target_tick)
+        return expired
@@ -0,0 +1,127 @@
+import threading
+
+import tqdm
+
+# The progress displays sample the byte counters this often, in seconds
+PROGRESS_INTERVAL = 0.1
+
+
+class ByteCounter:
+    """
+    The bytes sent by a single thread. Only that thread adds to it, so the send loop
+    increments a plain integer without a lock, and the samplers only read it.
+    """
+
+    __slots__ = ("value",)
+
+    def __init__(self):
+        """Initializes the counter at 0."""
+        self.value = 0
+
+
+class TransferProgress:
+    """
+    The progress of a transfer, shared between the threads sending it and the ones
+    displaying it. Every sending thread counts its bytes in a ByteCounter of its own,
+    kept for all the files it sends, and the displays (ProgressBar, the GUI) sample
+    their sum at their own pace, so the send loop never formats or emits anything.
+
+    The transfer is canceled through an event the send loop checks per chunk.
+    """
+
+    def __init__(self, total: int = 0):
+        """
+        Initializes the progress, with nothing sent.
+
+        Args:
+            total: The number of bytes to send, 0 if unknown.
+        """
+        self.total = total
+        self.cancelled = threading.Event()
+        self._initial = 0
+        self._counters: list[ByteCounter] = []
+        self._local = threading.local()
+
+    @property
+    def sent(self) -> int:
+        """The number of bytes sent so far, including the ones resumed from."""
+        return self._initial + sum(counter.value for counter in self._counters)
+
+    def counter(self) -> ByteCounter:
+        """
+        Returns the counter of the calling thread, created on its first call.
+
+        Returns:
+            The counter, counted in sent.
+        """
+        counter = getattr(self._local, "counter", None)
+        if counter is None:
+            counter = self._local.counter = ByteCounter()
+            self._counters.append(counter)
+        return counter
+
+    def restart(self, total: int, initial: int) -> None:
+        """
+        Starts counting over, for an attempt resuming a transfer.
+
+        Args:
+            total: The number of bytes to send.
+            initial: The number of bytes the server already has.
+        """
+        self.total = total
+        self._counters = []
+        self._local = threading.local()
+        self._initial = initial
+
+    def cancel(self) -> None:
+        """Asks the sending threads to stop, from any thread."""
+        self.cancelled.set()
+
+
+class ProgressBar:
+    """
+    A tqdm progress bar displaying a TransferProgress, updated by a thread sampling
+    it every PROGRESS_INTERVAL seconds while the bar is open.
+    """
+
+    def __init__(self, progress: TransferProgress, desc: str):
+        """
+        Initializes the bar at the bytes sent so far.
+
+        Args:
+            progress: The progress to display.
+            desc: The description shown before the bar.
+        """
+        self._progress = progress
+        self._pbar = tqdm.tqdm(
+            desc=desc,
+            total=progress.total or None,
+            initial=progress.sent,
+            ncols=80,
+            unit="B",
+            unit_scale=True,
+        )
+        self._closed = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+
+    def __enter__(self) -> "ProgressBar":
+        """Starts sampling the progress."""
+        self._sampler.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        """Stops sampling, and closes the bar at the final progress."""
+        self._closed.set()
+        self._sampler.join()
+        self._update()
+        self._pbar.close()
+
+    def _sample(self) -> None:
+        """Updates the bar until it is closed."""
+        while not self._closed.wait(PROGRESS_INTERVAL):
+            self._update()
+
+    def _update(self) -> None:
+        """Moves the bar to the bytes sent so far, out of the total known so far."""
+        self._pbar.total = self._progress.total or None
+        self._pbar.update(self._progress.sent - self._pbar.n)
@@ -0,0 +1,367 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import shlex
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import dotenv
+
+sys.path.append(os.path.abspath("../src"))
+
+import checksum  # noqa: E402
+import protocol  # noqa: E402
+from disk_writer import FSYNC_POLICIES  # noqa: E402
+from test_files_gen import generate_text_file  # noqa: E402
+
+SERVER_SCRIPT = os.path.abspath("../src/server.py")
+SERVER_START_TIMEOUT = 10
+# The metrics compared with a baseline, and whether higher is better
+COMPARED_METRICS = {
+    "mb_s": True,
+    "files_s": True,
+    "p50_ms": False,
+    "p99_ms": False,
+    "server_cpu_percent": False,
+    "server_rss_mib": False,
+}
+
+
+def generate_corpus(directory: str, sizes_kib: list[int]) -> dict[int, str]:
+    """Generates a text file of every size, like test_files_gen.py."""
+    corpus = {}
+    for size in sizes_kib:
+        corpus[size] = os.path.join(directory, f"test_file_{size}.txt")
+        generate_text_file(corpus[size], size)
+        # generate_text_file() writes whole KiB blocks past the size
+        os.truncate(corpus[size], size * 1024)
+
+    return corpus
+
+
+def read_process_usage(pid: int) -> tuple[float, float]:
+    """
+    Returns the CPU time (s) and the resident set size (MiB) of a process and
+    its children, i.e. the worker processes of the server.
+    """
+    with open(f"/proc/{pid}/task/{pid}/children") as children_file:
+        children = [int(child) for child in children_file.read().split()]
+
+    cpu_time = rss = 0.0
+    for process in [pid] + children:
+        try:
+            with open(f"/proc/{process}/stat") as stat_file:
+                # The fields after the command name, which may contain spaces
+                fields = stat_file.read().rsplit(")", 1)[1].split()
+        except FileNotFoundError:
+            continue
+        cpu_time += (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        rss += int(fields[21]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+    return cpu_time, rss
+
+
+def start_server(
+    directory: str, port: int, bufsize: int, server_args: list[str]
+) -> subprocess.Popen:
+    """Starts a local server with the given CONNECTION_BUFSIZE and waits for it."""
+    # Variables set in the environment take precedence over .env
+    env = dict(os.environ, CONNECTION_BUFSIZE=str(bufsize))
+    server = subprocess.Popen(
+        [sys.executable, SERVER_SCRIPT, directory, "-H", "127.0.0.1", "-p", str(port)]
+        + server_args,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with code {server.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+
+    server.kill()
+    raise RuntimeError("Server did not start listening")
+
+
+def stop_server(server: subprocess.Popen) -> None:
+    """Stops the server like Ctrl+C, so it flushes its journal."""
+    server.terminate()
+    try:
+        server.wait(SERVER_START_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+async def upload(
+    port: int, file_path: str, filename: str, trailer: bytes, fields: dict[str, str]
+) -> float:
+    """
+    Sends a file over a new connection with sendfile() and waits for the
+    acknowledgement. Returns the time from the connection to the ack.
+    """
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    with socket.socket() as client_socket, open(file_path, "rb") as f:
+        client_socket.setblocking(False)
+        await loop.sock_connect(client_socket, ("127.0.0.1", port))
+        filesize = os.fstat(f.fileno()).st_size
+        await loop.sock_sendall(
+            client_socket, protocol.encode_metadata(filename, filesize, **fields)
+        )
+        if filesize:
+            await loop.sock_sendfile(client_socket, f, 0, filesize)
+        if trailer:
+            await loop.sock_sendall(client_socket, trailer)
+        if await loop.sock_recv(client_socket, 1) != protocol.LEGACY_ACK:
+            raise ConnectionResetError("Server failed to receive the file")
+
+    return time.perf_counter() - start
+
+
+async def run_cell(
+    port: int,
+    file_path: str,
+    concurrency: int,
+    uploads: int,
+    algorithm: str | None,
+) -> tuple[list[float], int, float]:
+    """
+    Runs the uploads over `concurrency` concurrent clients, every client sending
+    files one after another until all uploads are done.
+
+    Returns:
+        The times to ack of the successful uploads, the number of failed ones,
+        and the elapsed time.
+    """
+    fields = {}
+    trailer = b""
+    if algorithm:
+        # The checksum is computed once, so only the server's cost is measured
+        digest = checksum.create_checksum(algorithm)
+        with open(file_path, "rb") as f:
+            while chunk := f.read(2**20):
+                digest.update(chunk)
+        fields["sum"] = algorithm
+        trailer = protocol.CHECKSUM.pack(digest.intdigest())
+
+    remaining = iter(range(uploads))
+    latencies = []
+    failed = 0
+
+    async def run_client() -> None:
+        nonlocal failed
+        for index in remaining:
+            try:
+                latencies.append(
+                    await upload(port, file_path, f"bench_{index}.txt", trailer, fields)
+                )
+            except OSError:
+                failed += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run_client() for _ in range(concurrency)))
+    return latencies, failed, time.perf_counter() - start
+
+
+def clear_directory(directory: str) -> None:
+    """Removes the received files, keeping the server's own state."""
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.startswith("bench_"):
+                os.remove(entry.path)
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    return sorted_values[int((len(sorted_values) - 1) * fraction)]
+
+
+def run_sweep(args: argparse.Namespace, corpus: dict[int, str], work_dir: str) -> list:
+    results = []
+    server_args = shlex.split(args.server_args)
+    for bufsize in args.bufsizes:
+        storage = os.path.join(work_dir, f"storage_{bufsize}")
+        server = start_server(storage, args.port, bufsize, server_args)
+        try:
+            for concurrency in args.concurrency:
+                for size in args.sizes:
+                    uploads = max(
+                        concurrency, math.ceil(args.volume * 2**20 / (size * 1024))
+                    )
+                    cpu_before, _ = read_process_usage(server.pid)
+                    latencies, failed, elapsed = asyncio.run(
+                        run_cell(
+                            args.port, corpus[size], concurrency, uploads, args.checksum
+                        )
+                    )
+                    cpu_after, rss = read_process_usage(server.pid)
+                    clear_directory(storage)
+
+                    succeeded = len(latencies)
+                    latencies = sorted(latencies) or [0.0]
+                    result = {
+                        "bufsize": bufsize,
+                        "concurrency": concurrency,
+                        "size_kib": size,
+                        "uploads": uploads,
+                        "failed": failed,
+                        "mb_s": succeeded * size * 1024 / 1e6 / elapsed,
+                        "files_s": succeeded / elapsed,
+                        "p50_ms": statistics.median(latencies) * 1000,
+                        "p99_ms": percentile(latencies, 0.99) * 1000,
+                        "server_cpu_percent": (cpu_after - cpu_before) / elapsed * 100,
+                        "server_rss_mib": rss,
+                    }
+                    results.append(result)
+                    print_result(result)
+        finally:
+            stop_server(server)
+
+    return results
+
+
+def print_result(result: dict) -> None:
+    print(
+        f"bufsize {result['bufsize']:>7} | clients {result['concurrency']:>4} | "
+        f"{result['size_kib']:>7} KiB x {result['uploads']:<5} | "
+        f"{result['mb_s']:8.1f} MB/s {result['files_s']:8.1f} files/s | "
+        f"ack p50 {result['p50_ms']:8.1f} ms p99 {result['p99_ms']:8.1f} ms | "
+        f"server CPU {result['server_cpu_percent']:5.1f}% "
+        f"RSS {result['server_rss_mib']:6.1f} MiB"
+        + (f" | {result['failed']} failed" if result["failed"] else "")
+    )
+
+
+def compare_with_baseline(results: list[dict], baseline_path: str) -> None:
+    """Prints the change of every metric against the same cell of a baseline run."""
+    with open(baseline_path) as baseline_file:
+        baseline = {
+            (cell["bufsize"], cell["concurrency"], cell["size_kib"]): cell
+            for cell in json.load(baseline_file)["results"]
+        }
+
+    print(f"\nCompared with {baseline_path} (+ is better):")
+    for result in results:
+        key = (result["bufsize"], result["concurrency"], result["size_kib"])
+        if key not in baseline:
+            continue
+
+        changes = []
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            old, new = baseline[key][metric], result[metric]
+            if not old:
+                continue
+            change = (new - old) / old * 100 * (1 if higher_is_better else -1)
+            changes.append(f"{metric} {change:+.1f}%")
+        print(f"bufsize {key[0]:>7} | clients {key[1]:>4} | {key[2]:>7} KiB | ", end="")
+        print(", ".join(changes))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmarks a local server over a sweep of concurrency, file size "
+        "and CONNECTION_BUFSIZE, reporting throughput, time to ack and server usage"
+    )
+    parser.add_argument(
+        "-c", "--concurrency", type=int, nargs="+", default=[1, 16, 128]
+    )
+    parser.add_argument(
+        "-s",
+        "--sizes",
+        type=int,
+        nargs="+",
+        help="File sizes in KiB (default: TEST_FILES_LENGTHS_KIB up to 10000)",
+    )
+    parser.add_argument(
+        "-b",
+        "--bufsizes",
+        type=int,
+        nargs="+",
+        help="CONNECTION_BUFSIZE values (default: the .env one and 65536)",
+    )
+    parser.add_argument(
+        "-v",
+        "--volume",
+        type=int,
+        default=64,
+        help="MiB to send per cell at least, in uploads of the same size (default: 64)",
+    )
+    parser.add_argument(
+        "-k",
+        "--checksum",
+        choices=checksum.ALGORITHMS,
+        help="Send the files with a checksum, to measure the overhead of verifying them",
+    )
+    parser.add_argument(
+        "-f",
+        "--fsync",
+        choices=FSYNC_POLICIES,
+        help="FILE_FSYNC policy of the server, to measure the cost of durability "
+        "(default: the .env one)",
+    )
+    parser.add_argument(
+        "-a",
+        "--server-args",
+        default="",
+        help='Extra server arguments, e.g. "-e asyncio" or "-t 4"',
+    )
+    parser.add_argument("-p", "--port", type=int, default=12346)
+    parser.add_argument("-o", "--output", help="Path to write the JSON results to")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in os.getenv("TEST_FILES_LENGTHS_KIB").split()]
+    args.sizes = args.sizes or [size for size in sizes if size <= 10000]
+    args.bufsizes = args.bufsizes or sorted(
+        {int(os.getenv("CONNECTION_BUFSIZE")), 65536}
+    )
+    # The server inherits the variable, which takes precedence over .env
+    args.fsync = args.fsync or os.getenv("FILE_FSYNC")
+    os.environ["FILE_FSYNC"] = args.fsync
+
+    work_dir = tempfile.mkdtemp(prefix="benchmark_")
+    try:
+        corpus = generate_corpus(work_dir, args.sizes)
+        results = run_sweep(args, corpus, work_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(
+                {
+                    "settings": {
+                        "server_args": args.server_args,
+                        "checksum": args.checksum,
+                        "fsync": args.fsync,
+                        "volume_mib": args.volume,
+                        "python": platform.python_version(),
+                        "platform": platform.platform(),
+                        "cpus": os.cpu_count(),
+                    },
+                    "results": results,
+                },
+                output_file,
+                indent=2,
+            )
+    if args.baseline:
+        compare_with_baseline(results, args.baseline)
+
+
+if __name__ == "__main__":
+    dotenv.load_dotenv()
+    main()
@@ -0,0 +1,105 @@
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+import dotenv
+
+sys.path.append(os.path.abspath("../src"))
+
+import checksum  # noqa: E402
+import protocol  # noqa: E402
+
+
+async def upload(
+    host: str,
+    port: int,
+    payload: bytes,
+    index: int,
+    start_event: asyncio.Event,
+    algorithm: str | None,
+) -> float:
+    """
+    Connects to the server, waits for start_event, sends a file (followed by
+    its checksum if an algorithm is given) and waits for the acknowledgement.
+    Returns the time from the start to the ack.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        await start_event.wait()
+        start = time.perf_counter()
+        fields = {"sum": algorithm} if algorithm else {}
+        writer.write(
+            protocol.encode_metadata(f"client_{index}.bin", len(payload), **fields)
+        )
+        writer.write(payload)
+        if algorithm:
+            # Computed per upload, so the client's cost is measured as well
+            digest = checksum.create_checksum(algorithm)
+            digest.update(payload)
+            writer.write(protocol.CHECKSUM.pack(digest.intdigest()))
+        await writer.drain()
+        if await reader.read(1) != protocol.LEGACY_ACK:
+            raise ConnectionResetError("Server failed to receive the file")
+        return time.perf_counter() - start
+    finally:
+        writer.close()
+
+
+async def run(
+    host: str, port: int, clients: int, size: int, algorithm: str | None
+) -> None:
+    payload = os.urandom(size)
+    start_event = asyncio.Event()
+    uploads = [
+        asyncio.create_task(upload(host, port, payload, i, start_event, algorithm))
+        for i in range(clients)
+    ]
+
+    # Lets every client connect before any of them starts sending
+    await asyncio.sleep(1)
+    start = time.perf_counter()
+    start_event.set()
+    results = await asyncio.gather(*uploads, return_exceptions=True)
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(result for result in results if isinstance(result, float))
+    failed = len(results) - len(latencies)
+    if not latencies:
+        print(f"All {failed} uploads failed, e.g.: {results[0]}")
+        return
+
+    sent = len(latencies) * size
+    print(f"{len(latencies)} uploads of {size} bytes, {failed} failed")
+    print(f"{sent / 2**20 / elapsed:.1f} MiB/s, {len(latencies) / elapsed:.1f} files/s")
+    print(
+        f"Time to ack: p50 {statistics.median(latencies) * 1000:.1f} ms, "
+        f"p99 {latencies[int((len(latencies) - 1) * 0.99)] * 1000:.1f} ms"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Uploads a file from many concurrent clients at once, "
+        "to compare the server engines"
+    )
+    parser.add_argument("-H", "--host", default="127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, default=12345)
+    parser.add_argument("-c", "--clients", type=int, default=1000)
+    parser.add_argument("-s", "--size", type=int, default=100 * 1024)
+    parser.add_argument(
+        "-k",
+        "--checksum",
+        choices=checksum.ALGORITHMS,
+        help="Send the files with a checksum, to measure the overhead of verifying them",
+    )
+    args = parser.parse_args()
+
+    asyncio.run(run(args.host, args.port, args.clients, args.size, args.checksum))
+
+
+if __name__ == "__main__":
+    dotenv.load_dotenv()
+    main()
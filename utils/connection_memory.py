@@ -0,0 +1,120 @@
+import argparse
+import os
+import resource
+import shlex
+import socket
+import sys
+import tempfile
+import time
+
+import dotenv
+
+sys.path.append(os.path.abspath("../src"))
+
+import checksum  # noqa: E402
+import protocol  # noqa: E402
+from benchmark import read_process_usage, start_server, stop_server  # noqa: E402
+
+# The RSS of the server is considered settled once it stops changing for this long
+SETTLE_INTERVAL = 0.5
+
+
+def open_connections(
+    port: int, count: int, state: str, algorithm: str | None
+) -> list[socket.socket]:
+    """
+    Opens connections left waiting in a state: "metadata" sends a part of the
+    metadata frame, "file" sends the metadata and the first bytes of the content.
+    """
+    fields = {"sum": algorithm} if algorithm else {}
+    metadata = protocol.encode_metadata("memory_test.bin", 2**20, **fields)
+    if state == "metadata":
+        payload = metadata[: protocol.FRAME_HEADER.size + 1]
+    else:
+        payload = metadata + bytes(4096)
+
+    client_sockets = []
+    for _ in range(count):
+        client_socket = socket.create_connection(("127.0.0.1", port))
+        client_socket.sendall(payload)
+        client_sockets.append(client_socket)
+
+    return client_sockets
+
+
+def settled_rss(pid: int) -> float:
+    """Waits for the server to handle the pending connections and returns its RSS."""
+    rss = read_process_usage(pid)[1]
+    while True:
+        time.sleep(SETTLE_INTERVAL)
+        previous, rss = rss, read_process_usage(pid)[1]
+        if rss == previous:
+            return rss
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Measures the memory a local server takes per open connection"
+    )
+    parser.add_argument("-n", "--connections", type=int, default=5000)
+    parser.add_argument(
+        "-s",
+        "--state",
+        choices=("metadata", "file"),
+        default="metadata",
+        help="Leave the connections in the middle of the metadata, or of the "
+        "content of a file (default: metadata)",
+    )
+    parser.add_argument(
+        "-k",
+        "--checksum",
+        choices=checksum.ALGORITHMS,
+        help="Announce a checksum, so the content is received with recv_into()",
+    )
+    parser.add_argument(
+        "-a",
+        "--server-args",
+        default="",
+        help='Extra server arguments, e.g. "-t 4"',
+    )
+    parser.add_argument("-p", "--port", type=int, default=12346)
+    args = parser.parse_args()
+
+    # Both this process and the server (inheriting the limit) hold a descriptor per
+    # connection, the server another one per open file
+    _, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard_limit, hard_limit))
+    # All the connections come from localhost; the variables take precedence over .env
+    os.environ.update(MAX_CONNECTIONS="0", MAX_CONNECTIONS_PER_IP="0")
+
+    with tempfile.TemporaryDirectory(prefix="connection_memory_") as directory:
+        server = start_server(
+            directory,
+            args.port,
+            int(os.getenv("CONNECTION_BUFSIZE")),
+            shlex.split(args.server_args),
+        )
+        client_sockets = []
+        try:
+            # A few connections first, so one-off allocations are not counted
+            client_sockets += open_connections(args.port, 10, args.state, args.checksum)
+            before = settled_rss(server.pid)
+            client_sockets += open_connections(
+                args.port, args.connections, args.state, args.checksum
+            )
+            after = settled_rss(server.pid)
+        finally:
+            for client_socket in client_sockets:
+                client_socket.close()
+            stop_server(server)
+
+    print(
+        f"{args.connections} connections in the {args.state} state: "
+        f"server RSS {before:.1f} -> {after:.1f} MiB, "
+        f"{(after - before) * 1024 / args.connections:.2f} KiB per connection"
+    )
+
+
+if __name__ == "__main__":
+    dotenv.load_dotenv()
+    main()
@@ -0,0 +1,115 @@
+import argparse
+import logging
+import os
+import shlex
+import sys
+import tempfile
+import time
+
+import dotenv
+
+sys.path.append(os.path.abspath("../src"))
+# Only the chart is printed; tqdm reads its settings when it is imported
+os.environ["TQDM_DISABLE"] = "1"
+
+import client_cli  # noqa: E402
+from benchmark import start_server, stop_server  # noqa: E402
+
+# The width of the longest bar of the chart, in characters
+CHART_WIDTH = 50
+# The random bytes rewritten at the start of the file before every send
+UNIQUE_PREFIX_SIZE = 4096
+
+
+def measure_window(port: int, file_path: str, window: int, repeat: int) -> float:
+    """
+    Sends the file with the client's send_file() and a SEND_WINDOW, and returns
+    the best throughput of the repeats in MB/s.
+    """
+    os.environ["SEND_WINDOW"] = str(window)
+    filesize = os.path.getsize(file_path)
+    best = 0.0
+    for _ in range(repeat):
+        # New content is not deduplicated by its hash, nor resumed, as the new
+        # modification time changes the transfer ID
+        with open(file_path, "r+b") as f:
+            f.write(os.urandom(UNIQUE_PREFIX_SIZE))
+        start = time.perf_counter()
+        client_cli.send_file(file_path, "127.0.0.1", port)
+        best = max(best, filesize / 1e6 / (time.perf_counter() - start))
+
+    return best
+
+
+def print_chart(results: dict[str, float]) -> None:
+    """Prints the throughput of every window as a horizontal bar chart."""
+    highest = max(results.values())
+    for label, throughput in results.items():
+        bar = "#" * max(round(throughput / highest * CHART_WIDTH), 1)
+        print(f"{label:>9} | {bar:<{CHART_WIDTH}} {throughput:8.1f} MB/s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Charts the client's throughput to a local server against "
+        "the size of its sendfile() calls (SEND_WINDOW)"
+    )
+    parser.add_argument(
+        "-w",
+        "--windows",
+        type=int,
+        nargs="+",
+        default=[2**14, 2**16, 2**18, 2**20, 2**22, 2**24],
+        help="Fixed windows in bytes, charted along with the adaptive one "
+        "(default: 16 KiB to 16 MiB)",
+    )
+    parser.add_argument(
+        "-s", "--size", type=int, default=256, help="File size in MiB (default: 256)"
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        type=int,
+        default=3,
+        help="Sends per window, the best one is charted (default: 3)",
+    )
+    parser.add_argument(
+        "-a",
+        "--server-args",
+        default="",
+        help='Extra server arguments, e.g. "-e asyncio"',
+    )
+    parser.add_argument("-p", "--port", type=int, default=12346)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+
+    with tempfile.TemporaryDirectory(prefix="send_window_") as directory:
+        file_path = os.path.join(directory, "send_window.bin")
+        with open(file_path, "wb") as f:
+            for _ in range(args.size):
+                f.write(os.urandom(2**20))
+
+        server = start_server(
+            os.path.join(directory, "storage"),
+            args.port,
+            int(os.getenv("CONNECTION_BUFSIZE")),
+            shlex.split(args.server_args),
+        )
+        results = {}
+        try:
+            for window in args.windows + [0]:
+                label = f"{window // 1024} KiB" if window else "adaptive"
+                results[label] = measure_window(
+                    args.port, file_path, window, args.repeat
+                )
+        finally:
+            stop_server(server)
+
+    print(f"{args.size} MiB file, best of {args.repeat}:")
+    print_chart(results)
+
+
+if __name__ == "__main__":
+    dotenv.load_dotenv()
+    main()
@@ -0,0 +1,86 @@
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import dotenv
+
+sys.path.append(os.path.abspath("../src"))
+
+import client_cli  # noqa: E402
+
+
+def dribble_metadata(
+    host: str, port: int, delay: float, stop_event: threading.Event
+) -> None:
+    """
+    Connects to the server and sends a metadata header one byte at a time,
+    reconnecting until stop_event is set.
+    """
+    file_info = "slow_client.txt/0"
+    metadata_size = int(os.getenv("METADATA_LENGTH_SIZE"))
+    header = f"{len(file_info):<{metadata_size}}{file_info}".encode()
+
+    while not stop_event.is_set():
+        with socket.create_connection((host, port)) as client_socket:
+            for i in range(len(header)):
+                if stop_event.wait(delay):
+                    return
+                client_socket.sendall(header[i : i + 1])
+            client_socket.recv(1)
+
+
+def measure_transfer(file_path: str, host: str, port: int) -> float:
+    """
+    Sends a copy of the file ending in new random bytes, so the server neither
+    resumes nor deduplicates it, and returns the throughput in MiB/s.
+    """
+    with tempfile.TemporaryDirectory(prefix="slow_header_") as directory:
+        copy_path = os.path.join(directory, os.path.basename(file_path))
+        shutil.copyfile(file_path, copy_path)
+        with open(copy_path, "ab") as f:
+            f.write(os.urandom(16))
+
+        start = time.perf_counter()
+        client_cli.send_file(copy_path, host, port)
+        elapsed = time.perf_counter() - start
+        return os.path.getsize(copy_path) / elapsed / 2**20
+
+
+def main() -> None:
+    slow_clients_num = 200
+    byte_delay = 0.05
+    file_path = "../test_files/test_file_100000.txt"
+    host = "127.0.0.1"
+    port = 12345
+
+    baseline = measure_transfer(file_path, host, port)
+
+    stop_event = threading.Event()
+    slow_clients = [
+        threading.Thread(
+            target=dribble_metadata, args=(host, port, byte_delay, stop_event)
+        )
+        for _ in range(slow_clients_num)
+    ]
+    for slow_client in slow_clients:
+        slow_client.start()
+
+    try:
+        time.sleep(1)
+        loaded = measure_transfer(file_path, host, port)
+    finally:
+        stop_event.set()
+        for slow_client in slow_clients:
+            slow_client.join()
+
+    print(f"Without slow clients: {baseline:.1f} MiB/s")
+    print(f"With {slow_clients_num} slow clients: {loaded:.1f} MiB/s")
+
+
+if __name__ == "__main__":
+    dotenv.load_dotenv()
+    main()